@@ -0,0 +1,98 @@
+"""
+Compare the patch encoders (see opm.writers.PatchEncoder): encode throughput and bytes per patch.
+
+Patches are read once from the slide, then every encoder encodes the same arrays, so only the encoding cost is timed.
+Throughput is measured in MB of raw patch pixels encoded per second. With a label map, its patches are encoded with
+each encoder's label_map_encoder() and checked to decode back to the exact same values.
+
+Example, on a synthetic slide and label map (see benchmarks.synthetic):
+    python -m benchmarks.synthetic -o synthetic --width 8000 --height 6000 --compression jpeg
+    SLIDE=synthetic/synthetic_8000x6000_t256_jpeg_f0.5_l3_s0
+    python -m benchmarks.bench_encoders -i $SLIDE.tiff -lm ${SLIDE}_lm.tiff -c opm/config.yml -n 200
+"""
+
+import io
+import os
+import time
+import argparse
+import tempfile
+import shutil
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from opm.patch_manager import PatchManager
+from opm.utils import parse_config, generate_initial_mask
+from opm.writers import PatchEncoder
+
+ENCODERS = [PatchEncoder("png", 1), PatchEncoder("png", 6), PatchEncoder("png", 9),
+            PatchEncoder("webp", 1), PatchEncoder("webp", 6),
+            PatchEncoder("jpeg", jpeg_quality=75), PatchEncoder("jpeg", jpeg_quality=90),
+            PatchEncoder("npy")]
+
+
+def decode(data, encoder):
+    if encoder.patch_format == "npy":
+        return np.load(io.BytesIO(data))
+    return np.asarray(Image.open(io.BytesIO(data)))
+
+
+def benchmark(encoder, arrays, repeats):
+    """
+    @return: (best total encoding time over the repeats in seconds, total encoded bytes)
+    """
+    best, n_bytes = np.inf, 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        n_bytes = sum(len(encoder.encode(array)) for array in arrays)
+        best = min(best, time.perf_counter() - start)
+    return best, n_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_path', dest='input_path', required=True, help="input path for the tissue")
+    parser.add_argument('-lm', '--label_map_path', dest='label_map_path', help="input path for the label mask")
+    parser.add_argument('-c', '--config', dest='config', default="opm/config.yml", help="config.yml for running OPM.")
+    parser.add_argument('-n', '--num_patches', dest='num_patches', type=int, default=200,
+                        help="number of patches encoded per encoder")
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3, help="timed repeats per encoder")
+    args = parser.parse_args()
+
+    cfg = parse_config(args.config)
+    cfg.update(num_patches=args.num_patches, read_type="grid")
+    slide_path = os.path.abspath(args.input_path)
+
+    out_dir = tempfile.mkdtemp(prefix="opm_bench_")
+    try:
+        manager = PatchManager(slide_path, out_dir)
+        mask, scale = generate_initial_mask(slide_path, cfg['scale'])
+        manager.set_valid_mask(mask, scale)
+        if args.label_map_path is not None:
+            manager.set_label_map(args.label_map_path)
+        samples = list(manager.iter_patches(cfg))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    slide_arrays = [sample[1] for sample in samples]
+    lm_arrays = [sample[2] for sample in samples if sample[2] is not None]
+    print("Encoding {} patches of {}".format(len(slide_arrays), slide_arrays[0].shape if slide_arrays else None))
+
+    results = []
+    for encoder in ENCODERS:
+        for kind, arrays, kind_encoder in [("slide", slide_arrays, encoder),
+                                           ("label map", lm_arrays, encoder.label_map_encoder())]:
+            if not arrays:
+                continue
+            seconds, n_bytes = benchmark(kind_encoder, arrays, args.repeats)
+            if kind == "label map":
+                # Label maps must round-trip exactly
+                assert all((decode(kind_encoder.encode(array), kind_encoder) == array).all() for array in arrays)
+            raw_bytes = sum(array.nbytes for array in arrays)
+            results.append({"patches": kind,
+                            "encoder": repr(kind_encoder),
+                            "MB_per_sec": raw_bytes / 1024 ** 2 / seconds,
+                            "bytes_per_patch": n_bytes / len(arrays),
+                            "ratio": raw_bytes / n_bytes})
+
+    print(pd.DataFrame(results).to_string(index=False, float_format="%.2f"))
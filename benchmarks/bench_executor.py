@@ -0,0 +1,73 @@
+"""
+Compare patches/sec of the 'thread' and 'process' executors for a range of worker counts.
+
+The same set of grid coordinates is extracted for every run through PatchManager.save_predefined_patches, so each run
+does identical read/encode/write work.
+
+Example, on a synthetic slide (see benchmarks.synthetic):
+    python -m benchmarks.synthetic -o synthetic --width 8000 --height 6000 --compression jpeg
+    SLIDE=synthetic/synthetic_8000x6000_t256_jpeg_f0.5_l3_s0
+    python -m benchmarks.bench_executor -i $SLIDE.tiff -c opm/config.yml -w 1,2,4,8 -n 500
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import shutil
+
+import pandas as pd
+from opm.patch_manager import PatchManager
+from opm.utils import parse_config, generate_initial_mask
+
+
+def run_once(slide_path, label_map_path, config, coord_csv, executor_type, n_workers):
+    out_dir = tempfile.mkdtemp(prefix="opm_bench_")
+    try:
+        run_config = dict(config, executor=executor_type, num_workers=n_workers)
+        manager = PatchManager(slide_path, out_dir)
+        if label_map_path is not None:
+            manager.set_label_map(label_map_path)
+        start = time.perf_counter()
+        manager.save_predefined_patches(patch_coord_csv=coord_csv, config=run_config)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_path', dest='input_path', required=True, help="input path for the tissue")
+    parser.add_argument('-lm', '--label_map_path', dest='label_map_path', help="input path for the label mask")
+    parser.add_argument('-c', '--config', dest='config', required=True, help="config.yml for running OPM.")
+    parser.add_argument('-w', '--workers', dest='workers', default="1,2,4,8", help="comma separated worker counts")
+    parser.add_argument('-n', '--num_patches', dest='num_patches', type=int, default=500,
+                        help="number of patches extracted per run")
+    args = parser.parse_args()
+
+    cfg = parse_config(args.config)
+    slide_path = os.path.abspath(args.input_path)
+
+    # Build one fixed coordinate list shared by every run
+    manager = PatchManager(slide_path, tempfile.mkdtemp(prefix="opm_bench_"))
+    mask, scale = generate_initial_mask(slide_path, cfg['scale'])
+    manager.set_valid_mask(mask, scale)
+    coordinates = manager.get_grid_coordinates(cfg['patch_size'], cfg['overlap_factor'])[:args.num_patches]
+    shutil.rmtree(manager.output_dir, ignore_errors=True)
+
+    coord_csv = os.path.join(tempfile.mkdtemp(prefix="opm_bench_"), "coords.csv")
+    pd.DataFrame({"PatchCoordinatesX": coordinates[:, 1],
+                  "PatchCoordinatesY": coordinates[:, 0]}).to_csv(coord_csv, index=False)
+
+    results = []
+    for n_workers in [int(w) for w in args.workers.split(",")]:
+        for executor_type in ["thread", "process"]:
+            elapsed = run_once(slide_path, args.label_map_path, cfg, coord_csv, executor_type, n_workers)
+            results.append({"executor": executor_type,
+                            "workers": n_workers,
+                            "patches": len(coordinates),
+                            "seconds": elapsed,
+                            "patches_per_sec": len(coordinates) / elapsed})
+
+    shutil.rmtree(os.path.dirname(coord_csv), ignore_errors=True)
+    print(pd.DataFrame(results).to_string(index=False))
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of label map value mapping and class proportions on 1024x1024 uint8/uint16 label tiles.
+
+Compares the previous implementation (one boolean comparison per value_map key, then np.unique) with the lookup-table
+map_values, the bincount based get_patch_class_proportions, and the fused map_values_with_proportions.
+
+Example:
+    python -m benchmarks.bench_label_ops -s 1024 -r 20
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+from opm.utils import map_values, get_patch_class_proportions, map_values_with_proportions, print_sorted_dict
+
+
+def map_values_reference(image, dictionary):
+    template = image.copy()
+    for key, value in dictionary.items():
+        template[image == key] = value
+    return template
+
+
+def class_proportions_reference(image):
+    unique, counts = np.unique(image, return_counts=True)
+    denom = image.shape[0] * image.shape[1]
+    return print_sorted_dict({val: count / denom for val, count in zip(unique, counts)})
+
+
+def make_label_tile(size, n_classes, dtype, rng):
+    # Blocky label regions, closer to real label maps than per-pixel noise
+    blocks = rng.integers(0, n_classes, (size // 32 + 1, size // 32 + 1))
+    tile = np.kron(blocks, np.ones((32, 32), dtype=np.int64))[:size, :size]
+    # Spread the classes over the dtype's range so uint16 maps use large values
+    spacing = max(1, (np.iinfo(dtype).max // n_classes))
+    return (tile * spacing).astype(dtype), spacing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', dest='size', type=int, default=1024, help="side length of the label tiles")
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=20, help="timed repeats per case")
+    parser.add_argument('-k', '--classes', dest='classes', default="10,25,50", help="comma separated class counts")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = []
+    for dtype in [np.uint8, np.uint16]:
+        for n_classes in [int(k) for k in args.classes.split(",")]:
+            tile, spacing = make_label_tile(args.size, n_classes, dtype, rng)
+            value_map = {k * spacing: (k + 1) % n_classes for k in range(n_classes)}
+
+            assert (map_values(tile, value_map) == map_values_reference(tile, value_map)).all()
+            mapped, composition = map_values_with_proportions(tile, value_map)
+            assert composition == class_proportions_reference(map_values_reference(tile, value_map))
+
+            cases = {
+                "reference": lambda: class_proportions_reference(map_values_reference(tile, value_map)),
+                "lut + bincount": lambda: get_patch_class_proportions(map_values(tile, value_map)),
+                "fused": lambda: map_values_with_proportions(tile, value_map),
+            }
+            for name, case in cases.items():
+                seconds = min(timeit.repeat(case, number=1, repeat=args.repeats))
+                results.append({"dtype": np.dtype(dtype).name, "classes": n_classes, "method": name,
+                                "ms_per_tile": seconds * 1000})
+
+    df = pd.DataFrame(results)
+    reference = df[df.method == "reference"].set_index(["dtype", "classes"]).ms_per_tile
+    df["speedup"] = [reference[(row.dtype, row.classes)] / row.ms_per_tile for row in df.itertuples()]
+    print(df.to_string(index=False, float_format="%.2f"))
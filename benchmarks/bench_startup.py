@@ -0,0 +1,112 @@
+"""
+Startup-time budget of each patch_miner.py mode: how long the imports of a run take, checked against a budget.
+
+Each mode is run for real in a fresh interpreter with python -X importtime, on a small synthetic slide (see
+benchmarks.synthetic), and the cumulative time of every top-level import (including the ones done lazily while the run
+goes on) is added up. The exit status is 1 if any mode is over its budget, so the check can run in CI.
+
+Example:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --budget_scale 2  # slower machine
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import shutil
+import subprocess
+
+import pandas as pd
+from benchmarks.synthetic import make_synthetic_slide
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds of imports allowed per mode
+BUDGETS = {"help": 0.1,
+           "input_csv": 0.9,
+           "mine": 1.2,
+           "batch": 1.2}
+
+
+def parse_import_time(stderr):
+    """
+    Total import time of a python -X importtime run.
+    @return: (seconds spent importing, {top-level module: seconds})
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # Header line
+        name = fields[2][1:]
+        # Nested imports are indented, and already counted in their top-level import's cumulative time
+        if not name.startswith(" "):
+            modules[name] = modules.get(name, 0) + int(fields[1]) / 1e6
+    return sum(modules.values()), modules
+
+
+def run_mode(arguments, work_dir):
+    out_dir = tempfile.mkdtemp(prefix="opm_startup_", dir=work_dir)
+    try:
+        process = subprocess.run([sys.executable, "-X", "importtime", os.path.join(REPO_ROOT, "patch_miner.py")] +
+                                 arguments + (["-o", out_dir] if arguments[0] != "--help" else []),
+                                 cwd=REPO_ROOT, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError("patch_miner.py {} failed:\n{}".format(" ".join(arguments), process.stderr[-2000:]))
+        return parse_import_time(process.stderr)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config', default=os.path.join(REPO_ROOT, "opm", "config.yml"),
+                        help="config.yml for running OPM.")
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3,
+                        help="runs per mode, the fastest is kept")
+    parser.add_argument('--budget_scale', dest='budget_scale', type=float, default=1.0,
+                        help="multiply every budget, for slower or faster machines")
+    parser.add_argument('--top', dest='top', type=int, default=5,
+                        help="number of slowest top-level imports listed per mode")
+    parser.add_argument('-o', '--output_json', dest='output_json', default=None, help="also write the results here")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="opm_startup_")
+    try:
+        slide_path, lm_path = make_synthetic_slide(work_dir, 2048, 1536, tissue_fraction=0.5)
+        config_path = os.path.join(work_dir, "config.yml")
+        with open(args.config) as source, open(config_path, "w") as config_file:
+            config_file.write(source.read() + "\nnum_patches : 4\nnum_workers : 1\n")
+        coord_csv = os.path.join(work_dir, "coords.csv")
+        pd.DataFrame({"PatchCoordinatesX": [512, 1024], "PatchCoordinatesY": [512, 768]}).to_csv(coord_csv, index=False)
+        slide_list = os.path.join(work_dir, "slides.txt")
+        with open(slide_list, "w") as list_file:
+            list_file.write(slide_path + "\n")
+
+        modes = {"help": ["--help"],
+                 "input_csv": ["-i", slide_path, "-lm", lm_path, "-c", config_path, "-icsv", coord_csv],
+                 "mine": ["-i", slide_path, "-lm", lm_path, "-c", config_path],
+                 "batch": ["-b", slide_list, "-c", config_path]}
+        results = []
+        for mode, arguments in modes.items():
+            runs = [run_mode(arguments, work_dir) for _ in range(args.repeats)]
+            seconds, modules = min(runs, key=lambda run: run[0])
+            budget = BUDGETS[mode] * args.budget_scale
+            slowest = sorted(modules.items(), key=lambda item: -item[1])[:args.top]
+            results.append({"mode": mode,
+                            "import_seconds": seconds,
+                            "budget_seconds": budget,
+                            "within_budget": seconds <= budget,
+                            "slowest_imports": ", ".join("{} {:.3f}".format(name, t) for name, t in slowest)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    with pd.option_context("display.max_colwidth", 200):
+        print(pd.DataFrame(results).to_string(index=False, float_format="%.3f"))
+    sys.exit(0 if all(result["within_budget"] for result in results) else 1)
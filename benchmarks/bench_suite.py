@@ -0,0 +1,232 @@
+"""
+Benchmark suite: time every stage of patch mining on a synthetic pyramidal slide (see benchmarks.synthetic) and write
+the results to a JSON file, to be compared between runs with benchmarks.compare.
+
+Stages are timed separately on the same patches: tissue mask generation (generate_initial_mask), coordinate selection
+(find_next_patch), slide reads (read_region), the default patch checks, label map value mapping and class proportions,
+encoding, and end to end mine_patches / save_predefined_patches runs. Each stage is repeated and its fastest run kept.
+
+Example:
+    python -m benchmarks.bench_suite --width 20000 --height 15000 --compression jpeg -n 500 -o before.json
+    (apply changes)
+    python -m benchmarks.bench_suite --width 20000 --height 15000 --compression jpeg -n 500 -o after.json
+    python -m benchmarks.compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+import contextlib
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from opm.patch_manager import PatchManager
+from opm.utils import parse_config, generate_initial_mask, alpha_channel_check, patch_size_check, map_values, \
+    get_patch_class_proportions, get_patch_size_in_microns
+from opm.writers import PatchEncoder
+from benchmarks.synthetic import make_synthetic_slide
+
+# Used when the config has no value_map, the synthetic label maps hold classes 1 to 3
+DEFAULT_VALUE_MAP = {1: 40, 2: 80, 3: 120}
+# Config entries copied into the results, as they change what is being timed
+REPORTED_CONFIG = ["scale", "patch_size", "read_type", "overlap_factor", "num_workers", "executor", "patch_format",
+                   "compress_level", "jpeg_quality", "output_format", "tile_cache_mb", "pipeline", "fuse_label_map"]
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the progress output of the timed calls.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def time_stage(function, repeats):
+    """
+    @return: (fastest time over the repeats in seconds, result of the last call)
+    """
+    best, result = np.inf, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def stage_result(seconds, items):
+    return {"seconds": seconds,
+            "items": items,
+            "ms_per_item": seconds * 1000 / items if items else None,
+            "items_per_sec": items / seconds if seconds > 0 else None}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def new_manager(slide_path, lm_path, out_dir, mask, scale, cfg):
+    manager = PatchManager(slide_path, out_dir)
+    manager.set_valid_mask(mask, scale)
+    if lm_path is not None:
+        manager.set_label_map(lm_path)
+    manager.add_patch_criteria(alpha_channel_check)
+    manager.add_patch_criteria(partial(patch_size_check, patch_height=cfg['patch_size'][0],
+                                       patch_width=cfg['patch_size'][1]))
+    return manager
+
+
+def select_patches(manager, cfg, n_patches):
+    while len(manager.patches) < n_patches and manager.find_next_patch(patch_size=cfg['patch_size'],
+                                                                       read_type=cfg['read_type'],
+                                                                       overlap_factor=cfg['overlap_factor']):
+        pass
+    return list(manager.patches)
+
+
+def run_end_to_end(slide_path, lm_path, mask, scale, cfg, n_patches, coord_csv=None):
+    """
+    Mine (or, with coord_csv, save predefined) patches into a temporary folder.
+    @return: Number of rows in the output csv.
+    """
+    out_dir = tempfile.mkdtemp(prefix="opm_bench_")
+    try:
+        manager = new_manager(slide_path, lm_path, out_dir, mask, scale, cfg)
+        with quiet():
+            if coord_csv is None:
+                manager.mine_patches(dict(cfg, num_patches=n_patches, checkpoint_interval=0),
+                                     output_csv=os.path.join(out_dir, "list.csv"))
+                return len(pd.read_csv(os.path.join(out_dir, "list.csv")))
+            manager.save_predefined_patches(patch_coord_csv=coord_csv, config=cfg)
+            return len(pd.read_csv(coord_csv))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def run_suite(slide_path, lm_path, cfg, n_patches, repeats):
+    """
+    Time every stage on a slide.
+    @return: dict(stage name => stage_result())
+    """
+    stages = {}
+    with quiet():
+        seconds, (mask, scale) = time_stage(lambda: generate_initial_mask(slide_path, cfg['scale']), repeats)
+    stages["generate_initial_mask"] = stage_result(seconds, 1)
+
+    work_dir = tempfile.mkdtemp(prefix="opm_bench_")
+    try:
+        cfg = dict(cfg, patch_size=get_patch_size_in_microns(slide_path, cfg['patch_size']))
+
+        # Selection changes the manager's masks, so every repeat starts from a fresh one
+        selection_times = []
+        for _ in range(repeats):
+            manager = new_manager(slide_path, lm_path, work_dir, mask, scale, cfg)
+            with quiet():
+                start = time.perf_counter()
+                patches = select_patches(manager, cfg, n_patches)
+                selection_times.append(time.perf_counter() - start)
+        stages["find_next_patch"] = stage_result(min(selection_times), len(patches))
+        if not patches:
+            raise ValueError("No patch could be selected on {}, is there any tissue?".format(slide_path))
+
+        seconds, arrays = time_stage(lambda: [patch.read_patch() for patch in patches], repeats)
+        stages["read_region"] = stage_result(seconds, len(patches))
+
+        checks = manager.valid_patch_checks
+        seconds, _ = time_stage(lambda: [all(check(array) for check in checks) for array in arrays], repeats)
+        stages["checks"] = stage_result(seconds, len(arrays))
+
+        if lm_path is not None:
+            # Label maps are mapped on their first channel only
+            lm_arrays = [manager.pull_from_label_map(patch).read_patch()[:, :, 0] for patch in patches]
+            value_map = cfg['value_map'] if isinstance(cfg['value_map'], dict) else DEFAULT_VALUE_MAP
+            seconds, mapped = time_stage(lambda: [map_values(array, value_map) for array in lm_arrays], repeats)
+            stages["map_values"] = stage_result(seconds, len(lm_arrays))
+            seconds, _ = time_stage(lambda: [get_patch_class_proportions(array) for array in mapped], repeats)
+            stages["get_patch_class_proportions"] = stage_result(seconds, len(mapped))
+
+        encoder = PatchEncoder.from_config(cfg)
+        seconds, encoded = time_stage(lambda: [encoder.encode(array) for array in arrays], repeats)
+        stages["encode"] = stage_result(seconds, len(arrays))
+        stages["encode"]["bytes_per_item"] = sum(len(data) for data in encoded) / len(encoded)
+
+        seconds, n_rows = time_stage(lambda: run_end_to_end(slide_path, lm_path, mask, scale, cfg, n_patches),
+                                     repeats)
+        stages["mine_patches"] = stage_result(seconds, n_rows)
+
+        coord_csv = os.path.join(work_dir, "coords.csv")
+        pd.DataFrame({"PatchCoordinatesX": [patch.coordinates[1] for patch in patches],
+                      "PatchCoordinatesY": [patch.coordinates[0] for patch in patches]}).to_csv(coord_csv, index=False)
+        seconds, n_rows = time_stage(lambda: run_end_to_end(slide_path, lm_path, mask, scale, cfg, n_patches,
+                                                            coord_csv), repeats)
+        stages["save_predefined_patches"] = stage_result(seconds, n_rows)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config', default="opm/config.yml", help="config.yml for running OPM.")
+    parser.add_argument('-o', '--output_json', dest='output_json', default="benchmark.json",
+                        help="JSON file the results are written to")
+    parser.add_argument('-i', '--input_path', dest='input_path', default=None,
+                        help="benchmark this slide instead of a synthetic one")
+    parser.add_argument('-lm', '--label_map_path', dest='label_map_path', default=None,
+                        help="label map of --input_path")
+    parser.add_argument('-d', '--slide_dir', dest='slide_dir',
+                        default=os.path.join(tempfile.gettempdir(), "opm_synthetic"),
+                        help="folder where synthetic slides are generated, and reused by later runs")
+    parser.add_argument('--width', dest='width', type=int, default=20000, help="width of the synthetic slide")
+    parser.add_argument('--height', dest='height', type=int, default=15000, help="height of the synthetic slide")
+    parser.add_argument('--tile_size', dest='tile_size', type=int, default=256, help="tile size of the synthetic slide")
+    parser.add_argument('--compression', dest='compression', default=None,
+                        help="tile compression of the synthetic slide, e.g. zlib or jpeg; uncompressed by default")
+    parser.add_argument('--tissue_fraction', dest='tissue_fraction', type=float, default=0.5,
+                        help="approximate fraction of the synthetic slide covered by tissue")
+    parser.add_argument('--no_label_map', dest='label_map', action='store_false',
+                        help="benchmark without a label map")
+    parser.add_argument('-n', '--num_patches', dest='num_patches', type=int, default=200,
+                        help="number of patches per stage")
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3, help="timed repeats per stage")
+    args = parser.parse_args()
+
+    cfg = parse_config(args.config)
+    parameters = {"num_patches": args.num_patches, "repeats": args.repeats}
+    if args.input_path is None:
+        start = time.perf_counter()
+        slide_path, lm_path = make_synthetic_slide(args.slide_dir, args.width, args.height, args.tile_size,
+                                                   args.compression, args.tissue_fraction, label_map=args.label_map)
+        print("Synthetic slide ready in {:.1f}s: {}".format(time.perf_counter() - start, slide_path))
+        parameters.update(width=args.width, height=args.height, tile_size=args.tile_size,
+                          compression=args.compression, tissue_fraction=args.tissue_fraction,
+                          label_map=args.label_map)
+    else:
+        slide_path, lm_path = os.path.abspath(args.input_path), args.label_map_path
+        parameters.update(slide=slide_path, label_map=lm_path)
+
+    stages = run_suite(slide_path, lm_path, cfg, args.num_patches, args.repeats)
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "git_commit": get_git_commit(),
+               "python": sys.version.split()[0],
+               "platform": platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "parameters": parameters,
+               "config": {key: cfg[key] for key in REPORTED_CONFIG},
+               "stages": stages}
+    with open(args.output_json, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(pd.DataFrame.from_dict(stages, orient="index").to_string(float_format="%.3f"))
+    print("Results written to {}".format(args.output_json))
@@ -0,0 +1,62 @@
+"""
+Compare two benchmark suite results (see benchmarks.bench_suite), stage by stage.
+
+Stages are compared on their time per item. A stage is reported as slower or faster when its time changed by more
+than --threshold; the exit status is 1 if any stage got slower, so the comparison can gate a CI job.
+
+Example:
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+
+import sys
+import json
+import argparse
+
+import pandas as pd
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(baseline, candidate, threshold=0.1):
+    """
+    @param baseline: Results of the reference run.
+    @param candidate: Results of the run being evaluated.
+    @param threshold: Relative change in time per item above which a stage is reported as slower or faster.
+    @return: pandas DataFrame with one row per stage present in both runs.
+    """
+    rows = []
+    for stage, base in baseline["stages"].items():
+        new = candidate["stages"].get(stage)
+        if new is None or not base["ms_per_item"] or not new["ms_per_item"]:
+            continue
+        change = new["ms_per_item"] / base["ms_per_item"] - 1
+        rows.append({"stage": stage,
+                     "baseline_ms": base["ms_per_item"],
+                     "candidate_ms": new["ms_per_item"],
+                     "change": "{:+.1%}".format(change),
+                     "speedup": base["ms_per_item"] / new["ms_per_item"],
+                     "verdict": "slower" if change > threshold else "faster" if change < -threshold else ""})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline', help="JSON results of the reference run")
+    parser.add_argument('candidate', help="JSON results of the run to evaluate")
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0.1,
+                        help="relative change in time per item reported as slower/faster")
+    args = parser.parse_args()
+
+    baseline, candidate = load_results(args.baseline), load_results(args.candidate)
+    for key in ["parameters", "config", "cpu_count"]:
+        if baseline.get(key) != candidate.get(key):
+            print("Warning: the runs differ in {}: {} vs {}".format(key, baseline.get(key), candidate.get(key)))
+    print("Baseline:  {} ({})".format(baseline.get("git_commit"), baseline.get("created")))
+    print("Candidate: {} ({})".format(candidate.get("git_commit"), candidate.get("created")))
+
+    table = compare(baseline, candidate, args.threshold)
+    print(table.to_string(index=False, float_format="%.3f"))
+    sys.exit(1 if (table["verdict"] == "slower").any() else 0)
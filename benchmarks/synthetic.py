@@ -0,0 +1,173 @@
+"""
+Generate synthetic tiled, pyramidal TIFF slides and matching label maps for benchmarks.
+
+Tissue is a smooth random field thresholded so that about tissue_fraction of the slide is covered, drawn in H&E-like
+colours with per-pixel noise on a white background. The label map has classes 1 to 3 inside the tissue and 0 outside.
+Every pyramid level is rendered directly at its own resolution, one tile at a time, so slides far larger than memory
+can be written. The same parameters and seed always give the same slide.
+
+Example:
+    python -m benchmarks.synthetic -o /tmp/opm_synthetic --width 40000 --height 30000 --compression jpeg
+"""
+
+import os
+import argparse
+
+import numpy as np
+import tifffile
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+BACKGROUND = 240
+TISSUE_COLOR = np.array([200, 80, 170])
+# Microns per pixel of level 0 (a 40x scan)
+LEVEL0_MPP = 0.25
+# Each pyramid level is this many times smaller than the previous one
+LEVEL_DOWNSAMPLE = 4
+# Compressions that lose information, label maps are written with zlib instead
+LOSSY_COMPRESSIONS = ("jpeg", "webp", "jpegxl", "jpeg2000")
+
+
+class SyntheticSlide:
+    def __init__(self, width, height, tissue_fraction=0.5, seed=0, field_size=32):
+        """
+        Procedural slide: pixels are computed on demand from low resolution random fields.
+        @param width: Width of level 0 in pixels.
+        @param height: Height of level 0 in pixels.
+        @param tissue_fraction: Approximate fraction of the slide covered by tissue (0->1).
+        @param seed: Random seed.
+        @param field_size: Number of cells of the random fields along the shorter side, more cells give smaller blobs.
+        """
+        self.width = width
+        self.height = height
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        shape = (max(2, round(field_size * height / min(width, height))),
+                 max(2, round(field_size * width / min(width, height))))
+        self.tissue_field = gaussian_filter(rng.standard_normal(shape), 1.5)
+        self.class_field = gaussian_filter(rng.standard_normal(shape), 1.0)
+        self.shade_field = gaussian_filter(rng.standard_normal(shape), 0.5)
+
+        # Thresholds are quantiles of the fields sampled over the whole slide
+        ys, xs = np.linspace(0, height, 256), np.linspace(0, width, 256)
+        tissue = self._sample(self.tissue_field, ys, xs)
+        if tissue_fraction >= 1:
+            self.tissue_threshold = -np.inf
+        else:
+            self.tissue_threshold = np.quantile(tissue, 1 - tissue_fraction) if tissue_fraction > 0 else np.inf
+        classes = self._sample(self.class_field, ys, xs)[tissue > self.tissue_threshold]
+        self.class_thresholds = np.quantile(classes, [1 / 3, 2 / 3]) if classes.size else np.zeros(2)
+
+    def _sample(self, field, ys, xs):
+        """
+        Bilinear interpolation of a field at level 0 pixel rows ys and columns xs.
+        @return: 2D ndarray of shape (len(ys), len(xs)).
+        """
+        rows = np.asarray(ys, dtype=np.float64) * (field.shape[0] - 1) / self.height
+        cols = np.asarray(xs, dtype=np.float64) * (field.shape[1] - 1) / self.width
+        rows, cols = np.meshgrid(rows, cols, indexing="ij")
+        return map_coordinates(field, [rows, cols], order=1, mode="nearest")
+
+    def level_shape(self, level):
+        downsample = LEVEL_DOWNSAMPLE ** level
+        return -(-self.height // downsample), -(-self.width // downsample)
+
+    def render(self, level, y, x, height, width, label_map=False):
+        """
+        Render a region of a level.
+        @param level: Pyramid level, level 0 is the full resolution.
+        @param y: Top row of the region, in pixels of the level.
+        @param x: Left column of the region, in pixels of the level.
+        @param label_map: Render the label map instead of the slide.
+        @return: uint8 ndarray of shape (height, width, 3).
+        """
+        downsample = LEVEL_DOWNSAMPLE ** level
+        # Level 0 coordinates of the pixel centres
+        ys = (y + np.arange(height) + 0.5) * downsample
+        xs = (x + np.arange(width) + 0.5) * downsample
+        tissue = self._sample(self.tissue_field, ys, xs) > self.tissue_threshold
+
+        if label_map:
+            classes = 1 + np.searchsorted(self.class_thresholds, self._sample(self.class_field, ys, xs))
+            labels = np.where(tissue, classes, 0).astype(np.uint8)
+            return np.repeat(labels[:, :, None], 3, axis=2)
+
+        rng = np.random.default_rng((self.seed, level, y, x))
+        shade = self._sample(self.shade_field, ys, xs)[:, :, None] * 25
+        noise = rng.integers(-20, 21, (height, width, 3))
+        tissue_pixels = np.clip(TISSUE_COLOR + shade + noise, 0, 255)
+        background = np.clip(BACKGROUND + noise // 4, 0, 255)
+        return np.where(tissue[:, :, None], tissue_pixels, background).astype(np.uint8)
+
+    def _tiles(self, level, tile_size, label_map):
+        height, width = self.level_shape(level)
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                yield self.render(level, y, x, tile_size, tile_size, label_map)
+
+    def write(self, path, tile_size=256, compression=None, levels=3, label_map=False):
+        """
+        Write the slide (or its label map) as a tiled, pyramidal BigTIFF, with the reduced levels as SubIFDs.
+        @param path: Output path.
+        @param tile_size: Side length of the tiles.
+        @param compression: tifffile compression of the tiles, e.g. None, 'zlib', 'jpeg'. Label maps fall back to zlib
+            for lossy compressions.
+        @param levels: Number of pyramid levels.
+        @param label_map: Write the label map instead of the slide.
+        """
+        if label_map and compression in LOSSY_COMPRESSIONS:
+            compression = "zlib"
+        resolution = 1e4 / LEVEL0_MPP
+        with tifffile.TiffWriter(path, bigtiff=True) as tiff:
+            for level in range(levels):
+                options = dict(subfiletype=1)
+                if level == 0:
+                    options = dict(subifds=levels - 1, resolution=(resolution, resolution),
+                                   resolutionunit="CENTIMETER")
+                tiff.write(self._tiles(level, tile_size, label_map),
+                           shape=self.level_shape(level) + (3,),
+                           dtype=np.uint8,
+                           tile=(tile_size, tile_size),
+                           photometric="rgb",
+                           compression=compression,
+                           **options)
+
+
+def make_synthetic_slide(directory, width, height, tile_size=256, compression=None, tissue_fraction=0.5, levels=3,
+                         seed=0, label_map=True):
+    """
+    Write a synthetic slide and its label map to directory, named after their parameters. Files that already exist
+    are reused.
+    @return: (slide path, label map path or None)
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = "synthetic_{}x{}_t{}_{}_f{:g}_l{}_s{}".format(width, height, tile_size, compression or "raw",
+                                                         tissue_fraction, levels, seed)
+    slide_path = os.path.join(directory, name + ".tiff")
+    lm_path = os.path.join(directory, name + "_lm.tiff") if label_map else None
+
+    slide = SyntheticSlide(width, height, tissue_fraction, seed)
+    for path, is_label_map in [(slide_path, False), (lm_path, True)]:
+        if path is not None and not os.path.isfile(path):
+            # Written under a temporary name, so an interrupted run never leaves a truncated slide behind
+            slide.write(path + ".tmp", tile_size, compression, levels, label_map=is_label_map)
+            os.replace(path + ".tmp", path)
+    return slide_path, lm_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output_path', dest='output_path', required=True, help="folder to write the slides to")
+    parser.add_argument('--width', dest='width', type=int, default=20000, help="width of level 0 in pixels")
+    parser.add_argument('--height', dest='height', type=int, default=15000, help="height of level 0 in pixels")
+    parser.add_argument('--tile_size', dest='tile_size', type=int, default=256, help="side length of the tiles")
+    parser.add_argument('--compression', dest='compression', default=None,
+                        help="tile compression, e.g. zlib or jpeg; uncompressed by default")
+    parser.add_argument('--tissue_fraction', dest='tissue_fraction', type=float, default=0.5,
+                        help="approximate fraction of the slide covered by tissue")
+    parser.add_argument('--levels', dest='levels', type=int, default=3, help="number of pyramid levels")
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    paths = make_synthetic_slide(args.output_path, args.width, args.height, args.tile_size, args.compression,
+                                 args.tissue_fraction, args.levels, args.seed)
+    print("\n".join(path for path in paths if path is not None))
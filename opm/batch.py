@@ -0,0 +1,116 @@
+import os
+import concurrent.futures
+from functools import partial
+
+from .patch_manager import PatchManager
+from .mask_cache import get_mask_cache
+from .utils import alpha_channel_check, patch_size_check, generate_initial_mask, get_patch_size_in_microns, \
+    get_target_downsample
+
+
+def read_slide_list(list_path):
+    """
+    Read the list of slides for a batch run.
+    @param list_path: Either a .csv with a "SlidePath" column and optional "LabelMapPath" and "SubjectID" columns, or a
+        text file with one slide path per line.
+    @return: list of dicts with keys "slide_path", "label_map_path" and "subject_id" (None when not given).
+    """
+    slides = []
+    if list_path.lower().endswith(".csv"):
+        import pandas as pd
+        input_df = pd.read_csv(list_path)
+        if "SlidePath" not in input_df.columns:
+            raise ValueError("Slide list {} needs a 'SlidePath' column.".format(list_path))
+        for _, row in input_df.iterrows():
+            label_map_path = row.get("LabelMapPath")
+            subject_id = row.get("SubjectID")
+            slides.append({"slide_path": os.path.abspath(row["SlidePath"]),
+                           "label_map_path": None if pd.isna(label_map_path) else os.path.abspath(label_map_path),
+                           "subject_id": None if pd.isna(subject_id) else subject_id})
+    else:
+        with open(list_path) as list_file:
+            for line in list_file:
+                if line.strip():
+                    slides.append({"slide_path": os.path.abspath(line.strip()),
+                                   "label_map_path": None,
+                                   "subject_id": None})
+    return slides
+
+
+def prepare_slide(slide, output_dir, config, resume=False):
+    """
+    Open a slide and get its PatchManager ready for mining: tissue mask, label map, subject ID and patch checks.
+    @param slide: dict from read_slide_list().
+    @param output_dir: Output directory for the patches.
+    @param config: Config dict, see parse_config().
+    @param resume: Skip the tissue mask when the slide has a checkpoint to resume from.
+    @return: (PatchManager, config for this slide). The slide config has patch_size converted to pixels, which can
+        differ between slides when it is given in microns.
+    """
+    manager = PatchManager(slide["slide_path"], output_dir)
+    if not (resume and os.path.isfile(manager.get_checkpoint_path())):
+        mask, scale = generate_initial_mask(slide["slide_path"], config['scale'], get_mask_cache(config))
+        manager.set_valid_mask(mask, scale)
+    if slide["label_map_path"] is not None:
+        manager.set_label_map(slide["label_map_path"])
+    if slide["subject_id"] is not None:
+        manager.set_subjectID(slide["subject_id"])
+
+    slide_config = dict(config)
+    downsample = get_target_downsample(manager.slide_object, config)
+    slide_config['patch_size'] = get_patch_size_in_microns(slide["slide_path"], config['patch_size'],
+                                                           downsample=downsample)
+
+    # Reject patch if any pixels are transparent
+    manager.add_patch_criteria(alpha_channel_check)
+    # Reject patch if image dimensions are not equal to PATCH_SIZE
+    patch_dims_check = partial(patch_size_check,
+                               patch_height=slide_config['patch_size'][0],
+                               patch_width=slide_config['patch_size'][1])
+    manager.add_patch_criteria(patch_dims_check)
+    return manager, slide_config
+
+
+def mine_batch(slides, config, output_dir, output_csv=None, resume=False):
+    """
+    Mine patches from several slides in one process.
+
+    All slides share one long-lived worker pool (config['executor'] with config['num_workers'] workers), and all rows
+    go to a single manifest. While a slide is being mined, the next one is opened and its tissue mask generated on a
+    background thread, so mask generation overlaps with patch extraction.
+    @param slides: list of dicts from read_slide_list().
+    @param config: Config dict, see parse_config().
+    @param output_dir: Output directory for the patches.
+    @param output_csv: Path of the consolidated manifest. Defaults to <output_dir>/list.csv.
+    @param resume: Continue an interrupted batch: finished slides are skipped and the others resume from their
+        checkpoints.
+    """
+    if output_csv is None:
+        output_csv = os.path.join(output_dir, "list.csv")
+
+    if config['executor'] == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(config['num_workers'])
+    elif config['executor'] == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(config['num_workers'])
+    else:
+        raise ValueError("Unrecognized executor '{}', use either 'thread' or 'process'.".format(config['executor']))
+
+    with pool, concurrent.futures.ThreadPoolExecutor(1) as prepare_pool:
+        pending = prepare_pool.submit(prepare_slide, slides[0], output_dir, config, resume) if slides else None
+        for index, slide in enumerate(slides):
+            try:
+                manager, slide_config = pending.result()
+            except Exception as e:
+                print("Could not prepare slide {}: {}".format(slide["slide_path"], e))
+                manager = None
+
+            # Start on the next slide's mask while this one is mined
+            if index + 1 < len(slides):
+                pending = prepare_pool.submit(prepare_slide, slides[index + 1], output_dir, config, resume)
+
+            if manager is None:
+                continue
+
+            print("Mining slide {}/{}: {}".format(index + 1, len(slides), slide["slide_path"]))
+            manager.set_executor(pool)
+            manager.mine_patches(slide_config, output_csv=output_csv, resume=resume)
@@ -0,0 +1,105 @@
+import numpy as np
+
+from .packed_mask import PackedMask
+
+
+class CandidateIndex:
+    def __init__(self, mask):
+        """
+        Index of the remaining valid coordinates on a validity mask. Built once, then kept up to date as regions are
+        invalidated, so drawing a coordinate no longer requires a full pass over the mask.
+
+        The mask itself stays the source of truth. The index only tracks how many valid pixels are left in each row,
+        stored in a Fenwick (binary indexed) tree so the row holding the k-th remaining candidate can be found in
+        O(log rows). The column is then found by unpacking and scanning that single row.
+        @param mask: PackedMask. It is shared, not copied, and is modified by invalidate()/invalidate_point(). A 2D
+            boolean ndarray is packed into a new PackedMask instead.
+        """
+        self.mask = mask if isinstance(mask, PackedMask) else PackedMask(mask)
+        self.n_rows = self.mask.shape[0]
+        self.row_counts = self.mask.row_counts()
+        self.remaining = int(self.row_counts.sum())
+        self._cursor = 0
+
+        # Fenwick tree over row counts (1-indexed, index 0 unused)
+        self._tree = [0] + self.row_counts.tolist()
+        for i in range(1, self.n_rows + 1):
+            parent = i + (i & -i)
+            if parent <= self.n_rows:
+                self._tree[parent] += self._tree[i]
+
+        self._top_bit = 1
+        while self._top_bit * 2 <= self.n_rows:
+            self._top_bit *= 2
+
+    def _update_row(self, row, delta):
+        """
+        Add delta to the count of valid pixels in a row.
+        @param row: 0-indexed row of the mask.
+        @param delta: Change in the number of valid pixels in that row.
+        """
+        self.row_counts[row] += delta
+        self.remaining += delta
+        i = row + 1
+        while i <= self.n_rows:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _find_row(self, k):
+        """
+        Find the row containing the k-th (0-indexed, row-major order) remaining candidate.
+        @return: (row, offset) where offset is the position of the candidate among the valid pixels of that row.
+        """
+        position = 0
+        bit = self._top_bit
+        while bit:
+            nxt = position + bit
+            if nxt <= self.n_rows and self._tree[nxt] <= k:
+                position = nxt
+                k -= self._tree[nxt]
+            bit >>= 1
+        return position, k
+
+    def draw_random(self):
+        """
+        Draw a remaining candidate uniformly at random. Uses numpy's global RNG, like the rest of the miner.
+        @return: (row, col) on the mask, or None if there are no candidates left.
+        """
+        if self.remaining <= 0:
+            return None
+        row, offset = self._find_row(np.random.randint(self.remaining))
+        col = np.flatnonzero(self.mask.get_row(row))[offset]
+        return row, int(col)
+
+    def draw_sequential(self):
+        """
+        Draw the top-leftmost remaining candidate (the first entry np.argwhere would return).
+        @return: (row, col) on the mask, or None if there are no candidates left.
+        """
+        # Pixels are only ever invalidated, so rows before the cursor never need to be looked at again.
+        while self._cursor < self.n_rows and self.row_counts[self._cursor] == 0:
+            self._cursor += 1
+        if self._cursor == self.n_rows:
+            return None
+        return self._cursor, int(np.argmax(self.mask.get_row(self._cursor)))
+
+    def invalidate(self, row_start, row_end, col_start, col_end):
+        """
+        Set a rectangle of the mask to False and remove its pixels from the index.
+        Bounds are clipped to the mask, like regular slicing.
+        """
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        cleared = self.mask.set_region(row_start, row_end, col_start, col_end, False)
+        for offset in np.flatnonzero(cleared):
+            self._update_row(row_start + int(offset), -int(cleared[offset]))
+
+    def invalidate_point(self, row, col):
+        """
+        Set a single pixel of the mask to False and remove it from the index.
+        """
+        # Keep numpy's negative indexing semantics, but track the row by its positive index
+        row = row % self.n_rows
+        if self.mask.get(row, col):
+            col %= self.mask.shape[1]
+            self.mask.set_region(row, row + 1, col, col + 1, False)
+            self._update_row(row, -1)
@@ -0,0 +1,92 @@
+import os
+import json
+
+import numpy as np
+
+from .packed_mask import PackedMask
+
+
+# Patches saved between checkpoints when a run is resumable (--resume) and the config sets no checkpoint_interval
+DEFAULT_CHECKPOINT_INTERVAL = 1000
+
+
+def save_checkpoint(path, tissue_mask, valid_mask, mined_mask, scale, n_completed, manifest_rows,
+                    grid_coordinates=None, finished=False, writer_position=None):
+    """
+    Write the mining state of a slide, so an interrupted run can pick up where it stopped (see load_checkpoint).
+
+    Masks are stored bit-packed by row, as PackedMask keeps them. The file is written next to its destination and then
+    renamed over it, so a crash while checkpointing leaves the previous checkpoint intact.
+    @param path: Path of the checkpoint (.npz).
+    @param tissue_mask: The untouched tissue mask the valid mask was created from (PackedMask or bool ndarray).
+    @param valid_mask: Current valid mask (locations that can still be drawn).
+    @param mined_mask: Current mined mask.
+    @param scale: Scale of the masks relative to the slide.
+    @param n_completed: Number of patches saved so far.
+    @param manifest_rows: Number of rows in the output csv at the time of the checkpoint.
+    @param grid_coordinates: Grid tiles that have not been mined yet (grid read type only).
+    @param finished: True once mining of the slide is complete.
+    @param writer_position: JSON-serialisable position of the archive writer (see ShardWriter.position), so output
+        written after the checkpoint can be rolled back on resume.
+    """
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+    state = {"mask_shape": np.array(tissue_mask.shape),
+             "mask_packing": np.array("rows"),
+             "tissue_mask": _packed_rows(tissue_mask),
+             "valid_mask": _packed_rows(valid_mask),
+             "mined_mask": _packed_rows(mined_mask),
+             "scale": np.array(scale),
+             "n_completed": np.array(n_completed),
+             "manifest_rows": np.array(manifest_rows),
+             "finished": np.array(finished),
+             "rng_name": np.array(rng_name),
+             "rng_keys": rng_keys,
+             "rng_pos": np.array(rng_pos),
+             "rng_has_gauss": np.array(rng_has_gauss),
+             "rng_cached_gaussian": np.array(rng_cached_gaussian)}
+    if grid_coordinates is not None:
+        state["grid_coordinates"] = grid_coordinates
+    if writer_position is not None:
+        state["writer_position"] = np.array(json.dumps(writer_position))
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as checkpoint_file:
+        np.savez(checkpoint_file, **state)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint written by save_checkpoint and restore numpy's global RNG to the state it was saved in.
+    @param path: Path of the checkpoint (.npz).
+    @return: dict with the tissue_mask, valid_mask, mined_mask (PackedMask), scale, n_completed, manifest_rows,
+        grid_coordinates (None unless grid mining), writer_position (None without an archive writer) and finished
+        entries.
+    """
+    with np.load(path) as state:
+        shape = tuple(state["mask_shape"])
+        size = int(np.prod(shape))
+
+        def unpack(name):
+            if "mask_packing" in state:
+                return PackedMask.from_bits(state[name], shape)
+            # Checkpoints written before masks were kept packed by row
+            return PackedMask(np.unpackbits(state[name], count=size).reshape(shape))
+
+        np.random.set_state((str(state["rng_name"]), state["rng_keys"], int(state["rng_pos"]),
+                             int(state["rng_has_gauss"]), float(state["rng_cached_gaussian"])))
+        return {"tissue_mask": unpack("tissue_mask"),
+                "valid_mask": unpack("valid_mask"),
+                "mined_mask": unpack("mined_mask"),
+                "scale": tuple(state["scale"].tolist()),
+                "n_completed": int(state["n_completed"]),
+                "manifest_rows": int(state["manifest_rows"]),
+                "grid_coordinates": state["grid_coordinates"] if "grid_coordinates" in state else None,
+                "writer_position": json.loads(str(state["writer_position"])) if "writer_position" in state else None,
+                "finished": bool(state["finished"])}
+
+
+def _packed_rows(mask):
+    if isinstance(mask, PackedMask):
+        return mask.bits
+    return np.packbits(mask, axis=1)
@@ -0,0 +1,111 @@
+import os
+import glob
+import hashlib
+import json
+
+import numpy as np
+
+# Bytes of the slide file hashed into its fingerprint, enough to cover the header of most formats
+FINGERPRINT_HEADER_BYTES = 1024 ** 2
+
+
+def slide_fingerprint(slide_path):
+    """
+    Identify a slide file by its size, modification time and a hash of its header, without reading the whole file.
+    @param slide_path: Path to the slide.
+    @return: Hex digest string.
+    """
+    stat = os.stat(slide_path)
+    digest = hashlib.sha1()
+    digest.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(slide_path, "rb") as slide_file:
+        digest.update(slide_file.read(FINGERPRINT_HEADER_BYTES))
+    return digest.hexdigest()
+
+
+class MaskCache:
+    def __init__(self, cache_dir, max_size_mb=1024):
+        """
+        On-disk cache of tissue masks, so re-mining a slide skips thumbnail decoding and masking.
+
+        Masks are stored bit-packed, one .npz file per entry, named after a hash of the slide fingerprint, the mask
+        scale and the masking parameters. Entries are touched when read; once the cache grows past max_size_mb, the
+        least recently used entries are deleted. Entries are written to a temp file and renamed into place, so several
+        processes can share a cache directory.
+        @param cache_dir: Folder of the cache, created if needed.
+        @param max_size_mb: Maximum total size of the cache.
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size_mb * 1024 ** 2
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, slide_path, scale, parameters):
+        """
+        @param slide_path: Path to the slide.
+        @param scale: Scale the mask is generated at.
+        @param parameters: dict of masking parameters; any change to them gives a different key.
+        @return: Cache key (hex digest string).
+        """
+        description = json.dumps({"slide": slide_fingerprint(slide_path), "scale": scale, "parameters": parameters},
+                                 sort_keys=True, default=str)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """
+        @return: (mask, scale) for the key, or None if it is not cached.
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry["shape"])
+                mask = np.unpackbits(entry["mask"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+                scale = tuple(entry["scale"].tolist())
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            # Missing, evicted meanwhile, or partially written by a crashed process
+            return None
+        return mask, scale
+
+    def put(self, key, mask, scale):
+        """
+        Store a mask, then evict least recently used entries until the cache fits in its size limit.
+        """
+        path = self._entry_path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as entry_file:
+            np.savez(entry_file, mask=np.packbits(mask, axis=None), shape=np.array(mask.shape), scale=np.array(scale))
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), "*.npz")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def get_mask_cache(config):
+    """
+    @param config: Config dict, see parse_config().
+    @return: MaskCache set up from config['mask_cache_dir'] and config['mask_cache_size_mb'], or None if caching is
+        disabled.
+    """
+    if not config['mask_cache_dir']:
+        return None
+    return MaskCache(config['mask_cache_dir'], config['mask_cache_size_mb'])
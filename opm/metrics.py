@@ -0,0 +1,171 @@
+import json
+import time
+import threading
+import importlib
+from contextlib import contextmanager
+
+from .utils import get_peak_rss_mb
+
+
+class MetricsCollector:
+    enabled = True
+
+    def __init__(self, hooks=()):
+        """
+        Thread-safe collector of wall time and item counts per mining stage (e.g. "select", "read", "check:<name>",
+        "value_map", "encode", "write").
+
+        report() summarises everything collected since the last reset() into a JSON-serialisable dict, which emit()
+        hands to every hook, e.g. to forward it to a monitoring system.
+        @param hooks: Callables taking a report dict.
+        """
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.worker_peak_rss_mb = None
+            self.start_time = time.time()
+            self._start = time.perf_counter()
+
+    def add_hook(self, hook):
+        """
+        @param hook: Callable taking a report dict, called by emit().
+        """
+        self.hooks.append(hook)
+
+    @contextmanager
+    def timer(self, name, count=1):
+        """
+        Context manager adding the wall time of its block to a stage.
+        @param name: Stage name.
+        @param count: Number of items processed in the block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, count)
+
+    def add_time(self, name, seconds, count=1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    def snapshot(self):
+        """
+        @return: Picklable copy of the raw timers and this process' peak RSS, see merge().
+        """
+        with self._lock:
+            return {"timers": {name: list(timer) for name, timer in self.timers.items()},
+                    "peak_rss_mb": get_peak_rss_mb()}
+
+    def merge(self, snapshot):
+        """
+        Add the timers of another collector, e.g. one from a worker process, and keep the largest worker peak RSS.
+        @param snapshot: dict returned by snapshot(), or None.
+        """
+        if snapshot is None:
+            return
+        for name, (count, seconds) in snapshot["timers"].items():
+            self.add_time(name, seconds, count)
+        if snapshot["peak_rss_mb"] is not None:
+            with self._lock:
+                self.worker_peak_rss_mb = max(self.worker_peak_rss_mb or 0, snapshot["peak_rss_mb"])
+
+    def report(self, **info):
+        """
+        Summary of the metrics collected so far.
+
+        Stage times are summed over threads and worker processes, so with several workers a stage's seconds can
+        exceed wall_seconds.
+        @param info: Extra top-level entries, e.g. slide=<path>.
+        @return: dict with info, wall_seconds, peak_rss_mb (of this process), worker_peak_rss_mb (largest peak of
+            the worker processes, None without them) and "stages" (count, seconds, mean_ms and per_sec of each stage).
+        """
+        snapshot = self.snapshot()
+        stages = {}
+        for name, (count, seconds) in sorted(snapshot["timers"].items()):
+            stages[name] = {"count": count,
+                            "seconds": seconds,
+                            "mean_ms": seconds * 1000 / count if count else None,
+                            "per_sec": count / seconds if seconds > 0 else None}
+        report = dict(info)
+        report.update({"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+                       "wall_seconds": time.perf_counter() - self._start,
+                       "peak_rss_mb": get_peak_rss_mb(),
+                       "worker_peak_rss_mb": self.worker_peak_rss_mb,
+                       "stages": stages})
+        return report
+
+    def emit(self, report):
+        """
+        Pass a report to every hook. A failing hook is reported and skipped, it never interrupts mining.
+        """
+        for hook in self.hooks:
+            try:
+                hook(report)
+            except Exception as e:
+                print("Exception in metrics hook {}: {}".format(hook, e))
+
+
+class NullMetrics:
+    """
+    Collector that records nothing, used when metrics are disabled so instrumented code needs no checks.
+    """
+    enabled = False
+    hooks = ()
+
+    def reset(self):
+        pass
+
+    def add_hook(self, hook):
+        raise ValueError("Metrics are disabled, use a MetricsCollector to add hooks.")
+
+    @contextmanager
+    def timer(self, name, count=1):
+        yield
+
+    def add_time(self, name, seconds, count=1):
+        pass
+
+    def snapshot(self):
+        return None
+
+    def merge(self, snapshot):
+        pass
+
+    def report(self, **info):
+        return None
+
+    def emit(self, report):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def check_name(check):
+    """
+    Name of a patch check function in stage names ("check:<name>"), looking through functools.partial.
+    """
+    function = getattr(check, "func", check)
+    return getattr(function, "__name__", repr(function))
+
+
+def write_report(report, path):
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2, default=str)
+
+
+def load_hook(spec):
+    """
+    Import a metrics hook from a "package.module:function" string (see the metrics_hooks config option).
+    """
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError("Metrics hook '{}' should be given as 'module:function'.".format(spec))
+    return getattr(importlib.import_module(module_name), attribute)
@@ -0,0 +1,150 @@
+import numpy as np
+
+# Number of set bits of every byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+# Bytes with their first n bits (pixels) set, np.packbits puts the first pixel in the most significant bit
+_LEADING_BITS = np.array([(0xFF << (8 - n)) & 0xFF for n in range(9)], dtype=np.uint8)
+# Bytes processed at once when counting, to bound temporary arrays
+_CHUNK_BYTES = 2 ** 22
+
+
+class PackedMask:
+    def __init__(self, mask):
+        """
+        2D boolean mask stored with 8 pixels per byte, each row packed separately (np.packbits(mask, axis=1)).
+
+        Masks at fine scales on large slides then take an eighth of the memory of a bool array. Rows are unpacked on
+        demand, rectangles are set or cleared by rewriting only the bytes they cover, and counts over rectangles are
+        computed on the packed bytes.
+        @param mask: 2D array, non-zero pixels are set.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        self.bits = np.packbits(mask, axis=1)
+
+    @classmethod
+    def from_bits(cls, bits, shape):
+        """
+        Wrap row-packed bits (see self.bits) without copying them.
+        @param bits: uint8 ndarray of shape (rows, ceil(cols / 8)).
+        @param shape: (rows, cols) of the mask.
+        """
+        packed = cls.__new__(cls)
+        packed.shape = tuple(int(side) for side in shape)
+        packed.bits = bits
+        return packed
+
+    @classmethod
+    def zeros(cls, shape):
+        return cls.from_bits(np.zeros((shape[0], (shape[1] + 7) // 8), dtype=np.uint8), shape)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def copy(self):
+        return PackedMask.from_bits(self.bits.copy(), self.shape)
+
+    def to_array(self):
+        """
+        @return: The mask as a 2D bool ndarray.
+        """
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1]).astype(bool)
+
+    def get_row(self, row):
+        """
+        @return: Row of the mask as a 1D bool ndarray.
+        """
+        return np.unpackbits(self.bits[row], count=self.shape[1]).astype(bool)
+
+    def get(self, row, col):
+        """
+        Value of a single pixel. Negative indices count from the end, like numpy indexing.
+        """
+        if not -self.shape[1] <= col < self.shape[1]:
+            raise IndexError("index {} is out of bounds for axis 1 with size {}".format(col, self.shape[1]))
+        col %= self.shape[1]
+        return bool((self.bits[row, col >> 3] >> (7 - (col & 7))) & 1)
+
+    def row_counts(self):
+        """
+        @return: int64 ndarray with the number of set pixels in every row.
+        """
+        counts = np.zeros(self.shape[0], dtype=np.int64)
+        rows_per_chunk = max(1, _CHUNK_BYTES // max(self.bits.shape[1], 1))
+        for start in range(0, self.shape[0], rows_per_chunk):
+            counts[start:start + rows_per_chunk] = \
+                _POPCOUNT[self.bits[start:start + rows_per_chunk]].sum(axis=1, dtype=np.int64)
+        return counts
+
+    def set_region(self, row_start, row_end, col_start, col_end, value):
+        """
+        Set a rectangle of the mask to value. Bounds follow slicing rules (mask[row_start:row_end, col_start:col_end]).
+        @return: int64 ndarray with the number of pixels that changed in each row of the rectangle.
+        """
+        row_start, row_end, _ = slice(row_start, row_end).indices(self.shape[0])
+        col_start, col_end, _ = slice(col_start, col_end).indices(self.shape[1])
+        if row_end <= row_start or col_end <= col_start:
+            return np.zeros(0, dtype=np.int64)
+
+        # Unpack only the bytes covering the rectangle's columns
+        byte_start, byte_end = col_start // 8, (col_end + 7) // 8
+        block = np.unpackbits(self.bits[row_start:row_end, byte_start:byte_end], axis=1)
+        region = block[:, col_start - byte_start * 8:col_end - byte_start * 8]
+        changed = np.count_nonzero(region != bool(value), axis=1).astype(np.int64)
+        region[...] = bool(value)
+        self.bits[row_start:row_end, byte_start:byte_end] = np.packbits(block, axis=1)
+        return changed
+
+    def region_counts(self, row_start, row_end, col_start, col_end):
+        """
+        Number of set pixels inside one or more rectangles. Bounds may be scalars or arrays (vectorized over rectangles)
+        and are clipped to the mask.
+
+        Counts come from a summed-area table sampled only at the columns used as bounds, over the rows the rectangles
+        span, so neither a dense copy nor a full table of the mask is needed.
+        @return: int64 ndarray of counts, one per rectangle.
+        """
+        rows, cols = self.shape
+        row_start, row_end, col_start, col_end = (np.atleast_1d(bound).astype(np.int64) for bound in
+                                                  np.broadcast_arrays(row_start, row_end, col_start, col_end))
+        row_start, row_end = np.clip(row_start, 0, rows), np.clip(row_end, 0, rows)
+        col_start, col_end = np.clip(col_start, 0, cols), np.clip(col_end, 0, cols)
+        if row_start.size == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        first_row = int(row_start.min())
+        bits = self.bits[first_row:int(max(row_start.max(), row_end.max()))]
+        bounds = np.unique(np.concatenate([col_start, col_end]))
+        # table[r, j] = number of set pixels in bits[:r, :bounds[j]]
+        table = np.zeros((bits.shape[0] + 1, len(bounds)), dtype=np.int64)
+        counts = np.zeros(bits.shape[0], dtype=np.int64)
+        counted_bytes = 0
+        bytes_per_chunk = max(1, _CHUNK_BYTES // max(bits.shape[0], 1))
+        for index, bound in enumerate(bounds):
+            # Bounds are sorted, so each byte is counted once
+            full_bytes = int(bound) // 8
+            for start in range(counted_bytes, full_bytes, bytes_per_chunk):
+                counts += _POPCOUNT[bits[:, start:min(start + bytes_per_chunk, full_bytes)]].sum(axis=1, dtype=np.int64)
+            counted_bytes = max(counted_bytes, full_bytes)
+            column = counts
+            if bound % 8:
+                column = counts + _POPCOUNT[bits[:, full_bytes] & _LEADING_BITS[bound % 8]]
+            np.cumsum(column, out=table[1:, index])
+
+        start_index, end_index = np.searchsorted(bounds, col_start), np.searchsorted(bounds, col_end)
+        top, bottom = row_start - first_row, row_end - first_row
+        return (table[bottom, end_index] - table[top, end_index]
+                - table[bottom, start_index] + table[top, start_index])
+
+    def region_fraction(self, row_start, row_end, col_start, col_end):
+        """
+        Fraction of set pixels inside one or more rectangles. Bounds may be scalars or arrays (vectorized over
+        rectangles) and are clipped to the mask.
+        @return: fraction(s) in [0, 1]. Empty rectangles have a fraction of 0.
+        """
+        rows, cols = self.shape
+        area = ((np.clip(row_end, 0, rows) - np.clip(row_start, 0, rows)) *
+                (np.clip(col_end, 0, cols) - np.clip(col_start, 0, cols)))
+        total = self.region_counts(row_start, row_end, col_start, col_end)
+        return np.where(area > 0, total / np.maximum(area, 1), 0.0)
@@ -1,23 +1,38 @@
 from pathlib import Path
 from .utils import pass_method, map_values
 import numpy as np
-from skimage.io import imsave
 import os
+from collections import namedtuple
 from pathlib import Path
-from zarr.core import Array
+from PIL import Image
+from .writers import PatchEncoder
+from .metrics import NULL_METRICS, check_name
+
+# Picklable description of a patch, without the slide handle or manager. Used to ship patches to worker processes.
+PatchRecord = namedtuple("PatchRecord", ["slide_path", "coordinates", "level", "size", "output_suffix", "output_size",
+                                         "resample", "scales", "encoder"], defaults=(None, Image.LANCZOS, (), None))
+
+# Output folders already created by get_patch_path, so each patch doesn't have to hit the filesystem with a mkdir
+_created_dirs = set()
 
 class Patch:
-    def __init__(self, slide_path: str, slide_object: Array, manager, coordinates, level: int,
-                 size: tuple, output_suffix: str = "_patch@{}:{}.png") -> None:
+    def __init__(self, slide_path: str, slide_object, manager, coordinates, level: int,
+                 size: tuple, output_suffix: str = "_patch@{}:{}.png", output_size: tuple = None,
+                 resample: int = Image.LANCZOS, scales: tuple = (), encoder: PatchEncoder = None) -> None:
         """
         Init for Patch.
         @param slide_path: Path to slide. Used primarily for generating patch filenames.
         @param slide_object: OpenSlide object. Read patch images from this object.
         @param manager: PatchManager object. Inheriting this allows this patch to be checked for validity.
-        @param coordinates: Ndarray of [x, y] coordinates on slide for the top-left corner of the patch.
+        @param coordinates: Ndarray of [x, y] coordinates on slide (level 0) for the top-left corner of the patch.
         @param level: Level of slide you want to call the patch from.
-        @param size: tuple of ints for the side lengths of the patch.
+        @param size: tuple of ints for the side lengths of the patch, in pixels of that level.
         @param output_suffix: The format to be appended onto the slide's name.
+        @param output_size: Side lengths the patch is resampled to after reading, if different from size.
+        @param resample: PIL resampling filter used to get to output_size. Use Image.NEAREST for label maps.
+        @param scales: Extra magnifications read around the same location, as a tuple of (factor, level, coordinates,
+            size) with the same meaning as the arguments above. Each one is also resampled to output_size.
+        @param encoder: PatchEncoder used by write(), its extension should match output_suffix. Defaults to PNG.
         """
         self.manager = manager
         self._slide_path = slide_path
@@ -27,13 +42,55 @@ class Patch:
         self.level = level
         self.size = size
         self.output_suffix = output_suffix
+        self.output_size = size if output_size is None else output_size
+        self.resample = resample
+        self.scales = scales
+        self.encoder = PatchEncoder() if encoder is None else encoder
+        # Number of region reads done by this patch, so callers can verify the slide is only decoded once per patch
+        self.read_count = 0
 
     def read_patch(self):
         """
         Read patch from self.slide_object given this patch's coordinates, level, and size.
         @return: PIL object of RGBA patch image.
         """
-        return np.asarray(self.slide_object.read_region((self.coordinates[1], self.coordinates[0]), self.level, self.size))
+        self.read_count += 1
+        region = self.slide_object.read_region((self.coordinates[1], self.coordinates[0]), self.level, self.size)
+        if tuple(self.output_size) != tuple(self.size):
+            region = region.resize(tuple(self.output_size), self.resample)
+        return np.asarray(region)
+
+    def read_scales(self):
+        """
+        Read the patch and every extra scale in self.scales. Reads that come from the same pyramid level share a single
+        read_region call covering all of them, so each level is decoded once per location.
+        @return: list of ndarrays: the patch, then one per entry of self.scales.
+        """
+        reads = [(self.level, self.coordinates, self.size)] + [(level, coordinates, size)
+                                                                for _, level, coordinates, size in self.scales]
+        arrays = [None] * len(reads)
+        for level in set(read[0] for read in reads):
+            indices = [i for i, read in enumerate(reads) if read[0] == level]
+            downsample = self.slide_object.level_downsamples[level]
+            # Bounding box of every read on this level, in level 0 pixels
+            top = min(reads[i][1][0] for i in indices)
+            left = min(reads[i][1][1] for i in indices)
+            bottom = max(reads[i][1][0] + reads[i][2][1] * downsample for i in indices)
+            right = max(reads[i][1][1] + reads[i][2][0] * downsample for i in indices)
+
+            self.read_count += 1
+            region = self.slide_object.read_region((int(left), int(top)), level,
+                                                   (int(np.ceil((right - left) / downsample)),
+                                                    int(np.ceil((bottom - top) / downsample))))
+            for i in indices:
+                _, coordinates, size = reads[i]
+                x = int(round((coordinates[1] - left) / downsample))
+                y = int(round((coordinates[0] - top) / downsample))
+                crop = region.crop((x, y, x + size[0], y + size[1]))
+                if tuple(self.output_size) != tuple(size):
+                    crop = crop.resize(tuple(self.output_size), self.resample)
+                arrays[i] = np.asarray(crop)
+        return arrays
 
     def copy(self):
         """
@@ -45,7 +102,48 @@ class Patch:
                      manager=self.manager,
                      coordinates=self.coordinates,
                      level=self.level,
-                     size=self.size)
+                     size=self.size,
+                     output_size=self.output_size,
+                     resample=self.resample,
+                     scales=self.scales,
+                     encoder=self.encoder)
+
+    def to_record(self):
+        """
+        Return a lightweight, picklable PatchRecord describing this patch.
+        @return: PatchRecord
+        """
+        return PatchRecord(slide_path=self._slide_path,
+                           coordinates=tuple(int(c) for c in self.coordinates),
+                           level=self.level,
+                           size=tuple(self.size),
+                           output_suffix=self.output_suffix,
+                           output_size=tuple(self.output_size),
+                           resample=self.resample,
+                           scales=tuple((factor, level, tuple(int(c) for c in coordinates), tuple(size))
+                                        for factor, level, coordinates, size in self.scales),
+                           encoder=self.encoder)
+
+    @classmethod
+    def from_record(cls, record, slide_object, manager=None):
+        """
+        Rebuild a Patch from a PatchRecord.
+        @param record: PatchRecord created by Patch.to_record().
+        @param slide_object: Slide object to read the patch from (opened on record.slide_path).
+        @param manager: Optional PatchManager. Without one, checks have to be passed to save() explicitly.
+        @return: Patch
+        """
+        return cls(slide_path=record.slide_path,
+                   slide_object=slide_object,
+                   manager=manager,
+                   coordinates=record.coordinates,
+                   level=record.level,
+                   size=record.size,
+                   output_suffix=record.output_suffix,
+                   output_size=record.output_size,
+                   resample=record.resample,
+                   scales=record.scales,
+                   encoder=record.encoder)
 
     def set_slide(self, slide_path):
         """
@@ -58,18 +156,99 @@ class Patch:
         # Re-assign subfolder within output folder
         self.subfolder = Path(slide_path).stem
 
-    def get_patch_path(self, out_dir, create_dir=True):
+    def get_patch_path(self, out_dir, create_dir=True, scale=None):
         """
         Returns string of the path to where this patch will be saved.
         @param out_dir: The output directory
+        @param scale: Factor of one of self.scales, to get the path of that scale instead of the patch itself.
         @return: str
         """
         path = Path(self._slide_path)
         if create_dir:
-            Path(out_dir, self.subfolder).mkdir(parents=True, exist_ok=True)
-        return os.path.join(out_dir, self.subfolder, path.name.split(path.suffix)[0] + self.output_suffix.format(self.coordinates[0], self.coordinates[1]))
+            folder = os.path.join(out_dir, self.subfolder)
+            if folder not in _created_dirs:
+                Path(folder).mkdir(parents=True, exist_ok=True)
+                _created_dirs.add(folder)
+        name = path.name.split(path.suffix)[0] + self.output_suffix.format(self.coordinates[0], self.coordinates[1])
+        if scale is not None:
+            base, extension = os.path.splitext(name)
+            name = "{}_x{:g}{}".format(base, scale, extension)
+        return os.path.join(out_dir, self.subfolder, name)
 
-    def save(self, out_dir, save=True, check_if_valid=True, process_method=None, value_map=None):
+    def get_archive_key(self):
+        """
+        Returns the key identifying this patch inside an archive shard: the patch file name without its extension.
+        Dots are replaced, since archive readers split member names into key and extension at the first dot.
+        @return: str
+        """
+        path = Path(self._slide_path)
+        name = path.name.split(path.suffix)[0] + self.output_suffix.format(self.coordinates[0], self.coordinates[1])
+        return os.path.splitext(name)[0].replace(".", "_")
+
+    def extract(self, check_if_valid=True, value_map=None, checks=None, metrics=None):
+        """
+        Read the patch, run it through the validity checks and apply the value map.
+        @param check_if_valid: Run through checks supplied by manager.
+        @param value_map: Map key values in patch to alternate value (see save()).
+        @param checks: List of check functions to run if check_if_valid. Defaults to the manager's valid_patch_checks.
+        @param metrics: Optional MetricsCollector timing the "read", "check:<name>" and "value_map" stages.
+        @return: ndarray of the patch, or None if it was rejected.
+        """
+        arrays = self.extract_scales(check_if_valid=check_if_valid, value_map=value_map, checks=checks,
+                                     metrics=metrics)
+        return None if arrays is None else arrays[0]
+
+    def extract_scales(self, check_if_valid=True, value_map=None, checks=None, metrics=None):
+        """
+        Same as extract(), also returning the extra scales of the patch (see read_scales()). Only the patch itself
+        goes through the checks; the value map is applied to every scale.
+        @return: list of ndarrays (the patch, then one per entry of self.scales), or None if the patch was rejected.
+        """
+        metrics = NULL_METRICS if metrics is None else metrics
+        # Read the region once; the same buffer is shared by the checks, value mapping, process_method and encoding.
+        with metrics.timer("read"):
+            arrays = self.read_scales() if self.scales else [self.read_patch()]
+        patch = arrays[0]
+
+        if checks is None and check_if_valid:
+            checks = self.manager.valid_patch_checks
+
+        if check_if_valid:
+            for check_function in checks:
+                with metrics.timer("check:" + check_name(check_function)):
+                    passed = check_function(patch)
+                if not passed:
+                    print("Patch failed check", check_function)
+                    return None
+
+        if isinstance(value_map, dict):
+            try:
+                # Label maps are mapped on their first channel only
+                with metrics.timer("value_map"):
+                    arrays = [map_values(array[:, :, 0] if array.ndim == 3 else array, value_map) for array in arrays]
+            except Exception as e:
+                print("Exception while mapping patch values:", e)
+                return None
+
+        return arrays
+
+    def write(self, patch, out_dir, scale=None, metrics=None):
+        """
+        Write an extracted patch image to its file under out_dir, encoded with self.encoder.
+        @param patch: ndarray returned by extract().
+        @param out_dir: Output directory.
+        @param scale: Factor of the scale being written, None for the patch itself.
+        @param metrics: Optional MetricsCollector timing the "encode" and "write" stages.
+        """
+        metrics = NULL_METRICS if metrics is None else metrics
+        with metrics.timer("encode"):
+            data = self.encoder.encode(patch)
+        with metrics.timer("write"):
+            with open(self.get_patch_path(out_dir, scale=scale), "wb") as file:
+                file.write(data)
+
+    def save(self, out_dir, save=True, check_if_valid=True, process_method=None, value_map=None, checks=None,
+             metrics=None):
         """
         Save patch.
         @param out_dir: Output directory for saving the patch. Supplied by patch_manager.py
@@ -80,37 +259,22 @@ class Patch:
         @param value_map: Map key values in patch to alternate value. dict(key => value) where key, value are ints.
             alters the patch by substituting key for value in the image, leaves values not in dictionary unaltered.
             Helpful for standardization.
+        @param checks: List of check functions to run if check_if_valid. Defaults to the manager's valid_patch_checks.
+        @param metrics: Optional MetricsCollector, see extract() and write().
         @return: A list [bool, Patch, summary]. bool is if the patch was accepted, Patch is the patch object, and
             summary is the output of process_method.
         """
 
-        patch = self.read_patch()
+        patch = self.extract(check_if_valid=check_if_valid, value_map=value_map, checks=checks, metrics=metrics)
+        if patch is None:
+            return [False, self, ""]
 
         if process_method is None:
             process_method = pass_method
 
-        if check_if_valid:
-            for check_function in self.manager.valid_patch_checks:
-                if not check_function(patch):
-                    print("Patch failed check", check_function)
-                    return [False, self, ""]
-
         try:
             if save:
-                if isinstance(value_map, dict):
-                    patch = self.read_patch()[:, :, 0]
-                    patch = map_values(patch, value_map)
-                    imsave(
-                        fname=self.get_patch_path(out_dir),
-                        arr=patch
-                    )
-                elif value_map is None:
-                    patch = self.read_patch()
-                    imsave(
-                        fname=self.get_patch_path(out_dir),
-                        arr=patch
-                    )
-
+                self.write(patch, out_dir, metrics=metrics)
 
             return [True, self, process_method(patch)]
 
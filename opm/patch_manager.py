@@ -1,16 +1,21 @@
-import sys
 import concurrent.futures
+import hashlib
 import os
 from functools import partial
-from .patch import Patch
-from .utils import get_patch_class_proportions
-from tiffslide import open_slide
+from .patch import Patch, PatchRecord
+from .candidate_index import CandidateIndex
+from .packed_mask import PackedMask
+from .writers import ShardWriter, ArrayStoreWriter, ManifestWriter, PatchEncoder, encode_members, member_names
+from .pipeline import Pipeline
+from .checkpoint import save_checkpoint, load_checkpoint, DEFAULT_CHECKPOINT_INTERVAL
+from .tile_cache import TileCache, CachedSlide
+from .metrics import MetricsCollector, NULL_METRICS, write_report, load_hook
+from .utils import get_patch_class_proportions, map_values, map_values_with_proportions, get_target_downsample
 import numpy as np
-from tqdm import tqdm
 from pathlib import Path
-import skimage.io
-import pandas as pd
-import tiffslide
+
+# tiffslide, tqdm and PIL are imported by the methods that use them, like in utils.py: importing opm (e.g. for
+# iter_patches or the Patch/PatchRecord types) shouldn't pay for the slide reader and progress bar up front.
 
 
 class PatchManager:
@@ -23,6 +28,8 @@ class PatchManager:
         self.patches = list()
         self.slide_folder = Path(filename).stem
         self.valid_mask = None
+        self.candidate_index = None
+        self.tissue_mask = None
         self.mined_mask = None
         self.valid_mask_scale = (0, 0)
         self.valid_patch_checks = []
@@ -33,6 +40,12 @@ class PatchManager:
         self.subjectID = None
         self.save_subjectID = False
         self.output_dir = output_dir
+        self.executor = None
+        self.tile_cache = None
+        self.encoder = PatchEncoder()
+        self.metrics = NULL_METRICS
+        self.target_downsample = 1.0
+        self.output_scales = ()
         self.image_header = "SlidePatchPath"
         self.mask_header = "LabelMapPatchPath"
         Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -45,6 +58,7 @@ class PatchManager:
             self.converted_img_path = os.path.join(self.output_dir, "tiff_converted")
             Path(self.converted_img_path).mkdir(parents=True, exist_ok=True)
             temp_file = os.path.join(self.converted_img_path, os.path.basename(base) + "_" + img_type + ".tiff")
+            import skimage.io
             temp_img = skimage.io.imread(filename) 
             skimage.io.imsave(temp_file, temp_img)
             return temp_file
@@ -56,9 +70,20 @@ class PatchManager:
         self.subjectID = str(subjectID)
         self.save_subjectID = True
 
+    def set_executor(self, executor):
+        """
+        Use a shared, long-lived executor for saving patches instead of starting a new pool for every batch.
+        The caller owns the executor and is responsible for shutting it down.
+        @param executor: concurrent.futures ThreadPoolExecutor or ProcessPoolExecutor, or None to go back to per-batch
+            pools.
+        """
+        self.executor = executor
+
     def set_slide_path(self, filename):
+        self.source_path = os.path.abspath(filename)
         self.img_path = filename
         self.img_path = self.convert_to_tiff(self.img_path, "img")
+        import tiffslide
         self.slide_object = tiffslide.open_slide(self.img_path)
         self.slide_dims = self.slide_object.dimensions
 
@@ -69,21 +94,219 @@ class PatchManager:
         @param path: path to label map.
         """
         self.label_map = self.convert_to_tiff(path, "mask")
-        self.label_map_object = tiffslide.open_slide(self.label_map)
+        import tiffslide
+        self.label_map_object = self._wrap_slide(tiffslide.open_slide(self.label_map), self.label_map)
 
         assert all(x == y for x, y in zip(self.label_map_object.dimensions, self.slide_dims)), \
             "Label map must have same dimensions as main slide."
         self.label_map_folder = Path(path).stem
 
     def set_valid_mask(self, mask, scale=(1, 1)):
-        self.valid_mask = mask
-        self.mined_mask = np.zeros_like(mask)
+        """
+        Set the tissue mask patches are drawn from. The masks are kept bit-packed (see PackedMask): the untouched tissue
+        mask for tissue fractions over patch footprints, the valid mask that is cleared as patches are drawn, and the
+        mined mask.
+        @param mask: 2D boolean ndarray or PackedMask.
+        @param scale: (x, y) scale of the mask relative to the slide.
+        """
+        self.tissue_mask = mask if isinstance(mask, PackedMask) else PackedMask(mask)
+        self.valid_mask = self.tissue_mask.copy()
+        self.candidate_index = CandidateIndex(self.valid_mask)
+        self.mined_mask = PackedMask.zeros(self.tissue_mask.shape)
         self.valid_mask_scale = scale
 
-        if sys.getsizeof(self.valid_mask) > 16*(1024**2):
+        if self.valid_mask.nbytes > 16*(1024**2):
             print("Warning: large mask detected. Consider editing the config to use a larger scale for faster mining")
-            print("Valid mask size (in Mb): {}".format(sys.getsizeof(self.valid_mask) / (1024**2)))
+            print("Valid mask size (in Mb): {}".format(self.valid_mask.nbytes / (1024**2)))
     
+    def set_tile_cache(self, max_mb):
+        """
+        Read patches through a shared LRU cache of decoded slide and label map tiles (see tile_cache.CachedSlide), so
+        overlapping or adjacent patches decode each tile once. While it is enabled, patches are saved in tile order.
+        With the 'process' executor, every worker keeps its own cache of this size.
+        @param max_mb: Size of the cache in Mb, 0 to disable it.
+        """
+        self.tile_cache = TileCache(max_mb * 1024 ** 2) if max_mb > 0 else None
+        self.slide_object = self._wrap_slide(self.slide_object, self.img_path)
+        if self.label_map_object is not None:
+            self.label_map_object = self._wrap_slide(self.label_map_object, self.label_map)
+
+    def set_encoder(self, encoder):
+        """
+        Set how patches are encoded in files and tar shards. Label map patches use encoder.label_map_encoder(), so they
+        stay lossless.
+        @param encoder: PatchEncoder, see writers.PatchEncoder.
+        """
+        self.encoder = encoder
+
+    def set_metrics(self, metrics):
+        """
+        Collect per-stage timings and counts while mining (see metrics.MetricsCollector). At the end of mine_patches()
+        and save_predefined_patches(), a report is written to <output_dir>/<slide>.metrics.json and passed to the
+        collector's hooks.
+        @param metrics: MetricsCollector, or None to disable metrics.
+        """
+        self.metrics = NULL_METRICS if metrics is None else metrics
+
+    def _start_metrics(self, config):
+        """
+        Create a collector if the config asks for metrics and none was set, and clear it for a new run.
+        """
+        if (config['metrics'] or config['metrics_hooks']) and not self.metrics.enabled:
+            self.set_metrics(MetricsCollector([load_hook(spec) for spec in config['metrics_hooks']]))
+        self.metrics.reset()
+
+    def _report_metrics(self, **info):
+        """
+        Write the metrics report of this slide and pass it to the hooks.
+        @param info: Extra entries of the report.
+        @return: The report dict, or None if metrics are disabled.
+        """
+        if not self.metrics.enabled:
+            return None
+        report = self.metrics.report(slide=self.img_path, label_map=self.label_map, **info)
+        path = os.path.join(self.output_dir, self.slide_folder + ".metrics.json")
+        write_report(report, path)
+        print("Metrics report written to {}".format(path))
+        self.metrics.emit(report)
+        return report
+
+    def _wrap_slide(self, slide_object, name):
+        if isinstance(slide_object, CachedSlide):
+            slide_object = slide_object.slide
+        if self.tile_cache is None:
+            return slide_object
+        return CachedSlide(slide_object, self.tile_cache, name=name)
+
+    def sort_by_tile(self, patches):
+        """
+        Order patches along the slide's native tile grid (row by row), so consecutive reads share tiles.
+        """
+        if self.tile_cache is None:
+            return patches
+        return sorted(patches, key=lambda patch: (patch.level, self.slide_object.get_tile_index(
+            (patch.coordinates[1], patch.coordinates[0]), patch.level)))
+
+    def print_tile_cache_stats(self):
+        if self.tile_cache is None:
+            return
+        stats = self.tile_cache.stats()
+        # Worker processes keep their own caches, nothing is counted here then
+        if stats["hits"] + stats["misses"] > 0:
+            print("Tile cache: {} hits, {} misses ({:.1%} hit rate)".format(stats["hits"], stats["misses"],
+                                                                        stats["hit_rate"]))
+
+    def set_target_downsample(self, downsample):
+        """
+        Mine patches at a given downsample relative to level 0 (see utils.get_target_downsample). patch_size is then in
+        pixels at that resolution. Patches are read from the closest native level at or below it and only resampled
+        when that level doesn't match exactly; coordinates, the masks and the manifest stay in level 0 pixels.
+        @param downsample: float, 1 for level 0.
+        """
+        self.target_downsample = downsample
+
+    def set_output_scales(self, scales):
+        """
+        Also save every patch at other magnifications, centred on the same location. A scale factor of 2 covers twice
+        the width and height of the patch, downsampled to the same patch_size (e.g. 10x context around a 20x patch).
+        @param scales: list of scale factors relative to the target resolution, empty for single-scale output.
+        """
+        self.output_scales = tuple(scales or ())
+
+    def get_footprint(self, patch_size):
+        """
+        Size covered by a patch on level 0.
+        @param patch_size: (width, height) of the patch at the target resolution.
+        @return: [width, height] in level 0 pixels.
+        """
+        return [int(round(side * self.target_downsample)) for side in patch_size]
+
+    def _read_geometry(self, slide_object, patch_size, target_downsample=None):
+        """
+        Pick the pyramid level to read a patch from at the target resolution.
+        @param target_downsample: Downsample to read at, defaults to self.target_downsample.
+        @return: (level, [width, height] to read at that level).
+        """
+        if target_downsample is None:
+            target_downsample = self.target_downsample
+        level = 0
+        for index, downsample in enumerate(slide_object.level_downsamples):
+            # Tolerate pyramids whose downsamples are slightly off from round numbers
+            if downsample <= target_downsample * 1.01:
+                level = index
+        level_downsample = slide_object.level_downsamples[level]
+        return level, [int(round(side * target_downsample / level_downsample)) for side in patch_size]
+
+    def _scale_geometry(self, slide_object, coordinates, patch_size):
+        """
+        Describe the reads of every output scale of a patch, centred on the patch (see Patch.scales).
+        @return: tuple of (factor, level, (y, x) level 0 coordinates, [width, height] to read at that level).
+        """
+        footprint = self.get_footprint(patch_size)
+        center_y = coordinates[0] + footprint[1] / 2
+        center_x = coordinates[1] + footprint[0] / 2
+        scales = []
+        for factor in self.output_scales:
+            level, size = self._read_geometry(slide_object, patch_size, self.target_downsample * factor)
+            scales.append((factor, level,
+                           (int(round(center_y - footprint[1] * factor / 2)),
+                            int(round(center_x - footprint[0] * factor / 2))),
+                           size))
+        return tuple(scales)
+
+    def create_patch(self, coordinates, patch_size):
+        """
+        Create a slide Patch at the target resolution.
+        @param coordinates: (y, x) level 0 coordinates of the top-left corner.
+        @param patch_size: (width, height) of the patch at the target resolution.
+        """
+        level, size = self._read_geometry(self.slide_object, patch_size)
+        return Patch(slide_path=self.img_path,
+                     slide_object=self.slide_object,
+                     manager=self,
+                     coordinates=coordinates,
+                     level=level,
+                     size=size,
+                     output_suffix="_patch_{}-{}." + self.encoder.extension,
+                     output_size=tuple(patch_size),
+                     scales=self._scale_geometry(self.slide_object, coordinates, patch_size),
+                     encoder=self.encoder)
+
+    def get_checkpoint_path(self):
+        """
+        Checkpoint of the slide, <output_dir>/<slide>.<hash of the slide's full path>.checkpoint.npz, so slides with
+        the same name in different folders (e.g. in a batch) don't share one.
+        """
+        path_hash = hashlib.sha1(self.source_path.encode()).hexdigest()[:12]
+        return os.path.join(self.output_dir, "{}.{}.checkpoint.npz".format(self.slide_folder, path_hash))
+
+    def save_checkpoint(self, n_completed, manifest_rows, grid_coordinates=None, finished=False, writer=None):
+        """
+        Checkpoint the mining state of the slide to get_checkpoint_path().
+        @param n_completed: Number of patches saved so far.
+        @param manifest_rows: Number of rows in the output csv once those patches are written.
+        @param grid_coordinates: Grid tiles left to mine (grid read type only).
+        @param finished: True once the slide is done.
+        @param writer: Archive writer, whose position is saved so later samples can be rolled back on resume.
+        """
+        save_checkpoint(self.get_checkpoint_path(), self.tissue_mask, self.valid_mask, self.mined_mask,
+                        self.valid_mask_scale, n_completed, manifest_rows, grid_coordinates, finished,
+                        writer.position() if writer is not None else None)
+
+    def restore_checkpoint(self):
+        """
+        Restore the valid/mined masks and numpy's global RNG from the slide's checkpoint, replacing any valid mask
+        that was set.
+        @return: dict of the checkpoint's progress: n_completed, manifest_rows, grid_coordinates, writer_position and
+            finished.
+        """
+        state = load_checkpoint(self.get_checkpoint_path())
+        self.set_valid_mask(state["tissue_mask"], state["scale"])
+        self.valid_mask = state["valid_mask"]
+        self.candidate_index = CandidateIndex(self.valid_mask)
+        self.mined_mask = state["mined_mask"]
+        return state
+
     def add_patch(self, patch, overlap_factor, patch_size):
         """
         Add patch to manager and take care of self.mined_mask update so it doesn't pull the same patch twice.
@@ -120,14 +343,13 @@ class PatchManager:
                     (patch.coordinates[1] + int(round(patch_size[1] * inverse_overlap_factor))) / self.valid_mask_scale[
                         1]))
                 # Set the valid mask values to False so a coordinate that would cause overlap cannot be called later.
-                self.valid_mask[
-                max(valid_start_x, 0):self.width_bound_check(valid_end_x),
-                max(valid_start_y, 0):self.height_bound_check(valid_end_y)
-                ] = False
+                self.candidate_index.invalidate(
+                    max(valid_start_x, 0), self.width_bound_check(valid_end_x),
+                    max(valid_start_y, 0), self.height_bound_check(valid_end_y)
+                )
             else:
                 # If the user is okay with 100% overlap, just remove the single pixel of the coordinate.
-                self.valid_mask[
-                    valid_start_x, valid_start_y] = False  # Change only the starting index
+                self.candidate_index.invalidate_point(valid_start_x, valid_start_y)  # Change only the starting index
 
             mined_start_x = int(round((patch.coordinates[0]) / self.valid_mask_scale[0]))
             mined_start_y = int(round((patch.coordinates[1]) / self.valid_mask_scale[1]))
@@ -135,10 +357,8 @@ class PatchManager:
             mined_end_y = int(round((patch.coordinates[1] + patch_size[1]) / self.valid_mask_scale[1]))
 
             # Update the mined mask
-            self.mined_mask[
-            max(mined_start_x, 0):self.width_bound_check(mined_end_x),
-            max(mined_start_y, 0):self.width_bound_check(mined_end_y)
-            ] = True
+            self.mined_mask.set_region(max(mined_start_x, 0), self.width_bound_check(mined_end_x),
+                                       max(mined_start_y, 0), self.width_bound_check(mined_end_y), True)
 
             # Append this patch to the list of patches to be saved
             self.patches.append(patch)
@@ -161,44 +381,127 @@ class PatchManager:
             x_value = np.random.choice(self.slide_dims[0], 1)
             y_value = np.random.choice(self.slide_dims[1], 1)
             coordinates = np.array([x_value, y_value])
-            patch = Patch(self.img_path, self.slide_object, self, coordinates, 0, patch_size, "_patch_{}-{}.png")
+            patch = self.create_patch(coordinates, patch_size)
 
-            return self.add_patch(patch, overlap_factor, patch_size)
+            return self.add_patch(patch, overlap_factor, self.get_footprint(patch_size))
 
         else:
-            # Find indices on filled mask, then multiply by real scale to get actual coordinates
+            # Draw a coordinate from the candidate index, then multiply by real scale to get actual coordinates
             try:
-                indices = np.argwhere(self.valid_mask)
-                # (X/Y get reversed because OpenSlide and np use reversed height/width indexing)
-                x_values = np.round(indices[:, 0] * self.valid_mask_scale[0]).astype(int)
-                y_values = np.round(indices[:, 1] * self.valid_mask_scale[1]).astype(int)
-                num_indices = len(indices.ravel()) // 2
-                print("%i indices left " % num_indices, end="\r")
-                # Find index of coordinates to select for patch
                 if read_type == 'random':
-                    choice = np.random.choice(num_indices, 1)
+                    index = self.candidate_index.draw_random()
                 elif read_type == 'sequential':
-                    choice = 0
+                    index = self.candidate_index.draw_sequential()
                 else:
-                    choice = -1
                     print("Unrecognized read type %s" % read_type)
                     exit(1)
 
-                coordinates = np.array([x_values[choice], y_values[choice]]).ravel()
+                print("%i indices left " % self.candidate_index.remaining, end="\r")
+                if index is None:
+                    return False
+
+                # (X/Y get reversed because OpenSlide and np use reversed height/width indexing)
+                coordinates = np.array([int(round(index[0] * self.valid_mask_scale[0])),
+                                        int(round(index[1] * self.valid_mask_scale[1]))])
 
-                patch = Patch(slide_path=self.img_path,
-                              slide_object=self.slide_object,
-                              manager=self,
-                              coordinates=coordinates,
-                              level=0,
-                              size=patch_size,
-                              output_suffix="_patch_{}-{}.png")
-                return self.add_patch(patch, overlap_factor, patch_size)
+                patch = self.create_patch(coordinates, patch_size)
+                return self.add_patch(patch, overlap_factor, self.get_footprint(patch_size))
             except Exception as e:
                 print("Exception thrown when adding next patch:")
                 print(e)
                 return False
 
+    def get_grid_coordinates(self, patch_size, overlap_factor=0.0, min_tissue_fraction=0.0):
+        """
+        Compute every tile origin of a regular grid over the slide in one pass.
+
+        Tiles are strided by patch size * (1 - overlap_factor) and must lie fully inside the slide. When a valid mask is
+        set, each tile's tissue fraction is counted on the tissue mask and tiles with no tissue, or less than
+        min_tissue_fraction, are dropped.
+        @param patch_size: (width, height) of the patches at the target resolution.
+        @param overlap_factor: Portion of each patch that may overlap its neighbours (0 -> 1).
+        @param min_tissue_fraction: Minimum fraction of the tile that must be covered by the tissue mask.
+        @return: int ndarray of shape (n, 2) with patch coordinates in the same (row, col) order as Patch.coordinates.
+        """
+        # Patch.coordinates are (y, x), while patch_size and slide_dims are (width, height)
+        footprint = self.get_footprint(patch_size)
+        extent = (footprint[1], footprint[0])
+        bounds = (self.slide_dims[1], self.slide_dims[0])
+        stride = [max(1, int(round(extent[i] * (1 - overlap_factor)))) for i in range(2)]
+
+        starts_y = np.arange(0, bounds[0] - extent[0] + 1, stride[0])
+        starts_x = np.arange(0, bounds[1] - extent[1] + 1, stride[1])
+        grid_y, grid_x = np.meshgrid(starts_y, starts_x, indexing="ij")
+        coordinates = np.stack([grid_y.ravel(), grid_x.ravel()], axis=1)
+
+        if self.tissue_mask is None or len(coordinates) == 0:
+            return coordinates
+
+        fractions = self.get_tissue_fractions(coordinates, extent)
+        keep = np.logical_and(fractions > 0, fractions >= min_tissue_fraction)
+        return coordinates[keep]
+
+    def get_tissue_fractions(self, coordinates, extent):
+        """
+        Fraction of each patch footprint covered by the untouched tissue mask.
+        @param coordinates: int ndarray of shape (n, 2) of (y, x) level 0 patch coordinates.
+        @param extent: (height, width) of the footprint in level 0 pixels.
+        @return: ndarray of n fractions in [0, 1].
+        """
+        row_start = np.round(coordinates[:, 0] / self.valid_mask_scale[0]).astype(int)
+        col_start = np.round(coordinates[:, 1] / self.valid_mask_scale[1]).astype(int)
+        row_end = np.maximum(np.round((coordinates[:, 0] + extent[0]) / self.valid_mask_scale[0]).astype(int),
+                             row_start + 1)
+        col_end = np.maximum(np.round((coordinates[:, 1] + extent[1]) / self.valid_mask_scale[1]).astype(int),
+                             col_start + 1)
+        return self.tissue_mask.region_fraction(row_start, row_end, col_start, col_end)
+
+    def prefilter_patches(self, patches, patch_size, min_tissue_fraction=0.0):
+        """
+        Reject candidate patches before any of their pixels are read, from the low resolution masks and the patch
+        geometry alone:
+            - out_of_bounds: the footprint extends past the slide, so the read would be padded.
+            - low_tissue: less than min_tissue_fraction of the footprint is covered by the tissue mask.
+        @param patches: list of slide Patch objects.
+        @param patch_size: (width, height) of the patches at the target resolution.
+        @param min_tissue_fraction: Minimum fraction of the patch that must be covered by the tissue mask (0 -> 1).
+        @return: (list of the patches that passed, dict of rejection counts by reason).
+        """
+        rejections = {"out_of_bounds": 0, "low_tissue": 0}
+        if len(patches) == 0:
+            return patches, rejections
+
+        footprint = self.get_footprint(patch_size)
+        extent = (footprint[1], footprint[0])
+        coordinates = np.array([np.ravel(patch.coordinates)[:2] for patch in patches]).astype(int)
+        in_bounds = np.all(coordinates >= 0, axis=1) & \
+            (coordinates[:, 0] + extent[0] <= self.slide_dims[1]) & \
+            (coordinates[:, 1] + extent[1] <= self.slide_dims[0])
+        keep = in_bounds
+        if self.tissue_mask is not None and min_tissue_fraction > 0:
+            keep = in_bounds & (self.get_tissue_fractions(coordinates, extent) >= min_tissue_fraction)
+
+        rejections["out_of_bounds"] = int(np.count_nonzero(~in_bounds))
+        rejections["low_tissue"] = int(np.count_nonzero(in_bounds & ~keep))
+        return [patch for patch, kept in zip(patches, keep) if kept], rejections
+
+    def add_grid_patches(self, coordinates, patch_size, overlap_factor):
+        """
+        Add a batch of precomputed patch coordinates (see get_grid_coordinates) to the manager.
+        @param coordinates: ndarray of shape (n, 2) of patch coordinates.
+        @return: Number of patches added.
+        """
+        n_added = 0
+        footprint = self.get_footprint(patch_size)
+        for coordinate in coordinates:
+            patch = self.create_patch(coordinate, patch_size)
+            if self.valid_mask is None:
+                self.patches.append(patch)
+                n_added += 1
+            elif self.add_patch(patch, overlap_factor, footprint):
+                n_added += 1
+        return n_added
+
     def remove_patch(self, patch):
         return self.patches.remove(patch)
 
@@ -222,7 +525,7 @@ class PatchManager:
     def set_mask_header(self, mask_header):
         self.mask_header = mask_header
 
-    def mine_patches(self, config, output_csv=None):
+    def mine_patches(self, config, output_csv=None, resume=False):
         """
         Main loop of the program. This generates patch locations and attempts to save them until the slide is either
         saturated or the quota has been met.
@@ -245,6 +548,9 @@ class PatchManager:
 
         @param n_patches: either an int for the number of patches, or -1 for mining until exhaustion.
         @param output_csv: The path of the output .csv to write. If none specified, put it in the output folder.
+        @param resume: Continue from the slide's checkpoint (see get_checkpoint_path), if there is one. Rows written to
+            the csv, and tar or zarr samples, after that checkpoint are dropped and mined again. A resumable run
+            checkpoints every DEFAULT_CHECKPOINT_INTERVAL patches unless config['checkpoint_interval'] is set.
         @param n_jobs: Number of threads to launch.
         @param save: 'Dummy' run of patch extraction if False.
         @param value_map: Dictionary for value swapping.
@@ -255,81 +561,117 @@ class PatchManager:
         n_jobs = config['num_workers']
         save = config['save_patches']
         value_map = config['value_map']
-        
+        executor_type = config['executor']
+        fuse_label_map = config['fuse_label_map']
+        self._start_metrics(config)
+        writer = self._open_writer(config) if save else None
+        self.set_target_downsample(get_target_downsample(self.slide_object, config))
+        self.set_output_scales(config['output_scales'])
+        self.set_tile_cache(config['tile_cache_mb'])
+        self.set_encoder(PatchEncoder.from_config(config))
+
         if output_csv is None:
             print("Creating output csv")
             csv_filename = os.path.join(self.output_dir, "list.csv")
         else:
             csv_filename = output_csv
 
-        try:
-            if os.path.exists(csv_filename) and os.path.isfile(csv_filename):
-                output_df = pd.read_csv(csv_filename)
-            else:
-                output_df = pd.DataFrame()
-        except pd.errors.EmptyDataError as e:
-            output_df = pd.DataFrame()
-
+        # Rows are appended as patches are accepted, a pre-existing csv is extended rather than read back.
+        manifest = ManifestWriter(csv_filename)
 
         if n_patches == -1:
             n_patches = np.Inf
 
         n_completed = 0
-        saturated = False
-
-        while n_patches - n_completed > 0 and not saturated:
-            # If there is a patch quota given...
-            if n_patches != np.Inf:
-                # Generate feasible patches until quota is reached or error is raised
-                for _ in range(n_patches - n_completed):
-                    if not self.find_next_patch(patch_size=config['patch_size'],
-                                                read_type=config['read_type'],
-                                                overlap_factor=config['overlap_factor']):
-                        print("\nCould not add new patch, breaking.")
-                        break
-                else:
-                    print("")  # Fixes spacing in case it breaks. Inelegant but I'll fix later
-
-                # If the quota is not met, assume the slide is saturated
-                if len(self.patches) != n_patches - n_completed:
-                    print("Slide has reached saturation: No more non-overlapping patches to be found.\n"
-                          "Change SHOW_MINED in config.py to True to see patch locations.\n"
-                          "Alternatively, change READ_TYPE to 'sequential' for greater mining efficiency.")
-                    saturated = True
-            # If there is no patch quota given, add patches until saturation.
-            else:
-                while True:
-                    if not self.find_next_patch(patch_size=config['patch_size'],
-                                                read_type=config['read_type'],
-                                                overlap_factor=config['overlap_factor']):
-                        print("\nCould not add new patch, breaking.")
-                        break
-
-                if len(self.patches) != n_patches - n_completed:
-                    print("Slide has reached saturation: No more non-overlapping patches to be found.\n"
-                          "Change SHOW_MINED in config.py to True to see patch locations.\n"
-                          "Alternatively, change READ_TYPE to 'sequential' for greater mining efficiency.")
-                    saturated = True
+        grid_coordinates = None
+        # Candidates dropped, by reason: before reading (see prefilter_patches), or by the patch criteria after reading
+        rejections = {"out_of_bounds": 0, "low_tissue": 0, "failed_checks": 0}
+
+        if resume and os.path.isfile(self.get_checkpoint_path()):
+            state = self.restore_checkpoint()
+            if state["finished"]:
+                print("Slide was already mined, nothing to resume.")
+                manifest.close()
+                return
+            manifest.truncate(state["manifest_rows"])
+            if writer is not None and state["writer_position"] is not None:
+                writer.rollback(state["writer_position"])
+            n_completed = state["n_completed"]
+            grid_coordinates = state["grid_coordinates"]
+            print("Resuming from checkpoint: {} patches already saved.".format(n_completed))
+
+        # Patches are selected and saved checkpoint_interval at a time, with a checkpoint after each batch.
+        checkpoint_interval = config['checkpoint_interval']
+        if checkpoint_interval == 0 and resume:
+            checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        batch_size = checkpoint_interval if checkpoint_interval > 0 else np.Inf
+        checkpoint = save and self.valid_mask is not None and checkpoint_interval > 0
+        if checkpoint:
+            self.save_checkpoint(n_completed, manifest.flush(), grid_coordinates, writer=writer)
+
+        selection = {"grid_coordinates": grid_coordinates, "saturated": False}
+        while n_patches - n_completed > 0 and not selection["saturated"]:
+            candidates = self._select_batch(config, n_patches - n_completed, batch_size, selection)
+            if config['pipeline'] and executor_type == "thread":
+                successful = self._save_pipelined(candidates, config, writer, manifest, rejections)
+                print("{}/{} valid patches found in this run.".format(successful, n_patches))
+                n_completed += successful
+                if checkpoint:
+                    self.save_checkpoint(n_completed, manifest.flush(), selection["grid_coordinates"],
+                                         finished=selection["saturated"] or n_completed >= n_patches, writer=writer)
+                continue
+            self.patches = list(candidates)
 
             # Save patches
+            with self.metrics.timer("prefilter", len(self.patches)):
+                self.patches, prefiltered = self.prefilter_patches(self.patches, config['patch_size'],
+                                                                   config['min_tissue_fraction'])
+            for reason, count in prefiltered.items():
+                rejections[reason] += count
+            n_candidates = len(self.patches)
+            self.patches = self.sort_by_tile(self.patches)
             output_dir_slide_folder = os.path.join(self.output_dir, self.slide_folder)
-            Path(output_dir_slide_folder).mkdir(parents=True, exist_ok=True)
-            _save_patch_partial = partial(_save_patch,
-                                        output_directory=self.output_dir,
-                                        save=save,
-                                        check_if_valid=True)
-            
-            print("Saving patches:")
-
-            with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
-                np_slide_futures = list(
-                    tqdm(
-                        executor.map(_save_patch_partial, self.patches),
-                        total=len(self.patches),
-                        unit="pchs",
-                    )
-                )
+            if writer is None:
+                Path(output_dir_slide_folder).mkdir(parents=True, exist_ok=True)
+
+            if writer is not None or (self.label_map is not None and fuse_label_map) or self.output_scales:
+                # Fused mode: one task reads, checks and writes both the slide and label map patch, and builds the row.
+                # Archive and multi-scale output always go through it, so a sample's members stay together.
+                if self.label_map is not None:
+                    output_dir_mask_folder = os.path.join(self.output_dir, self.label_map_folder)
+                    if writer is None:
+                        Path(output_dir_mask_folder).mkdir(parents=True, exist_ok=True)
+                    patch_pairs = [(patch, self.pull_from_label_map(patch)) for patch in self.patches]
+                else:
+                    patch_pairs = [(patch,) for patch in self.patches]
+                _save_pair_partial = partial(_save_patch_pair,
+                                             output_directory=self.output_dir,
+                                             save=save,
+                                             value_map=value_map,
+                                             row_fields=self._row_fields(),
+                                             archive=config['output_format'] if writer is not None else None,
+                                             writer=writer if executor_type == "thread" else None)
+
+                print("Saving patches and label maps:")
+                if isinstance(writer, ArrayStoreWriter):
+                    writer.reserve(len(patch_pairs))
+                pair_futures = self._run_save_pool(_save_pair_partial, patch_pairs, n_jobs, executor_type,
+                                                   on_result=partial(self._archive_result, writer, manifest=manifest))
+                self.patches = list()
+
+                successful = sum(1 for result in pair_futures if result[0])
+                print("{}/{} valid patches found in this run.".format(successful, n_patches))
+                n_completed += successful
+                rejections["failed_checks"] += n_candidates - successful
+            else:
+                _save_patch_partial = partial(_save_patch,
+                                              output_directory=self.output_dir,
+                                              save=save,
+                                              check_if_valid=True)
 
+                print("Saving patches:")
+
+                np_slide_futures = self._run_save_pool(_save_patch_partial, self.patches, n_jobs, executor_type)
 
                 self.patches = list()
                 np_slide_futures = np.array(np_slide_futures)
@@ -340,66 +682,196 @@ class PatchManager:
                     print("Setting successful indices to []")
                     successful_indices = []
 
-            # Find all successfully saved patches, copy and extract from label map.
-            if self.label_map is not None:
-                for i in successful_indices:
-                    slide_patch = np_slide_futures[i, 1]
-                    lm_patch = self.pull_from_label_map(slide_patch)
-                    self.label_map_patches.append(lm_patch)
-
-                print("Saving label maps:")
-                output_dir_mask_folder = os.path.join(self.output_dir, self.label_map_folder)
-                Path(output_dir_mask_folder).mkdir(parents=True, exist_ok=True)
-                
-                _lm_save_patch_partial = partial(_save_patch,
-                                                 output_directory=self.output_dir,
-                                                 save=save,
-                                                 check_if_valid=False,
-                                                 patch_processor=get_patch_class_proportions,
-                                                 value_map=value_map)
-                with concurrent.futures.ThreadPoolExecutor(config['num_workers']) as executor:
-                    lm_futures = list(
-                        tqdm(
-                            executor.map(_lm_save_patch_partial, self.label_map_patches),
-                            total=len(self.label_map_patches),
-                            unit="pchs",
-                        )
-                    )
-                np_lm_futures = np.array(lm_futures)
-            successful = np.count_nonzero(np_slide_futures[:, 0])
-            print("{}/{} valid patches found in this run.".format(successful, n_patches))
-            n_completed += successful
-
-            new_df_rows = []
-            for index in successful_indices:
-                new_row = {}
-                if self.save_subjectID:
-                    new_row.update({"SubjectID": self.subjectID})
+                # Find all successfully saved patches, copy and extract from label map.
                 if self.label_map is not None:
-                    slide_patch_path = np_slide_futures[index, 1].get_patch_path(self.output_dir, False)
-                    lm_patch_path = np_lm_futures[index, 1].get_patch_path(self.output_dir, False)
-                    lm_result = np_lm_futures[index, 2]
-                    new_row.update({self.image_header: slide_patch_path,
-                                        self.mask_header: lm_patch_path,
-                                        "PatchComposition": lm_result})
-
-                slide_patch_path = np_slide_futures[index, 1].get_patch_path(self.output_dir, False)
-                new_row.update({"SlidePatchPath": slide_patch_path})
-
-                patch_coords = np_slide_futures[index, 1].coordinates
-                new_row.update({"PatchCoordinatesX": patch_coords[1]})
-                new_row.update({"PatchCoordinatesY": patch_coords[0]})
-
-                new_df_rows.append(new_row)
-
-            new_df = pd.DataFrame(new_df_rows)
-            output_df = pd.concat([output_df, new_df])  # Concatenate in case there is a pre-existing dataframe
+                    self.label_map_patches = list()
+                    for i in successful_indices:
+                        slide_patch = np_slide_futures[i, 1]
+                        lm_patch = self.pull_from_label_map(slide_patch)
+                        self.label_map_patches.append(lm_patch)
+
+                    print("Saving label maps:")
+                    output_dir_mask_folder = os.path.join(self.output_dir, self.label_map_folder)
+                    Path(output_dir_mask_folder).mkdir(parents=True, exist_ok=True)
+
+                    _lm_save_patch_partial = partial(_save_patch,
+                                                     output_directory=self.output_dir,
+                                                     save=save,
+                                                     check_if_valid=False,
+                                                     patch_processor=get_patch_class_proportions,
+                                                     value_map=value_map)
+                    lm_futures = self._run_save_pool(_lm_save_patch_partial, self.label_map_patches, n_jobs,
+                                                     executor_type)
+                successful = np.count_nonzero(np_slide_futures[:, 0]) if n_candidates else 0
+                print("{}/{} valid patches found in this run.".format(successful, n_patches))
+                n_completed += successful
+                rejections["failed_checks"] += n_candidates - successful
+
+                new_df_rows = []
+                # Label map futures only exist for accepted slide patches, in the same order
+                for lm_index, index in enumerate(successful_indices):
+                    slide_patch = np_slide_futures[index, 1]
+                    if self.label_map is not None:
+                        new_row = _manifest_row(slide_patch, lm_futures[lm_index][1], lm_futures[lm_index][2],
+                                                self.output_dir, self._row_fields())
+                    else:
+                        new_row = _manifest_row(slide_patch, None, None, self.output_dir, self._row_fields())
+                    new_df_rows.append(new_row)
+                with self.metrics.timer("manifest", len(new_df_rows)):
+                    manifest.write_rows(new_df_rows)
+
+            if checkpoint:
+                self.save_checkpoint(n_completed, manifest.flush(), selection["grid_coordinates"],
+                                     finished=selection["saturated"] or n_completed >= n_patches, writer=writer)
+
+        if writer is not None:
+            writer.close()
+        manifest.close()
+        print("Rejected candidates: " + ", ".join("{} {}".format(count, reason) for reason, count in rejections.items()))
+        self.print_tile_cache_stats()
+        self._report_metrics(patches_saved=n_completed, rejections=rejections,
+                             tile_cache=self.tile_cache.stats() if self.tile_cache is not None else None)
 
+        print("Done!")
 
-        output_df.to_csv(csv_filename, index=False)
+    def _select_batch(self, config, n_remaining, batch_size, state):
+        """
+        Select the next batch of candidate patches, one at a time as they are consumed.
+        @param config: Config dict, see parse_config().
+        @param n_remaining: Number of patches still to mine (np.Inf to mine until exhaustion).
+        @param batch_size: Maximum number of candidates in the batch (np.Inf for no limit).
+        @param state: dict carried from batch to batch: 'grid_coordinates' holds the grid tiles left to mine (grid read
+            type only, computed on the first batch), and 'saturated' is set to True once the slide has no candidates
+            left.
+        @return: generator of slide Patch objects.
+        """
+        # In grid mode every tile origin is computed at once, then consumed in quota-sized batches.
+        if config['read_type'] == 'grid':
+            if state["grid_coordinates"] is None:
+                with self.metrics.timer("grid_coordinates"):
+                    state["grid_coordinates"] = self.get_grid_coordinates(
+                        patch_size=config['patch_size'],
+                        overlap_factor=config['overlap_factor'],
+                        min_tissue_fraction=config['min_tissue_fraction'])
+                print("%i grid tiles found" % len(state["grid_coordinates"]))
+            n_batch = int(min(len(state["grid_coordinates"]), n_remaining, batch_size))
+            batch = state["grid_coordinates"][:n_batch]
+            state["grid_coordinates"] = state["grid_coordinates"][n_batch:]
+
+            if len(state["grid_coordinates"]) == 0:
+                print("Slide has reached saturation: every grid tile has been mined.")
+                state["saturated"] = True
+            for index in range(len(batch)):
+                with self.metrics.timer("select"):
+                    added = self.add_grid_patches(batch[index:index + 1],
+                                                  patch_size=config['patch_size'],
+                                                  overlap_factor=config['overlap_factor'])
+                if added:
+                    yield self.patches.pop()
+            return
+
+        # With a patch quota, generate feasible patches until it is reached, otherwise add patches until saturation.
+        n_batch = min(n_remaining, batch_size)
+        n_selected = 0
+        while n_selected < n_batch:
+            with self.metrics.timer("select"):
+                found = self.find_next_patch(patch_size=config['patch_size'],
+                                             read_type=config['read_type'],
+                                             overlap_factor=config['overlap_factor'])
+            if not found:
+                print("\nCould not add new patch, breaking.")
+                break
+            n_selected += 1
+            yield self.patches.pop()
+        else:
+            if n_remaining != np.Inf:
+                print("")  # Fixes spacing in case it breaks. Inelegant but I'll fix later
 
+        # If the quota is not met, assume the slide is saturated
+        if n_selected != n_batch:
+            print("Slide has reached saturation: No more non-overlapping patches to be found.\n"
+                  "Change SHOW_MINED in config.py to True to see patch locations.\n"
+                  "Alternatively, change READ_TYPE to 'sequential' for greater mining efficiency.")
+            state["saturated"] = True
 
-        print("Done!")
+    def _save_pipelined(self, candidates, config, writer, manifest, rejections):
+        """
+        Save a batch of candidate patches with a staged pipeline (see Pipeline), instead of selecting the whole batch
+        and then saving it: selection, reading and checking, encoding, and writing all run at once, connected by
+        bounded queues. Selection runs on the pipeline's source thread, reading and encoding on num_workers threads
+        each, and files, archive samples and manifest rows are written from this thread as samples come out.
+
+        Queue depths are shown on the progress bar and their means printed at the end of the batch. A queue that stays
+        full is waiting on the stage after it, an empty one on the stage before it.
+        @param candidates: Iterable of slide Patch objects, see _select_batch().
+        @param writer: Archive writer, or None to write individual files.
+        @param manifest: ManifestWriter the rows of the saved patches are appended to.
+        @param rejections: dict of rejection counts by reason, updated in place.
+        @return: Number of patches saved.
+        """
+        from tqdm import tqdm
+        n_jobs = config['num_workers']
+        save = config['save_patches']
+        archive = config['output_format'] if writer is not None else None
+        row_fields = self._row_fields()
+        if self.tile_cache is not None:
+            # Reading in tile order is worth more than overlapping selection with reading
+            candidates = self.sort_by_tile(list(candidates))
+
+        def select():
+            for candidate in candidates:
+                with self.metrics.timer("prefilter"):
+                    patches, prefiltered = self.prefilter_patches([candidate], config['patch_size'],
+                                                                  config['min_tissue_fraction'])
+                for reason, count in prefiltered.items():
+                    rejections[reason] += count
+                for patch in patches:
+                    yield (patch, self.pull_from_label_map(patch)) if self.label_map is not None else (patch,)
+
+        pipeline = Pipeline(source=select(),
+                            stages=[(partial(_read_stage, value_map=config['value_map'], metrics=self.metrics), n_jobs),
+                                    (partial(_encode_stage, output_directory=self.output_dir, save=save,
+                                             archive=archive, metrics=self.metrics), n_jobs)],
+                            queue_size=2 * n_jobs)
+        print("Saving patches and label maps (pipelined):")
+        successful = 0
+        n_samples = 0
+        depth_totals = np.zeros(len(pipeline.queues))
+        progress = tqdm(pipeline, unit="pchs")
+        for patches, arrays, encoded in progress:
+            depths = pipeline.queue_depths()
+            depth_totals += depths
+            n_samples += 1
+            progress.set_postfix_str("queues " + " ".join(str(depth) for depth in depths), refresh=False)
+            if arrays is None:
+                rejections["failed_checks"] += 1
+                continue
+
+            slide_patch = patches[0]
+            lm_patch = patches[1] if len(patches) > 1 else None
+            row = _manifest_row(slide_patch, lm_patch, arrays[2], self.output_dir, row_fields)
+            try:
+                with self.metrics.timer("write"):
+                    if save and archive is not None:
+                        _store_sample(writer, slide_patch, encoded, row, row_fields)
+                    elif save:
+                        for path, data in encoded.items():
+                            with open(path, "wb") as patch_file:
+                                patch_file.write(data)
+            except Exception as e:
+                print("Exception while saving patch:", e)
+                rejections["failed_checks"] += 1
+                continue
+            with self.metrics.timer("manifest"):
+                manifest.write_row(row)
+            successful += 1
+        progress.close()
+
+        if n_samples > 0:
+            names = ["select->read", "read->encode", "encode->write"]
+            print("Mean queue depths: " + ", ".join("{} {:.1f}".format(name, total / n_samples)
+                                                    for name, total in zip(names, depth_totals)))
+        return successful
 
     def save_predefined_patches(self, patch_coord_csv, config, x_coord_col="PatchCoordinatesX", y_coord_col="PatchCoordinatesY"):
         """
@@ -414,19 +886,51 @@ class PatchManager:
         value_map = config['value_map']
         patch_size = config['patch_size']
         n_jobs = config['num_workers']
+        executor_type = config['executor']
+        self._start_metrics(config)
+        self.set_target_downsample(get_target_downsample(self.slide_object, config))
+        self.set_output_scales(config['output_scales'])
+        self.set_tile_cache(config['tile_cache_mb'])
+        self.set_encoder(PatchEncoder.from_config(config))
 
         output_dir_slide_folder = os.path.join(self.output_dir, self.slide_folder)
         Path(output_dir_slide_folder).mkdir(parents=True, exist_ok=True)
         # Todo, port to pandas or something more sophisticated?
+        import pandas as pd
         input_df = pd.read_csv(patch_coord_csv)
         for idx, row in input_df.iterrows():
             x, y = row[x_coord_col], row[y_coord_col]
-            patch = Patch(self.img_path, self.slide_object, self, [y, x], 0, patch_size, "_patch_{}-{}.png")
+            patch = self.create_patch([y, x], patch_size)
             self.patches.append(patch)
 
+        self.patches = self.sort_by_tile(self.patches)
+        if self.label_map is not None:
+            self.label_map_patches = [self.pull_from_label_map(patch) for patch in self.patches]
+
+        writer = self._open_writer(config)
+        if writer is not None or (self.label_map is not None and config['fuse_label_map']) or self.output_scales:
             if self.label_map is not None:
-                lm_patch = self.pull_from_label_map(patch)
-                self.label_map_patches.append(lm_patch)
+                patch_pairs = list(zip(self.patches, self.label_map_patches))
+            else:
+                patch_pairs = [(patch,) for patch in self.patches]
+            _save_pair_partial = partial(_save_patch_pair,
+                                         output_directory=output_dir_slide_folder,
+                                         save=True,
+                                         check_if_valid=False,
+                                         value_map=value_map,
+                                         row_fields=self._row_fields(),
+                                         archive=config['output_format'] if writer is not None else None,
+                                         writer=writer if executor_type == "thread" else None)
+            print("Saving slide patches and label maps:")
+            if isinstance(writer, ArrayStoreWriter):
+                writer.reserve(len(patch_pairs))
+            self._run_save_pool(_save_pair_partial, patch_pairs, n_jobs, executor_type,
+                                on_result=partial(self._archive_result, writer))
+            if writer is not None:
+                writer.close()
+            self.print_tile_cache_stats()
+            self._report_metrics(patches_saved=len(patch_pairs))
+            return
 
         _save_patch_partial = partial(_save_patch,
                                       output_directory=output_dir_slide_folder,
@@ -434,14 +938,7 @@ class PatchManager:
                                       check_if_valid=False)
 
         print("Saving slide patches:")
-        with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
-            list(
-                tqdm(
-                    executor.map(_save_patch_partial, self.patches),
-                    total=len(self.patches),
-                    unit="pchs",
-                )
-            )
+        self._run_save_pool(_save_patch_partial, self.patches, n_jobs, executor_type)
 
         if self.label_map is not None:
             print("Saving label maps:")
@@ -451,14 +948,194 @@ class PatchManager:
                                              check_if_valid=False,
                                              patch_processor=get_patch_class_proportions,
                                              value_map=value_map)
-            with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
-                list(
-                    tqdm(
-                        executor.map(_lm_save_patch_partial, self.label_map_patches),
-                        total=len(self.label_map_patches),
-                        unit="pchs",
-                    )
-                )
+            self._run_save_pool(_lm_save_patch_partial, self.label_map_patches, n_jobs, executor_type)
+        self.print_tile_cache_stats()
+        self._report_metrics(patches_saved=len(self.patches))
+
+    def iter_patches(self, config, prefetch=None):
+        """
+        Mine patches and yield them in memory, without writing anything to disk. Useful to feed a training loader or an
+        inference model directly.
+
+        Coordinates are selected lazily (same read_type, overlap_factor and num_patches rules as mine_patches) on a
+        producer thread, and num_workers threads read, check and value-map the patches ahead of the consumer. Queues
+        between them are bounded by prefetch, so memory stays bounded however many patches the slide holds, and
+        selection/reading pause while the consumer is busy. Patches are yielded in completion order.
+        @param config: Config dict, see parse_config().
+        @param prefetch: Maximum number of patches waiting in each queue. Defaults to 2 * num_workers.
+        @return: generator of (coordinates, slide_array, label_array, composition) tuples. label_array is None and
+            composition is "" when no label map is set.
+        """
+        n_patches = config['num_patches']
+        if n_patches == -1:
+            n_patches = np.Inf
+        n_jobs = config['num_workers']
+        if prefetch is None:
+            prefetch = 2 * n_jobs
+        self.set_target_downsample(get_target_downsample(self.slide_object, config))
+        # Samples are yielded at a single scale
+        self.set_output_scales(())
+
+        pipeline = Pipeline(source=self._iter_candidates(config),
+                            stages=[(partial(self._extract_sample, value_map=config['value_map']), n_jobs)],
+                            queue_size=prefetch)
+        n_yielded = 0
+        try:
+            for sample in pipeline:
+                yield sample
+                n_yielded += 1
+                if n_yielded >= n_patches:
+                    break
+        finally:
+            pipeline.close()
+
+    def _iter_candidates(self, config):
+        """
+        Generator of candidate Patch objects, selected one at a time as they are consumed. Like in mine_patches, every
+        read type goes through prefilter_patches, so out of bounds and low tissue candidates are never read.
+        """
+        for candidate in self._iter_selected(config):
+            patches, _ = self.prefilter_patches([candidate], config['patch_size'], config['min_tissue_fraction'])
+            yield from patches
+
+    def _iter_selected(self, config):
+        """
+        Generator of the patches selected by config['read_type'], before prefiltering.
+        """
+        if config['read_type'] == 'grid':
+            coordinates = self.get_grid_coordinates(patch_size=config['patch_size'],
+                                                    overlap_factor=config['overlap_factor'],
+                                                    min_tissue_fraction=config['min_tissue_fraction'])
+            for index in range(len(coordinates)):
+                if self.add_grid_patches(coordinates[index:index + 1],
+                                         patch_size=config['patch_size'],
+                                         overlap_factor=config['overlap_factor']):
+                    yield self.patches.pop()
+        else:
+            while self.find_next_patch(patch_size=config['patch_size'],
+                                       read_type=config['read_type'],
+                                       overlap_factor=config['overlap_factor']):
+                yield self.patches.pop()
+
+    def _extract_sample(self, patch, value_map=None):
+        """
+        Read and check a slide patch, and read its label map patch if there is one.
+        @return: (coordinates, slide_array, label_array, composition), or None if the patch was rejected.
+        """
+        slide_array = patch.extract(check_if_valid=True)
+        if slide_array is None:
+            return None
+
+        lm_array, composition = None, ""
+        if self.label_map is not None:
+            lm_array, composition = _extract_label_map(self.pull_from_label_map(patch), value_map)
+            if lm_array is None:
+                return None
+
+        return patch.coordinates, slide_array, lm_array, composition
+
+    def _open_writer(self, config):
+        """
+        Create the archive writer for the configured output_format.
+        @return: ShardWriter writing to <output_dir>/shards, ArrayStoreWriter writing to <output_dir>/<slide>.zarr, or
+            None when patches are written as individual files.
+        """
+        if config['output_format'] == "png":
+            return None
+        elif config['output_format'] == "tar":
+            return ShardWriter(os.path.join(self.output_dir, "shards"),
+                               self.slide_folder,
+                               max_shard_size=int(config['shard_size_mb'] * 1024 ** 2))
+        elif config['output_format'] == "zarr":
+            return ArrayStoreWriter(os.path.join(self.output_dir, self.slide_folder + ".zarr"))
+        else:
+            raise ValueError("Unrecognized output_format '{}', use either 'png', 'tar' or 'zarr'.".format(
+                config['output_format']))
+
+    def _archive_result(self, writer, result, manifest=None):
+        """
+        Write the members returned by an archive-mode _save_patch_pair task (when the task could not write them itself,
+        e.g. in a worker process), and point its manifest row to the archive instead of individual files.
+        If a manifest is given, the row of every accepted patch is appended to it.
+        """
+        if not result[0]:
+            return
+        if writer is not None and result[5] is not None:
+            with self.metrics.timer("write"):
+                _store_sample(writer, result[1], result[5], result[4], self._row_fields())
+            result[5] = None  # Release the members as soon as they are written
+        if manifest is not None:
+            with self.metrics.timer("manifest"):
+                manifest.write_row(result[4])
+
+    def _row_fields(self):
+        """
+        Manifest settings needed to build a row, in a picklable form that can be sent to workers.
+        """
+        return {"image_header": self.image_header,
+                "mask_header": self.mask_header,
+                "subjectID": self.subjectID if self.save_subjectID else None}
+
+    def _run_save_pool(self, save_partial, items, n_jobs, executor_type="thread", on_result=None):
+        """
+        Run a save task over a list of patches (or tuples of patches, for fused tasks) in parallel.
+
+        With the 'thread' executor, Patch objects are handed to a thread pool as is. With the 'process' executor, each
+        patch travels to the worker as a lightweight PatchRecord; workers open their own slide handles once and send
+        PatchRecords back in place of Patch objects, which are swapped back to the original Patch objects here.
+        @param save_partial: partial of a save task (_save_patch, _save_patch_pair) holding its keyword arguments.
+        @param items: list of Patch objects, or of tuples of Patch objects.
+        @param n_jobs: Number of workers.
+        @param executor_type: 'thread' or 'process'. Ignored if a shared executor was set with set_executor().
+        @param on_result: Optional callable run in this process on every result, in order, as soon as it is available.
+        @return: list of task results (e.g. [bool, Patch, summary]), in the same order as items.
+        """
+        from tqdm import tqdm
+        if self.metrics.enabled:
+            # Worker processes time the tasks with their own collector, merged back here (see _run_task_on_records)
+            save_partial = partial(save_partial, metrics=self.metrics)
+        if self.executor is not None:
+            executor = self.executor
+        elif executor_type == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(n_jobs)
+        elif executor_type == "process":
+            slide_paths = sorted(set(record.slide_path for record in _flatten_records(_to_records(item)
+                                                                                        for item in items)))
+            executor = concurrent.futures.ProcessPoolExecutor(n_jobs,
+                                                              initializer=_open_worker_slides,
+                                                              initargs=(slide_paths,))
+        else:
+            raise ValueError("Unrecognized executor '{}', use either 'thread' or 'process'.".format(executor_type))
+
+        results = []
+        try:
+            if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+                records = [_to_records(item) for item in items]
+                task_kwargs = {key: value for key, value in save_partial.keywords.items() if key != "metrics"}
+                _record_partial = partial(_run_task_on_records,
+                                          task=save_partial.func,
+                                          checks=self.valid_patch_checks,
+                                          tile_cache_bytes=self.tile_cache.max_bytes if self.tile_cache else 0,
+                                          collect_metrics=self.metrics.enabled,
+                                          **task_kwargs)
+                chunksize = max(1, len(records) // (n_jobs * 4))
+                worker_results = executor.map(_record_partial, records, chunksize=chunksize)
+                for (result, snapshot), item in tqdm(zip(worker_results, items), total=len(records), unit="pchs"):
+                    self.metrics.merge(snapshot)
+                    result = _restore_patches(result, item)
+                    if on_result is not None:
+                        on_result(result)
+                    results.append(result)
+            else:
+                for result in tqdm(executor.map(save_partial, items), total=len(items), unit="pchs"):
+                    if on_result is not None:
+                        on_result(result)
+                    results.append(result)
+        finally:
+            # A shared executor outlives this call, only shut down the ones created here
+            if executor is not self.executor:
+                executor.shutdown()
+        return results
 
     def pull_from_label_map(self, slide_patch):
         """
@@ -469,14 +1146,286 @@ class PatchManager:
         lm_patch = slide_patch.copy()
         lm_patch.set_slide(self.label_map)
         lm_patch.slide_object = self.label_map_object
-        lm_patch.output_suffix = "_patch_{}-{}_LM.png"
+        lm_patch.encoder = self.encoder.label_map_encoder()
+        lm_patch.output_suffix = "_patch_{}-{}_LM." + lm_patch.encoder.extension
+        # The label map's pyramid may differ from the slide's. Never interpolate between label values.
+        lm_patch.level, lm_patch.size = self._read_geometry(self.label_map_object, slide_patch.output_size)
+        lm_patch.scales = self._scale_geometry(self.label_map_object, slide_patch.coordinates, slide_patch.output_size)
+        from PIL import Image
+        lm_patch.resample = Image.NEAREST
 
         return lm_patch
 
 
-def _save_patch(patch, output_directory, save, check_if_valid=True, patch_processor=None, value_map=None):
+def _save_patch(patch, output_directory, save, check_if_valid=True, patch_processor=None, value_map=None, checks=None,
+                metrics=None):
     return patch.save(out_dir=output_directory,
                       save=save,
                       check_if_valid=check_if_valid,
                       process_method=patch_processor,
-                      value_map=value_map)
+                      value_map=value_map,
+                      checks=checks,
+                      metrics=metrics)
+
+
+def _save_patch_pair(patches, output_directory, save, row_fields, check_if_valid=True, value_map=None, checks=None,
+                     archive=None, writer=None, metrics=None):
+    """
+    Fused save task: check and save a slide patch, then save its label map patch and build the manifest row.
+    @param patches: tuple of (slide Patch, label map Patch) at the same coordinates, or (slide Patch,) alone.
+    @param archive: Archive output_format ('tar', 'zarr'), or None to write individual files.
+    @param writer: Archive writer to store the sample with. In archive mode without a writer (e.g. in a worker process)
+        nothing is written here; the members are returned for the caller to archive.
+    @return: A list [bool, slide Patch, label map Patch, summary, row, members]. row is None if the patch was rejected,
+        members holds the sample's archive members if they still have to be written, None otherwise.
+    """
+    metrics = NULL_METRICS if metrics is None else metrics
+    slide_patch = patches[0]
+    lm_patch = patches[1] if len(patches) > 1 else None
+
+    arrays = _read_patch_pair(patches, check_if_valid=check_if_valid, value_map=value_map, checks=checks,
+                              metrics=metrics)
+    if arrays is None:
+        return [False, slide_patch, lm_patch, "", None, None]
+    slide_arrays, lm_arrays, composition = arrays
+
+    # Extra scales, in the same order as slide_patch.scales
+    factors = [scale[0] for scale in slide_patch.scales]
+    row = _manifest_row(slide_patch, lm_patch, composition, output_directory, row_fields)
+    members = None
+    try:
+        if save and archive is not None:
+            with metrics.timer("encode"):
+                members = encode_members(archive, slide_arrays[0], lm_arrays[0], composition,
+                                         scales=dict(zip(factors, zip(slide_arrays[1:], lm_arrays[1:]))),
+                                         encoder=slide_patch.encoder)
+            if writer is not None:
+                with metrics.timer("write"):
+                    _store_sample(writer, slide_patch, members, row, row_fields)
+                members = None
+        elif save:
+            for factor, slide_array, lm_array in zip([None] + factors, slide_arrays, lm_arrays):
+                slide_patch.write(slide_array, output_directory, scale=factor, metrics=metrics)
+                if lm_array is not None:
+                    lm_patch.write(lm_array, output_directory, scale=factor, metrics=metrics)
+    except Exception as e:
+        print("Exception while saving patch:", e)
+        return [False, slide_patch, lm_patch, "", None, None]
+
+    return [True, slide_patch, lm_patch, composition, row, members]
+
+
+def _read_patch_pair(patches, check_if_valid=True, value_map=None, checks=None, metrics=None):
+    """
+    Read and check a slide patch, then read its label map patch and apply the value map, with their extra scales.
+    @param patches: tuple of (slide Patch, label map Patch) at the same coordinates, or (slide Patch,) alone.
+    @return: (list of slide ndarrays, list of label map ndarrays or Nones, composition string), or None if the patch was
+        rejected.
+    """
+    slide_arrays = patches[0].extract_scales(check_if_valid=check_if_valid, checks=checks, metrics=metrics)
+    if slide_arrays is None:
+        return None
+
+    lm_arrays, composition = [None] * len(slide_arrays), ""
+    if len(patches) > 1:
+        lm_arrays, composition = _extract_label_map_scales(patches[1], value_map, metrics=metrics)
+        if lm_arrays is None:
+            return None
+    return slide_arrays, lm_arrays, composition
+
+
+def _read_stage(patches, value_map=None, metrics=None):
+    """
+    Read stage of PatchManager._save_pipelined().
+    @return: (patches, arrays) where arrays is the result of _read_patch_pair().
+    """
+    return patches, _read_patch_pair(patches, value_map=value_map, metrics=metrics)
+
+
+def _encode_stage(item, output_directory, save, archive=None, metrics=None):
+    """
+    Encode stage of PatchManager._save_pipelined(): encode a sample for the write stage.
+    @param item: (patches, arrays) from _read_stage().
+    @param archive: Archive output_format ('tar', 'zarr'), or None to write individual files.
+    @return: (patches, arrays, encoded). encoded holds the sample's archive members in archive mode, or a dict of file
+        path => encoded bytes otherwise, and is None for rejected patches or when nothing is saved.
+    """
+    patches, arrays = item
+    if arrays is None or not save:
+        return patches, arrays, None
+
+    slide_arrays, lm_arrays, composition = arrays
+    factors = [None] + [scale[0] for scale in patches[0].scales]
+    with (NULL_METRICS if metrics is None else metrics).timer("encode"):
+        if archive is not None:
+            return patches, arrays, encode_members(archive, slide_arrays[0], lm_arrays[0], composition,
+                                                   scales=dict(zip(factors[1:], zip(slide_arrays[1:], lm_arrays[1:]))),
+                                                   encoder=patches[0].encoder)
+
+        encoded = {}
+        for factor, slide_array, lm_array in zip(factors, slide_arrays, lm_arrays):
+            encoded[patches[0].get_patch_path(output_directory, scale=factor)] = patches[0].encoder.encode(slide_array)
+            if lm_array is not None:
+                encoded[patches[1].get_patch_path(output_directory, scale=factor)] = \
+                    patches[1].encoder.encode(lm_array)
+        return patches, arrays, encoded
+
+
+def _extract_label_map(lm_patch, value_map=None):
+    """
+    Read a label map patch, apply the value map and compute its composition in one go.
+    @return: (label map ndarray, composition string), or (None, "") if it could not be read.
+    """
+    lm_arrays, composition = _extract_label_map_scales(lm_patch, value_map)
+    return (None, "") if lm_arrays is None else (lm_arrays[0], composition)
+
+
+def _extract_label_map_scales(lm_patch, value_map=None, metrics=None):
+    """
+    Same as _extract_label_map, for the label map patch and its extra scales. The composition is the patch's own.
+    @return: (list of label map ndarrays, composition string), or (None, "") if it could not be read.
+    """
+    metrics = NULL_METRICS if metrics is None else metrics
+    lm_arrays = lm_patch.extract_scales(check_if_valid=False, metrics=metrics)
+    if lm_arrays is None:
+        return None, ""
+    with metrics.timer("value_map"):
+        if not isinstance(value_map, dict):
+            lm_array, composition = map_values_with_proportions(lm_arrays[0])
+            return [lm_array] + lm_arrays[1:], composition
+
+        # Label maps are mapped on their first channel only
+        lm_arrays = [lm_array[:, :, 0] if lm_array.ndim == 3 else lm_array for lm_array in lm_arrays]
+        lm_array, composition = map_values_with_proportions(lm_arrays[0], value_map)
+        return [lm_array] + [map_values(array, value_map) for array in lm_arrays[1:]], composition
+
+
+def _store_sample(writer, slide_patch, members, row, row_fields):
+    """
+    Write a sample's members with an archive writer and point its manifest row to where they were stored.
+    """
+    location = writer.write_sample(slide_patch.get_archive_key(), members, coordinates=slide_patch.coordinates)
+    if location["lm"] is not None:
+        row.update({row_fields["image_header"]: location["slide"],
+                    row_fields["mask_header"]: location["lm"]})
+    row.update({"SlidePatchPath": location["slide"]})
+    for factor, _, _, _ in slide_patch.scales:
+        slide_name, lm_name = member_names(writer.output_format, factor, slide_patch.encoder)
+        row.update({_scale_column("SlidePatchPath", factor): location["members"][slide_name]})
+        if lm_name in location["members"]:
+            row.update({_scale_column(row_fields["mask_header"], factor): location["members"][lm_name]})
+    row.update(location["columns"])
+
+
+def _scale_column(header, factor):
+    """
+    Manifest column of an extra scale, e.g. SlidePatchPath_x2.
+    """
+    return "{}_x{:g}".format(header, factor)
+
+
+def _manifest_row(slide_patch, lm_patch, composition, output_directory, row_fields):
+    """
+    Build the output csv row of an accepted patch.
+    @param lm_patch: Label map Patch, or None if there is no label map.
+    @param composition: Label map summary string (see get_patch_class_proportions).
+    @param row_fields: dict from PatchManager._row_fields().
+    @return: dict
+    """
+    new_row = {}
+    if row_fields["subjectID"] is not None:
+        new_row.update({"SubjectID": row_fields["subjectID"]})
+    if lm_patch is not None:
+        new_row.update({row_fields["image_header"]: slide_patch.get_patch_path(output_directory, False),
+                        row_fields["mask_header"]: lm_patch.get_patch_path(output_directory, False),
+                        "PatchComposition": composition})
+
+    new_row.update({"SlidePatchPath": slide_patch.get_patch_path(output_directory, False)})
+    for factor, _, _, _ in slide_patch.scales:
+        new_row.update({_scale_column("SlidePatchPath", factor):
+                        slide_patch.get_patch_path(output_directory, False, scale=factor)})
+        if lm_patch is not None:
+            new_row.update({_scale_column(row_fields["mask_header"], factor):
+                            lm_patch.get_patch_path(output_directory, False, scale=factor)})
+
+    patch_coords = slide_patch.coordinates
+    new_row.update({"PatchCoordinatesX": patch_coords[1]})
+    new_row.update({"PatchCoordinatesY": patch_coords[0]})
+    return new_row
+
+
+# Slide handles opened by each process-pool worker, keyed by slide path. A worker of a pool shared between slides only
+# keeps the most recently used handles open.
+_worker_slides = {}
+_MAX_WORKER_SLIDES = 8
+# Decoded tile cache shared by the slides of a worker, when enabled
+_worker_tile_cache = None
+
+
+def _open_worker_slides(slide_paths):
+    """
+    Process-pool initializer: open every slide this worker will read from once, up front.
+    """
+    for slide_path in slide_paths:
+        _get_worker_slide(slide_path)
+
+
+def _get_worker_slide(slide_path, tile_cache_bytes=0):
+    global _worker_tile_cache
+    slide = _worker_slides.pop(slide_path, None)
+    if slide is None:
+        if len(_worker_slides) >= _MAX_WORKER_SLIDES:
+            oldest = next(iter(_worker_slides))
+            _worker_slides.pop(oldest).close()
+        import tiffslide
+        slide = tiffslide.open_slide(slide_path)
+    if tile_cache_bytes > 0 and not isinstance(slide, CachedSlide):
+        if _worker_tile_cache is None or _worker_tile_cache.max_bytes != tile_cache_bytes:
+            _worker_tile_cache = TileCache(tile_cache_bytes)
+        slide = CachedSlide(slide, _worker_tile_cache, name=slide_path)
+    # Re-insert so the dict stays ordered from least to most recently used
+    _worker_slides[slide_path] = slide
+    return slide
+
+
+def _to_records(item):
+    if isinstance(item, Patch):
+        return item.to_record()
+    return tuple(patch.to_record() for patch in item)
+
+
+def _flatten_records(records):
+    for record in records:
+        if isinstance(record, PatchRecord):
+            yield record
+        else:
+            yield from record
+
+
+def _run_task_on_records(records, task, tile_cache_bytes=0, collect_metrics=False, **task_kwargs):
+    """
+    Process-pool side of _run_save_pool: rebuild patches from records, run the save task, and replace the Patch objects
+    in its result by their records so the result can be pickled back to the parent.
+    @param collect_metrics: Time the task with a MetricsCollector of this worker.
+    @return: (result, snapshot of the task's metrics or None)
+    """
+    metrics = MetricsCollector() if collect_metrics else None
+    if metrics is not None:
+        task_kwargs["metrics"] = metrics
+    if isinstance(records, PatchRecord):
+        patches = Patch.from_record(records, _get_worker_slide(records.slide_path, tile_cache_bytes))
+    else:
+        patches = tuple(Patch.from_record(record, _get_worker_slide(record.slide_path, tile_cache_bytes))
+                        for record in records)
+    result = task(patches, **task_kwargs)
+    return ([value.to_record() if isinstance(value, Patch) else value for value in result],
+            metrics.snapshot() if metrics is not None else None)
+
+
+def _restore_patches(result, item):
+    """
+    Swap the PatchRecords in a worker result back to the parent's Patch objects.
+    """
+    patches = [item] if isinstance(item, Patch) else list(item)
+    lookup = {patch.to_record(): patch for patch in patches}
+    return [lookup.get(value, value) if isinstance(value, PatchRecord) else value for value in result]
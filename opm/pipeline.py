@@ -0,0 +1,137 @@
+import queue
+import threading
+
+# Marks the end of the stream on a queue
+_DONE = object()
+
+
+class Pipeline:
+    def __init__(self, source, stages, queue_size=16):
+        """
+        Producer/consumer pipeline of worker threads connected by bounded queues.
+
+        One thread pulls items from source into the first queue. Each stage is served by its own pool of threads, which
+        take items from the stage's input queue, process them and put the results on the next queue. Iterating over
+        the pipeline yields the results of the last stage as they become available (not necessarily in source order).
+        Since every queue is bounded, a slow consumer stalls the stages before it (backpressure), and at most about
+        queue_size items per queue (plus one per worker) are held in memory at any time.
+        @param source: Iterable of items. Only iterated from the source thread.
+        @param stages: list of (function, n_workers). function(item) returns the item for the next stage, or None to drop
+            it.
+        @param queue_size: Maximum number of items waiting in each queue.
+        """
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self._stop = threading.Event()
+        self._error = None
+        self._remaining_workers = [n_workers for _, n_workers in stages]
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._run_source, daemon=True))
+        for index, (function, n_workers) in enumerate(self.stages):
+            for _ in range(n_workers):
+                self._threads.append(threading.Thread(target=self._run_stage, args=(index, function), daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _put(self, q, item):
+        """
+        Put an item on a queue, waiting for room unless the pipeline is stopped.
+        @return: False if the pipeline was stopped before the item could be queued.
+        """
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        """
+        Get an item from a queue, waiting for one unless the pipeline is stopped.
+        @return: The item, or _DONE if the pipeline was stopped.
+        """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _finish(self, index):
+        """
+        Tell the consumers of queue index that one more producer has finished.
+        """
+        n_consumers = self.stages[index][1] if index < len(self.stages) else 1
+        for _ in range(n_consumers):
+            if not self._put(self.queues[index], _DONE):
+                return
+
+    def _run_source(self):
+        try:
+            for item in self.source:
+                if not self._put(self.queues[0], item):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        self._finish(0)
+
+    def _run_stage(self, index, function):
+        while True:
+            item = self._get(self.queues[index])
+            if item is _DONE:
+                break
+            try:
+                result = function(item)
+            except Exception as e:
+                self._fail(e)
+                return
+            if result is not None and not self._put(self.queues[index + 1], result):
+                return
+
+        # The last worker of the stage to finish passes the end of the stream on
+        with self._lock:
+            self._remaining_workers[index] -= 1
+            last = self._remaining_workers[index] == 0
+        if last:
+            self._finish(index + 1)
+
+    def queue_depths(self):
+        """
+        Number of items currently waiting in each queue: [source -> stage 0, stage 0 -> stage 1, ..., last -> output].
+        """
+        return [q.qsize() for q in self.queues]
+
+    def __iter__(self):
+        if not self._threads:
+            self.start()
+        try:
+            while True:
+                item = self._get(self.queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.close()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """
+        Stop every thread of the pipeline and wait for them to exit. Items still in flight are dropped.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Block size used for levels that are not stored as tiles (e.g. strips)
+DEFAULT_TILE_SIZE = 512
+
+
+class TileCache:
+    def __init__(self, max_bytes):
+        """
+        Thread-safe LRU cache of decoded tiles, bounded by the total size of the cached arrays.
+        @param max_bytes: Maximum number of bytes of tile data kept in memory.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        Get a tile, decoding it with load() on a miss.
+        @param key: Hashable tile identifier.
+        @param load: Function returning the tile's ndarray.
+        @return: ndarray of the tile. Shared between readers, so it must not be modified.
+        """
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        # Decode outside the lock so other readers aren't blocked. Two readers missing the same tile both decode it.
+        tile = load()
+        with self._lock:
+            if key not in self._tiles and tile.nbytes <= self.max_bytes:
+                self._tiles[key] = tile
+                self.size += tile.nbytes
+                while self.size > self.max_bytes:
+                    _, evicted = self._tiles.popitem(last=False)
+                    self.size -= evicted.nbytes
+        return tile
+
+    def stats(self):
+        """
+        @return: dict with hits, misses, hit_rate and the current size in bytes.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0,
+                    "bytes": self.size}
+
+
+class CachedSlide:
+    def __init__(self, slide, cache, name=None):
+        """
+        Wrapper around a tiffslide slide that serves read_region from the slide's native tiles, through a TileCache.
+        Overlapping or adjacent reads then decode each tile once instead of once per read. Everything else is passed
+        through to the wrapped slide.
+        @param slide: tiffslide slide object.
+        @param cache: TileCache, can be shared between slides.
+        @param name: Name of the slide in the cache keys, defaults to the wrapped object's id.
+        """
+        self.slide = slide
+        self.cache = cache
+        self.name = id(slide) if name is None else name
+        self.tile_sizes = []
+        for level in range(slide.level_count):
+            width = slide.properties.get("tiffslide.level[{}].tile-width".format(level))
+            height = slide.properties.get("tiffslide.level[{}].tile-height".format(level))
+            self.tile_sizes.append((int(width or DEFAULT_TILE_SIZE), int(height or DEFAULT_TILE_SIZE)))
+
+    def __getattr__(self, name):
+        return getattr(self.slide, name)
+
+    def get_tile_index(self, location, level):
+        """
+        Native tile containing a level 0 location at a level, used to order reads along the tile grid.
+        @return: (tile row, tile column)
+        """
+        downsample = self.slide.level_downsamples[level]
+        tile_width, tile_height = self.tile_sizes[level]
+        return int(location[1] / downsample) // tile_height, int(location[0] / downsample) // tile_width
+
+    def _load_tile(self, level, tile_x, tile_y):
+        downsample = self.slide.level_downsamples[level]
+        level_width, level_height = self.slide.level_dimensions[level]
+        tile_width, tile_height = self.tile_sizes[level]
+        x, y = tile_x * tile_width, tile_y * tile_height
+        # Smallest level 0 location that read_region maps back onto this tile's first pixel
+        location = (int(np.ceil(x * downsample)), int(np.ceil(y * downsample)))
+        size = (min(tile_width, level_width - x), min(tile_height, level_height - y))
+        return self.slide.read_region(location, level, size, as_array=True)
+
+    def read_region(self, location, level, size, as_array=False, padding=True):
+        """
+        Same as tiffslide's read_region (location in level 0 pixels, size in pixels of the level), assembled from
+        cached tiles. Regions extending past the slide are padded with zeros.
+        """
+        if not padding or not 0 <= level < self.slide.level_count:
+            return self.slide.read_region(location, level, size, as_array=as_array, padding=padding)
+
+        downsample = self.slide.level_downsamples[level]
+        level_width, level_height = self.slide.level_dimensions[level]
+        tile_width, tile_height = self.tile_sizes[level]
+        width, height = int(size[0]), int(size[1])
+        x0, y0 = int(int(location[0]) / downsample), int(int(location[1]) / downsample)
+        x1, y1 = x0 + width, y0 + height
+
+        region = None
+        for tile_y in range(max(y0, 0) // tile_height, (min(y1, level_height) - 1) // tile_height + 1):
+            for tile_x in range(max(x0, 0) // tile_width, (min(x1, level_width) - 1) // tile_width + 1):
+                # Overlap of the tile and the region, in level pixels. Edge tiles are partial, so a region starting
+                # past the end of the level can still fall in the last tile's range without overlapping it.
+                left, top = max(x0, tile_x * tile_width), max(y0, tile_y * tile_height)
+                right = min(x1, tile_x * tile_width + tile_width, level_width)
+                bottom = min(y1, tile_y * tile_height + tile_height, level_height)
+                if right <= left or bottom <= top:
+                    continue
+                tile = self.cache.get((self.name, level, tile_x, tile_y),
+                                      lambda: self._load_tile(level, tile_x, tile_y))
+                if region is None:
+                    region = np.zeros((height, width, tile.shape[2]), dtype=tile.dtype)
+                region[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile[top - tile_y * tile_height:bottom - tile_y * tile_height,
+                         left - tile_x * tile_width:right - tile_x * tile_width]
+
+        if region is None:
+            # Entirely outside the slide
+            return self.slide.read_region(location, level, size, as_array=as_array, padding=padding)
+        if as_array:
+            return region
+        image = Image.fromarray(region[..., 0] if region.shape[2] == 1 else region)
+        profile = getattr(self.slide, "_profile", None)
+        if profile is not None:
+            image.info['icc_profile'] = profile
+        return image
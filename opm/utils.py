@@ -1,12 +1,13 @@
+import os
+import sys
+import time
 import numpy as np
-from skimage.filters.rank import maximum
-from skimage.filters import gaussian
-from skimage.morphology.footprints import disk
-from skimage.morphology import remove_small_objects, remove_small_holes
-from skimage.color.colorconv import rgb2hsv
-import matplotlib.pyplot as plt
-import yaml
-import tiffslide
+from functools import lru_cache
+from PIL import Image
+
+# matplotlib, skimage, scipy, yaml and tiffslide are imported by the functions that use them: most code paths (e.g.
+# replaying coordinates from a csv, or mining from a cached mask) need only a few of them, and importing them all takes
+# longer than many short per-slide jobs spend on actual work.
 
 # RGB Masking (pen) constants
 RGB_RED_CHANNEL = 0
@@ -21,6 +22,25 @@ HSV_VAL_CHANNEL = 2
 MIN_SAT = 20 / 255
 MIN_VAL = 30 / 255
 
+# Tissue Masking (hue range)
+TISSUE_MIN_HUE = 0.8
+TISSUE_MAX_HUE = 0.99
+TISSUE_MIN_SAT = 0.05
+
+# Masks are computed in row strips of about this many pixels, so hue, saturation and smoothing never hold more than a
+# strip of float64 data. Smoothed strips are read with GAUSSIAN_HALO rows of context on each side, the reach of
+# gaussian(sigma=1, truncate=4), so the result is identical to processing the whole image.
+MASK_STRIP_PIXELS = 2 ** 21
+GAUSSIAN_HALO = 4
+
+# Pen Masking
+PEN_SIZE_THRESHOLD = 200
+PEN_MASK_EXPANSION = 5
+
+# Thumbnails: levels larger than this are downsampled block by block rather than decoded whole
+MAX_THUMBNAIL_LEVEL_BYTES = 1024 ** 3
+THUMBNAIL_BLOCK_SIZE = 4096
+
 # LAB Masking
 LAB_L_CHANNEL = 0
 LAB_A_CHANNEL = 1
@@ -67,12 +87,41 @@ def get_patch_class_proportions(image):
     @return: fraction of image that is not zero.
     """
     np_img = np.asarray(image)
-    unique, counts = np.unique(image, return_counts=True)
     denom = np_img.shape[0] * np_img.shape[1]
-    prop_dict = {val: count / denom for val, count in list(zip(unique, counts))}
+    if np_img.dtype in LUT_DTYPES:
+        # Histogram instead of np.unique, which has to sort the whole patch
+        counts = np.bincount(np_img.ravel())
+        return _format_proportions(np.flatnonzero(counts), counts[counts > 0], denom)
+    unique, counts = np.unique(np_img, return_counts=True)
+    return _format_proportions(unique, counts, denom)
+
+
+def _format_proportions(values, counts, denom):
+    prop_dict = {val: count / denom for val, count in list(zip(values, counts))}
     return print_sorted_dict(prop_dict)
 
 
+# Integer label map types small enough to be mapped through a full lookup table (256 / 65536 entries)
+LUT_DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16))
+
+
+@lru_cache(maxsize=32)
+def _value_lut(items, dtype):
+    """
+    Lookup table applying a value map to every value of an integer dtype. Cached, as the same map is used for every
+    patch of a run.
+    @param items: tuple of (key, value) pairs of the value map.
+    @param dtype: numpy dtype of the label map, one of LUT_DTYPES.
+    """
+    lut = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    for key, value in items:
+        # Keys that can't occur in this dtype can't be swapped either
+        if 0 <= key < len(lut):
+            lut[key] = value
+    lut.flags.writeable = False
+    return lut
+
+
 def map_values(image, dictionary):
     """
     Modify image by swapping dictionary keys to dictionary values.
@@ -80,6 +129,9 @@ def map_values(image, dictionary):
     @param dictionary: dict(int => int). Keys in image are swapped to corresponding values.
     @return:
     """
+    if image.dtype in LUT_DTYPES:
+        return _value_lut(tuple(dictionary.items()), image.dtype)[image]
+
     template = image.copy()  # Copy image so all values not in dict are unmodified
     for key, value in dictionary.items():
         template[image == key] = value
@@ -87,22 +139,86 @@ def map_values(image, dictionary):
     return template
 
 
+def map_values_with_proportions(image, dictionary=None):
+    """
+    Apply map_values() and compute get_patch_class_proportions() of the result together. For uint8/uint16 label maps,
+    the histogram is taken once on the original patch and folded through the lookup table, so the mapped patch is
+    never scanned again.
+    @param image: Numpy ndarray of the label map patch.
+    @param dictionary: dict(int => int) value map, or None to leave the patch as is.
+    @return: (mapped image, composition string)
+    """
+    if dictionary is None:
+        return image, get_patch_class_proportions(image)
+    if image.dtype not in LUT_DTYPES:
+        mapped = map_values(image, dictionary)
+        return mapped, get_patch_class_proportions(mapped)
+
+    lut = _value_lut(tuple(dictionary.items()), image.dtype)
+    counts = np.bincount(image.ravel())
+    mapped_counts = np.bincount(lut[:len(counts)], weights=counts).astype(np.int64)
+    composition = _format_proportions(np.flatnonzero(mapped_counts), mapped_counts[mapped_counts > 0],
+                                      image.shape[0] * image.shape[1])
+    return lut[image], composition
+
+
 def display_overlay(image, mask):
+    import matplotlib.pyplot as plt
     overlay = image.copy()
     overlay[~mask] = (overlay[~mask] // 1.5).astype(np.uint8)
     plt.imshow(overlay)
     plt.show()
 
 
-def hue_range_mask(image, min_hue, max_hue, sat_min=0.05):
-    hsv_image = rgb2hsv(image)
-    h_channel = gaussian(hsv_image[:, :, HSV_HUE_CHANNEL])
-    above_min = h_channel > min_hue
-    below_max = h_channel < max_hue
+def iter_mask_strips(image, halo=0):
+    """
+    Split an image into row strips of about MASK_STRIP_PIXELS pixels.
+    :param image: numpy image
+    :param halo: Rows of context to add above and below each strip, clipped to the image
+    :return: generator of (strip with its halo, slice of the strip's own rows within the image, slice of the same rows
+        within the strip)
+    """
+    height, width = image.shape[:2]
+    rows = max(1, MASK_STRIP_PIXELS // max(width, 1))
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        halo_start, halo_stop = max(start - halo, 0), min(stop + halo, height)
+        yield image[halo_start:halo_stop], slice(start, stop), slice(start - halo_start, stop - halo_start)
+
+
+def hue_saturation(image):
+    """
+    Hue and saturation of an RGB image as rgb2hsv computes them, without building the HSV image: both are derived from
+    the per-pixel maximum, minimum and chroma of the channels, with the same float conversion and operations as rgb2hsv
+    so thresholds on them give the same result.
+    :param image: RGB(A) numpy image
+    :return: (hue, saturation) float arrays in [0, 1], float64 for integer images
+    """
+    from skimage.util import img_as_float
+    red, green, blue = (img_as_float(image[:, :, channel]) for channel in range(3))
+    maximum = np.maximum(np.maximum(red, green), blue)
+    chroma = maximum - np.minimum(np.minimum(red, green), blue)
+    divisor = np.where(chroma > 0, chroma, 1)
+    # Where channels tie for the maximum, blue wins over green and green over red, as in rgb2hsv
+    hue = np.where(blue == maximum, 4.0 + (red - green) / divisor,
+                   np.where(green == maximum, 2.0 + (blue - red) / divisor, (green - blue) / divisor))
+    hue = (hue / 6.0) % 1.0
+    # Gray pixels have a hue and saturation of 0
+    hue[chroma == 0] = 0
+    saturation = chroma / np.where(maximum > 0, maximum, 1)
+    return hue, saturation
 
-    s_channel = gaussian(hsv_image[:, :, HSV_SAT_CHANNEL])
-    above_sat = s_channel > sat_min
-    return np.logical_and(np.logical_and(above_min, below_max), above_sat)
+
+def hue_range_mask(image, min_hue, max_hue, sat_min=0.05):
+    from scipy.ndimage import gaussian_filter
+    mask = np.empty(image.shape[:2], dtype=bool)
+    for strip, rows, inner in iter_mask_strips(image, halo=GAUSSIAN_HALO):
+        hue, saturation = hue_saturation(strip)
+        # Same smoothing as skimage's gaussian() defaults
+        hue = gaussian_filter(hue, sigma=1, mode="nearest", truncate=4.0)[inner]
+        saturation = gaussian_filter(saturation, sigma=1, mode="nearest", truncate=4.0)[inner]
+        mask[rows] = (hue > min_hue) & (hue < max_hue) & (saturation > sat_min)
+    return mask
 
 
 def tissue_mask(image):
@@ -110,30 +226,40 @@ def tissue_mask(image):
     Quick and dirty hue range mask for OPM. Works well on H&E.
     TODO: Improve this
     """
-    hue_mask = hue_range_mask(image, 0.8, 0.99)
+    from skimage.morphology import remove_small_holes
+    hue_mask = hue_range_mask(image, TISSUE_MIN_HUE, TISSUE_MAX_HUE, TISSUE_MIN_SAT)
     final_mask = remove_small_holes(hue_mask)
     return final_mask
 
 
 def basic_pen_mask(image, pen_size_threshold, pen_mask_expansion):
-    green_mask = np.bitwise_and(
-        image[:, :, RGB_GREEN_CHANNEL] > image[:, :, RGB_GREEN_CHANNEL],
-        image[:, :, RGB_GREEN_CHANNEL] - image[:, :, RGB_GREEN_CHANNEL]
-        > MIN_COLOR_DIFFERENCE,
-    )
+    from skimage.morphology import remove_small_objects
+    from skimage.morphology.footprints import disk
+    from scipy.ndimage import binary_dilation
+    masked_pen = np.empty(image.shape[:2], dtype=bool)
+    for strip, rows, _ in iter_mask_strips(image):
+        # The green mask compared green against itself, so it was always empty: only blue pens are masked
+        green = strip[:, :, RGB_GREEN_CHANNEL]
+        blue = strip[:, :, RGB_BLUE_CHANNEL]
+        masked_pen[rows] = (blue > green) & (blue - green > MIN_COLOR_DIFFERENCE)
 
-    blue_mask = np.bitwise_and(
-        image[:, :, RGB_BLUE_CHANNEL] > image[:, :, RGB_GREEN_CHANNEL],
-        image[:, :, RGB_BLUE_CHANNEL] - image[:, :, RGB_GREEN_CHANNEL]
-        > MIN_COLOR_DIFFERENCE,
-    )
-
-    masked_pen = np.bitwise_or(green_mask, blue_mask)
     new_mask_image = remove_small_objects(masked_pen, pen_size_threshold)
+    # A maximum filter of a binary image is its dilation; pixels outside the image don't count, as with rank filters
+    return binary_dilation(new_mask_image, structure=disk(pen_mask_expansion).astype(bool))
 
-    return maximum(np.where(new_mask_image, 1, 0), disk(pen_mask_expansion)).astype(
-        bool
-    )
+
+@lru_cache(maxsize=None)
+def _low_saturation_value_table():
+    """
+    basic_hsv_mask's result for every (maximum, minimum) pair of uint8 channels, computed in float64 as rgb2hsv does,
+    so pixels lying exactly on a threshold (e.g. a saturation of 20/255) end up on the same side.
+    :return: bool ndarray of shape (256, 256), indexed by [maximum, minimum]
+    """
+    values = np.arange(256) / 255
+    maximum, minimum = values[:, None], values[None, :]
+    delta = maximum - minimum
+    saturation = np.where(delta > 0, delta / np.where(maximum > 0, maximum, 1), 0)
+    return (saturation <= MIN_SAT) | (maximum <= MIN_VAL)
 
 
 def basic_hsv_mask(image):
@@ -142,15 +268,24 @@ def basic_hsv_mask(image):
     :param image: RGB numpy image
     :return: image mask, True pixels are gray-black.
     """
-    hsv_image = rgb2hsv(image)
-    return np.bitwise_or(
-        hsv_image[:, :, HSV_SAT_CHANNEL] <= MIN_SAT,
-        hsv_image[:, :, HSV_VAL_CHANNEL] <= MIN_VAL,
-    )
-
-
-def hybrid_mask(image):
-    return ~np.bitwise_or(basic_hsv_mask(image), basic_pen_mask(image))
+    mask = np.empty(image.shape[:2], dtype=bool)
+    for strip, rows, _ in iter_mask_strips(image):
+        # Saturation and value only depend on the largest and smallest channel
+        maximum = np.maximum(np.maximum(strip[:, :, 0], strip[:, :, 1]), strip[:, :, 2])
+        minimum = np.minimum(np.minimum(strip[:, :, 0], strip[:, :, 1]), strip[:, :, 2])
+        if image.dtype == np.uint8:
+            mask[rows] = _low_saturation_value_table()[maximum, minimum]
+            continue
+        from skimage.util import img_as_float
+        # Same float conversion as rgb2hsv, which is monotonic so it commutes with the maximum and minimum
+        maximum, minimum = img_as_float(maximum), img_as_float(minimum)
+        saturation = (maximum - minimum) / np.where(maximum > 0, maximum, 1)
+        mask[rows] = (saturation <= MIN_SAT) | (maximum <= MIN_VAL)
+    return mask
+
+
+def hybrid_mask(image, pen_size_threshold=PEN_SIZE_THRESHOLD, pen_mask_expansion=PEN_MASK_EXPANSION):
+    return ~np.bitwise_or(basic_hsv_mask(image), basic_pen_mask(image, pen_size_threshold, pen_mask_expansion))
 
 
 def trim_mask(image, mask, background_value=0, mask_func=hybrid_mask):
@@ -204,6 +339,7 @@ def parse_config(config_file):
     :param config_file: path to config file
     :return: dictionary of config values
     """
+    import yaml
     config = yaml.load(open(config_file), Loader=yaml.FullLoader)
 
     # initialize defaults
@@ -221,34 +357,163 @@ def parse_config(config_file):
         config["read_type"] = "random"
     if not ("overlap_factor" in config):
         config["overlap_factor"] = 0.0
+    if not ("min_tissue_fraction" in config):
+        config["min_tissue_fraction"] = 0.0
+    if not ("executor" in config):
+        config["executor"] = "thread"
+    if not ("fuse_label_map" in config):
+        config["fuse_label_map"] = False
+    if not ("output_format" in config):
+        config["output_format"] = "png"
+    if not ("shard_size_mb" in config):
+        config["shard_size_mb"] = 1024
+    if not ("patch_format" in config):
+        config["patch_format"] = "png"
+    if not ("compress_level" in config):
+        config["compress_level"] = 6
+    if not ("jpeg_quality" in config):
+        config["jpeg_quality"] = 90
+    if not ("checkpoint_interval" in config):
+        config["checkpoint_interval"] = 0
+    if not ("target_level" in config):
+        config["target_level"] = None
+    if not ("target_downsample" in config):
+        config["target_downsample"] = None
+    if not ("target_mpp" in config):
+        config["target_mpp"] = None
+    if not ("output_scales" in config):
+        config["output_scales"] = []
+    if not ("mask_cache_dir" in config):
+        config["mask_cache_dir"] = None
+    if not ("mask_cache_size_mb" in config):
+        config["mask_cache_size_mb"] = 1024
+    if not ("tile_cache_mb" in config):
+        config["tile_cache_mb"] = 0
+    if not ("pipeline" in config):
+        config["pipeline"] = False
+    if not ("metrics" in config):
+        config["metrics"] = False
+    if not ("metrics_hooks" in config):
+        config["metrics_hooks"] = []
 
     return config
 
 
-def generate_initial_mask(slide_path, scale):
+def generate_initial_mask(slide_path, scale, cache=None):
     """
     Helper method to generate random coordinates within a slide
     :param slide_path: Path to slide (str)
-    :param num_patches: Number of patches you want to generate
-    :return: list of n (x,y) coordinates
+    :param scale: Downsampling factor of the mask relative to the slide
+    :param cache: Optional MaskCache (see opm.mask_cache) to reuse masks generated in earlier runs
+    :return: (tissue mask, (x, y) scale of the mask relative to the slide)
     """
+    if cache is not None:
+        key = cache.get_key(slide_path, scale, {"method": "tissue_mask",
+                                                "min_hue": TISSUE_MIN_HUE,
+                                                "max_hue": TISSUE_MAX_HUE,
+                                                "min_sat": TISSUE_MIN_SAT})
+        cached = cache.get(key)
+        if cached is not None:
+            print("Using cached tissue mask for {}".format(slide_path))
+            return cached
+        mask, real_scale = generate_initial_mask(slide_path, scale)
+        cache.put(key, mask, real_scale)
+        return mask, real_scale
+
+    import tiffslide
+    start = time.time()
     # Open slide and get properties
     slide = tiffslide.open_slide(slide_path)
     slide_dims = slide.dimensions
 
     # Call thumbnail for effiency, calculate scale relative to whole slide
-    slide_thumbnail = np.asarray(
-        slide.get_thumbnail((slide_dims[0] // scale, slide_dims[1] // scale))
-    )
+    slide_thumbnail = get_slide_thumbnail(slide, scale)
     real_scale = (
         slide_dims[0] / slide_thumbnail.shape[1],
         slide_dims[1] / slide_thumbnail.shape[0],
     )
 
-    return tissue_mask(slide_thumbnail), real_scale
+    mask = tissue_mask(slide_thumbnail)
+    print("Tissue mask for {} generated in {:.2f}s (peak RSS: {} MB)".format(
+        os.path.basename(slide_path), time.time() - start, get_peak_rss_mb()))
+    return mask, real_scale
 
 
-def get_patch_size_in_microns(input_slide_path, patch_size_from_config, verbose=False):
+def get_slide_thumbnail(slide, scale):
+    """
+    Downsample a slide by scale, reading from the closest pyramid level.
+    If that level is small enough (MAX_THUMBNAIL_LEVEL_BYTES), this is tiffslide's get_thumbnail, which decodes the
+    whole level at once. Otherwise (slides with a sparse or missing pyramid), the thumbnail is built block by block, so
+    only THUMBNAIL_BLOCK_SIZE x THUMBNAIL_BLOCK_SIZE pixels of the level are decoded at a time.
+    :param slide: tiffslide slide object
+    :param scale: Downsampling factor relative to level 0
+    :return: RGB(A) numpy thumbnail of about (height / scale, width / scale)
+    """
+    slide_dims = slide.dimensions
+    thumbnail_dims = (max(1, slide_dims[0] // scale), max(1, slide_dims[1] // scale))
+    level = slide.get_best_level_for_downsample(max(slide_dims[0] / thumbnail_dims[0],
+                                                    slide_dims[1] / thumbnail_dims[1]))
+    level_dims = slide.level_dimensions[level]
+    if level_dims[0] * level_dims[1] * 4 <= MAX_THUMBNAIL_LEVEL_BYTES:
+        return np.asarray(slide.get_thumbnail(thumbnail_dims))
+
+    level_downsample = slide.level_downsamples[level]
+    # Level pixels per thumbnail pixel, and thumbnail pixels covered by one block of the level
+    factor = (level_dims[0] / thumbnail_dims[0], level_dims[1] / thumbnail_dims[1])
+    block = (max(1, int(THUMBNAIL_BLOCK_SIZE // factor[0])), max(1, int(THUMBNAIL_BLOCK_SIZE // factor[1])))
+
+    thumbnail = np.empty((thumbnail_dims[1], thumbnail_dims[0], 3), dtype=np.uint8)
+    for y in range(0, thumbnail_dims[1], block[1]):
+        for x in range(0, thumbnail_dims[0], block[0]):
+            x_end, y_end = min(x + block[0], thumbnail_dims[0]), min(y + block[1], thumbnail_dims[1])
+            level_x, level_y = int(round(x * factor[0])), int(round(y * factor[1]))
+            level_x_end = min(int(round(x_end * factor[0])), level_dims[0])
+            level_y_end = min(int(round(y_end * factor[1])), level_dims[1])
+            region = slide.read_region((int(level_x * level_downsample), int(level_y * level_downsample)), level,
+                                       (level_x_end - level_x, level_y_end - level_y))
+            # Box filter: every thumbnail pixel is the average of the level pixels it covers
+            region = region.convert("RGB").resize((x_end - x, y_end - y), Image.BOX)
+            thumbnail[y:y_end, x:x_end] = np.asarray(region)
+    return thumbnail
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB, or None where the resource module is unavailable (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return int(peak / 1024)
+
+
+def get_target_downsample(slide, config):
+    """
+    Downsample, relative to level 0, that patches are mined at. Set by one of the target_mpp, target_downsample or
+    target_level config keys (checked in that order), and 1 (level 0) if none is set.
+    :param slide: tiffslide slide object
+    :param config: Config dict, see parse_config()
+    :return: float downsample
+    """
+    if config['target_mpp'] is not None:
+        import tiffslide
+        mpp = slide.properties.get(tiffslide.PROPERTY_NAME_MPP_X)
+        if not mpp:
+            raise ValueError("target_mpp is set, but the slide has no microns per pixel metadata.")
+        return float(config['target_mpp']) / float(mpp)
+    if config['target_downsample'] is not None:
+        return float(config['target_downsample'])
+    if config['target_level'] is not None:
+        return float(slide.level_downsamples[config['target_level']])
+    return 1.0
+
+
+def get_patch_size_in_microns(input_slide_path, patch_size_from_config, verbose=False, downsample=1.0):
     """
     This function takes a slide path and a patch size in microns and returns the patch size in pixels.
 
@@ -256,6 +521,8 @@ def get_patch_size_in_microns(input_slide_path, patch_size_from_config, verbose=
         input_slide_path (str): The input WSI path.
         patch_size_from_config (str): The patch size in microns.
         verbose (bool): Whether to provide verbose prints.
+        downsample (float): Downsample the patches are mined at (see get_target_downsample); sizes in microns are
+            converted to pixels at that resolution.
 
     Raises:
         ValueError: If the patch size is not a valid number in microns.
@@ -301,6 +568,7 @@ def get_patch_size_in_microns(input_slide_path, patch_size_from_config, verbose=
                         "Using mpp to calculate patch size for dimension {}".format(i)
                     )
                 # only enter if "m" is present in patch size
+                import tiffslide
                 input_slide = tiffslide.open_slide(input_slide_path)
                 metadata = input_slide.properties
                 if i == 0:
@@ -327,7 +595,7 @@ def get_patch_size_in_microns(input_slide_path, patch_size_from_config, verbose=
                         format(size_in_microns),
                     )
                 if magnification > 0:
-                    return_patch_size[i] = round(size_in_microns / magnification)
+                    return_patch_size[i] = round(size_in_microns / (magnification * downsample))
                     magnification_prev = magnification
             else:
                 return_patch_size[i] = float(patch_size[i])
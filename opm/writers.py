@@ -0,0 +1,565 @@
+import io
+import os
+import csv
+import glob
+import json
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+
+def encode_png(image, compress_level=6):
+    """
+    Encode an image as PNG in memory.
+    @param image: Numpy ndarray of the patch (2D, RGB or RGBA).
+    @param compress_level: zlib compression level, 0 (fastest, largest) to 9.
+    @return: bytes of the PNG file.
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(image)).save(buffer, format="PNG", compress_level=compress_level)
+    return buffer.getvalue()
+
+
+class PatchEncoder:
+    # File extension of every supported patch format
+    EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg", "npy": "npy"}
+
+    def __init__(self, patch_format="png", compress_level=6, jpeg_quality=90):
+        """
+        Encoder of patch arrays into file bytes, used for individual patch files and tar shard members. Images are
+        encoded with PIL directly, without going through skimage's plugin dispatch.
+        @param patch_format: 'png', 'webp' (lossless), 'jpeg' (lossy, alpha is dropped) or 'npy' (raw array).
+        @param compress_level: Effort from 0 (fastest, largest) to 9 (slowest, smallest). zlib level of PNG files,
+            scaled to WebP's method (0 to 6).
+        @param jpeg_quality: JPEG quality, 1 to 95.
+        """
+        if patch_format not in self.EXTENSIONS:
+            raise ValueError("Unrecognized patch_format '{}', use either {}.".format(
+                patch_format, ", ".join("'{}'".format(name) for name in self.EXTENSIONS)))
+        self.patch_format = patch_format
+        self.compress_level = int(compress_level)
+        self.jpeg_quality = int(jpeg_quality)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['patch_format'], config['compress_level'], config['jpeg_quality'])
+
+    @property
+    def extension(self):
+        return self.EXTENSIONS[self.patch_format]
+
+    # Compared by value, so patch records stay equal after a round trip through a worker process
+    def __eq__(self, other):
+        return isinstance(other, PatchEncoder) and \
+            (self.patch_format, self.compress_level, self.jpeg_quality) == \
+            (other.patch_format, other.compress_level, other.jpeg_quality)
+
+    def __hash__(self):
+        return hash((self.patch_format, self.compress_level, self.jpeg_quality))
+
+    def __repr__(self):
+        if self.patch_format == "npy":
+            return "PatchEncoder('npy')"
+        if self.patch_format == "jpeg":
+            return "PatchEncoder('jpeg', jpeg_quality={})".format(self.jpeg_quality)
+        return "PatchEncoder('{}', compress_level={})".format(self.patch_format, self.compress_level)
+
+    def label_map_encoder(self):
+        """
+        Encoder for label map patches, which must keep their values exactly: this encoder if it is PNG or npy, PNG at
+        the same compression level otherwise (WebP only stores 8-bit RGB(A), so 16-bit and single channel label maps
+        would not round-trip).
+        """
+        if self.patch_format in ("png", "npy"):
+            return self
+        return PatchEncoder("png", self.compress_level, self.jpeg_quality)
+
+    def encode(self, image):
+        """
+        @param image: Numpy ndarray of the patch (2D, RGB or RGBA).
+        @return: bytes of the encoded file.
+        """
+        if self.patch_format == "png":
+            return encode_png(image, self.compress_level)
+
+        buffer = io.BytesIO()
+        if self.patch_format == "npy":
+            np.save(buffer, np.ascontiguousarray(image), allow_pickle=False)
+        elif self.patch_format == "webp":
+            Image.fromarray(np.ascontiguousarray(image)).save(buffer, format="WEBP", lossless=True,
+                                                              method=round(self.compress_level * 6 / 9))
+        else:
+            if image.ndim == 3 and image.shape[2] == 4:
+                image = image[:, :, :3]
+            Image.fromarray(np.ascontiguousarray(image)).save(buffer, format="JPEG", quality=self.jpeg_quality)
+        return buffer.getvalue()
+
+
+def member_names(output_format, scale=None, encoder=None):
+    """
+    Names of the slide and label map members of a sample in an archive.
+    @param output_format: 'tar' or 'zarr'.
+    @param scale: Factor of an extra scale of the patch, None for the patch itself.
+    @param encoder: PatchEncoder of the slide patches in tar shards, defaults to PNG.
+    @return: (slide member name, label map member name)
+    """
+    if output_format == "tar":
+        encoder = PatchEncoder() if encoder is None else encoder
+        names = (encoder.extension, "lm." + encoder.label_map_encoder().extension)
+        prefix = "" if scale is None else "x{:g}.".format(scale)
+    elif output_format == "zarr":
+        names = ("slide", "label")
+        prefix = "" if scale is None else "x{:g}_".format(scale)
+    else:
+        raise ValueError("Unrecognized archive format '{}'.".format(output_format))
+    return prefix + names[0], prefix + names[1]
+
+
+def encode_members(output_format, slide_array, lm_array=None, composition="", scales=None, encoder=None):
+    """
+    Prepare the members of an archive sample for the given output format.
+    @param output_format: 'tar' (encoded bytes) or 'zarr' (raw arrays).
+    @param slide_array: ndarray of the slide patch.
+    @param lm_array: ndarray of the label map patch, or None.
+    @param composition: Label map composition string.
+    @param scales: Optional dict(factor => (slide ndarray, label map ndarray or None)) of extra scales of the patch.
+    @param encoder: PatchEncoder of the slide patches in tar shards, defaults to PNG. Label maps use its
+        label_map_encoder().
+    @return: dict of members, as expected by the matching writer's write_sample(). The slide patch comes first.
+    """
+    encoder = PatchEncoder() if encoder is None else encoder
+    encode_slide, encode_lm = encoder.encode, encoder.label_map_encoder().encode
+    if output_format != "tar":
+        encode_slide = encode_lm = (lambda array: array)
+    members = {}
+    for scale, (scale_slide, scale_lm) in [(None, (slide_array, lm_array))] + list((scales or {}).items()):
+        slide_name, lm_name = member_names(output_format, scale, encoder)
+        members[slide_name] = encode_slide(scale_slide)
+        if scale_lm is not None:
+            members[lm_name] = encode_lm(scale_lm)
+    if output_format == "tar" and lm_array is not None:
+        members["composition.txt"] = composition.encode()
+    return members
+
+
+class ShardWriter:
+    output_format = "tar"
+
+    def __init__(self, shard_dir, prefix, max_shard_size=1024 ** 3):
+        """
+        Append-only writer of size-capped tar shards, in the WebDataset layout: every sample is a group of consecutive
+        members named <key>.<extension>.
+
+        Each shard <prefix>-<number>.tar gets an index <prefix>-<number>.tar.idx with one JSON line per member (sample
+        key, member name, byte offset of its data in the tar, size), so members can be read without scanning the tar.
+        Shard numbering continues after any shards already in shard_dir, so earlier runs are never overwritten.
+        Safe to share between threads.
+        @param shard_dir: Folder the shards are written to.
+        @param prefix: Prefix of the shard file names (usually the slide name).
+        @param max_shard_size: A new shard is started once the current one would grow past this size (in bytes).
+        """
+        self.shard_dir = shard_dir
+        self.prefix = prefix
+        self.max_shard_size = max_shard_size
+        self.shard_path = None
+        self.shard_id = -1
+        self._file = None
+        self._tar = None
+        self._index = None
+        self._lock = threading.Lock()
+
+        Path(shard_dir).mkdir(parents=True, exist_ok=True)
+        existing = glob.glob(os.path.join(glob.escape(shard_dir), glob.escape(prefix) + "-[0-9]*.tar"))
+        for path in existing:
+            number = os.path.basename(path)[len(prefix) + 1:-len(".tar")]
+            if number.isdigit():
+                self.shard_id = max(self.shard_id, int(number))
+
+    def _get_shard_path(self, shard_id):
+        return os.path.join(self.shard_dir, "{}-{:06d}.tar".format(self.prefix, shard_id))
+
+    def _next_shard(self):
+        self._close_shard()
+        self.shard_id += 1
+        self._open_shard(0, 0)
+
+    def _open_shard(self, offset, index_offset):
+        """
+        Open shard self.shard_id for writing, keeping its first offset bytes and the first index_offset bytes of its
+        index.
+        """
+        self.shard_path = self._get_shard_path(self.shard_id)
+        self._file = open(self.shard_path, "r+b" if offset > 0 else "wb")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        # A tarfile in "w" mode on an open file continues from the file's position
+        self._tar = tarfile.open(fileobj=self._file, mode="w")
+        self._index = open(self.shard_path + ".idx", "r+" if index_offset > 0 else "w")
+        self._index.truncate(index_offset)
+        self._index.seek(index_offset)
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._tar = None
+            self._index = None
+
+    def write_sample(self, key, members, coordinates=None):
+        """
+        Append one sample to the current shard.
+        @param key: Sample key, shared by all its members.
+        @param members: dict(extension => bytes), e.g. {"png": ..., "lm.png": ..., "composition.txt": ...}, with the
+            slide patch first and the label map patch under "lm.<extension>" (see encode_members()).
+        @param coordinates: Unused, the coordinates are part of the key.
+        @return: dict locating the sample: "slide" and "lm" member names, every member's name under "members", and
+            extra manifest "columns".
+        """
+        # Each member costs a header block plus its data, padded to whole blocks
+        sample_size = sum(tarfile.BLOCKSIZE + -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                          for data in members.values())
+        with self._lock:
+            if self._tar is None or (self._tar.offset > 0 and self._tar.offset + sample_size > self.max_shard_size):
+                self._next_shard()
+
+            for extension, data in members.items():
+                info = tarfile.TarInfo(name="{}.{}".format(key, extension))
+                info.size = len(data)
+                info.mtime = time.time()
+                self._tar.addfile(info, io.BytesIO(data))
+                # The data sits right before the tar's current offset, padded to a whole number of blocks
+                data_offset = self._tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                self._index.write(json.dumps({"key": key,
+                                              "name": info.name,
+                                              "offset": data_offset,
+                                              "size": info.size}) + "\n")
+            self._index.flush()
+            lm_extension = next((extension for extension in members if extension.startswith("lm.")), None)
+            return {"slide": "{}.{}".format(key, next(iter(members))),
+                    "lm": "{}.{}".format(key, lm_extension) if lm_extension is not None else None,
+                    "members": {extension: "{}.{}".format(key, extension) for extension in members},
+                    "columns": {"ShardPath": self.shard_path}}
+
+    def position(self):
+        """
+        Flush the current shard and describe how far writing got, see rollback().
+        @return: JSON-serialisable dict.
+        """
+        with self._lock:
+            if self._tar is None:
+                return {"shard_id": self.shard_id, "offset": None, "index_offset": None}
+            self._file.flush()
+            self._index.flush()
+            return {"shard_id": self.shard_id, "offset": self._tar.offset, "index_offset": self._index.tell()}
+
+    def rollback(self, position):
+        """
+        Drop every sample written after position, e.g. samples written after the checkpoint a run is resumed from:
+        later shards are deleted, and the shard that was open at the time is truncated and written to next.
+        Must not be called while samples are being written.
+        @param position: dict returned by position().
+        """
+        with self._lock:
+            self._close_shard()
+            for shard_id in range(position["shard_id"] + 1, self.shard_id + 1):
+                for path in (self._get_shard_path(shard_id), self._get_shard_path(shard_id) + ".idx"):
+                    if os.path.isfile(path):
+                        os.remove(path)
+            self.shard_id = position["shard_id"]
+            if position["offset"] is not None:
+                self._open_shard(position["offset"], position["index_offset"])
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+
+
+class ArrayStoreWriter:
+    output_format = "zarr"
+
+    def __init__(self, store_path, capacity_step=1024, flush_every=64):
+        """
+        Writer of patches into a chunked Zarr array store, so they can be sliced back into numpy without decoding.
+
+        The store holds a "slide" array of shape (N, H, W, C), a matching "label" array when label maps are mined, one
+        array per member for extra scales (e.g. "x2_slide"), and a "coordinates" table (N, 2) of (y, x) patch
+        coordinates. Each patch is its own uncompressed chunk, so workers
+        write disjoint chunks concurrently and readers can memory-map the chunk files directly. Arrays are created on
+        the first write and preallocated in steps of capacity_step; close() trims them to the number of patches.
+
+        The number of patches written is kept in the store's "count" attribute, updated every flush_every patches, on
+        flush() and on close(). Writing to an existing store appends to it: it is first trimmed to that count, so slots
+        that were reserved but never written (e.g. by a run that was killed) are not taken for patches.
+        @param store_path: Path of the Zarr store (a directory).
+        @param capacity_step: Minimum number of patches to grow the arrays by.
+        @param flush_every: Persist the count after this many patches.
+        """
+        import zarr
+        self.store_path = store_path
+        self.capacity_step = capacity_step
+        self.flush_every = flush_every
+        self.root = zarr.open_group(store_path, mode="a")
+        if "coordinates" in self.root:
+            self.coordinates = self.root["coordinates"]
+        else:
+            self.coordinates = self.root.create_dataset("coordinates", shape=(0, 2), chunks=(4096, 2), dtype=np.int64)
+        self.arrays = {name: self.root[name] for name in self.root.array_keys() if name != "coordinates"}
+        # Stores written before the count was persisted hold exactly their patches once closed
+        self.count = min(int(self.root.attrs.get("count", self.coordinates.shape[0])), self.coordinates.shape[0])
+        # Patches below this index are all written. Workers finish out of order, so it can trail count.
+        self.written = self.count
+        self.capacity = self.count
+        self._finished = set()
+        self._unflushed = 0
+        self._lock = threading.Lock()
+        self._resize(self.count)
+        self._flush_count()
+
+    def reserve(self, n_patches):
+        """
+        Make room for n_patches more patches. Call before handing work to the writers, so arrays are never resized
+        while other threads are writing into them.
+        """
+        with self._lock:
+            self._grow(self.count + n_patches)
+
+    def _grow(self, size):
+        if size <= self.capacity:
+            return
+        self._resize(max(size, self.capacity + self.capacity_step))
+
+    def _resize(self, capacity):
+        self.capacity = capacity
+        for array in self.arrays.values():
+            array.resize((capacity,) + array.shape[1:])
+        self.coordinates.resize((capacity, 2))
+
+    def _flush_count(self):
+        self.root.attrs["count"] = self.written
+        self._unflushed = 0
+
+    def _require_array(self, name, sample):
+        array = self.arrays.get(name)
+        if array is None:
+            if name in self.root:
+                array = self.root[name]
+            else:
+                array = self.root.create_dataset(name,
+                                                 shape=(self.capacity,) + sample.shape,
+                                                 chunks=(1,) + sample.shape,
+                                                 dtype=sample.dtype,
+                                                 compressor=None)
+            self.arrays[name] = array
+        return array
+
+    def write_sample(self, key, members, coordinates=None):
+        """
+        Write one patch (and its label map patch) to the next free index.
+        @param key: Unused, patches are identified by their index.
+        @param members: dict with a "slide" ndarray and optionally a "label" ndarray (and extra scales).
+        @param coordinates: (y, x) patch coordinates.
+        @return: dict locating the sample: "slide" and "lm" array entries, every member's entry under "members", and
+            extra manifest "columns".
+        """
+        with self._lock:
+            index = self.count
+            self.count += 1
+            self._grow(self.count)
+            arrays = {name: self._require_array(name, data) for name, data in members.items()}
+            if coordinates is not None:
+                self.coordinates[index] = [int(c) for c in coordinates]
+
+        # Every index is its own chunk, so these writes don't need the lock
+        for name, data in members.items():
+            arrays[name][index] = data
+
+        with self._lock:
+            self._finished.add(index)
+            while self.written in self._finished:
+                self._finished.remove(self.written)
+                self.written += 1
+                self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush_count()
+
+        return {"slide": "slide/{}".format(index),
+                "lm": "label/{}".format(index) if "label" in members else None,
+                "members": {name: "{}/{}".format(name, index) for name in members},
+                "columns": {"StorePath": self.store_path, "StoreIndex": index}}
+
+    def flush(self):
+        """
+        Persist the number of patches written so far.
+        @return: Number of patches in the store.
+        """
+        with self._lock:
+            self._flush_count()
+            return self.written
+
+    def position(self):
+        """
+        Persist the count and describe how far writing got, see rollback().
+        @return: JSON-serialisable dict.
+        """
+        return {"count": self.flush()}
+
+    def rollback(self, position):
+        """
+        Drop every patch written after position (see truncate()).
+        @param position: dict returned by position().
+        """
+        self.truncate(position["count"])
+
+    def truncate(self, n_patches):
+        """
+        Drop every patch after the first n_patches, e.g. patches written after the checkpoint a run is resumed from.
+        Must not be called while samples are being written.
+        """
+        with self._lock:
+            if n_patches >= self.count:
+                return
+            self.count = self.written = n_patches
+            self._finished.clear()
+            self._resize(n_patches)
+            self._flush_count()
+
+    def close(self):
+        with self._lock:
+            self._resize(self.count)
+            self._flush_count()
+
+
+class ManifestWriter:
+    def __init__(self, csv_path, flush_every=64):
+        """
+        Append-only writer of the output csv. Rows are written as they come in, instead of being collected in a
+        DataFrame and written at the end, so memory stays constant and a crashed run leaves a valid partial manifest.
+
+        An existing csv is appended to without being loaded; it is only scanned once to read its header and count its
+        rows. If rows bring columns the file doesn't have yet, the file is rewritten once with the extended header.
+        Safe to share between threads.
+        @param csv_path: Path of the csv.
+        @param flush_every: Flush to disk after this many rows (rows are always written whole).
+        """
+        self.csv_path = csv_path
+        self.flush_every = flush_every
+        self.columns = []
+        self.n_rows = 0
+        self._unflushed = 0
+        self._lock = threading.Lock()
+
+        if os.path.isfile(csv_path) and os.path.getsize(csv_path) > 0:
+            self.columns, self.n_rows, _ = _scan_csv(csv_path)
+        Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(csv_path, "a", newline="")
+
+    def _extend_columns(self, new_columns):
+        """
+        Rewrite the csv with extra columns (left empty for the rows already written).
+        """
+        self._file.close()
+        temp_path = self.csv_path + ".tmp"
+        with open(self.csv_path, newline="") as old_file, open(temp_path, "w", newline="") as new_file:
+            reader = csv.DictReader(old_file)
+            writer = csv.DictWriter(new_file, fieldnames=self.columns + new_columns, restval="")
+            writer.writeheader()
+            for row in reader:
+                writer.writerow(row)
+        os.replace(temp_path, self.csv_path)
+        self.columns = self.columns + new_columns
+        self._file = open(self.csv_path, "a", newline="")
+
+    def write_rows(self, rows):
+        """
+        Append rows to the manifest.
+        @param rows: list of dicts (column => value). Missing columns are left empty.
+        """
+        if not rows:
+            return
+        with self._lock:
+            new_columns = []
+            for row in rows:
+                for column in row:
+                    if column not in self.columns and column not in new_columns:
+                        new_columns.append(column)
+
+            if new_columns and not self.columns:
+                self.columns = new_columns
+                csv.writer(self._file).writerow(self.columns)
+            elif new_columns:
+                self._extend_columns(new_columns)
+
+            # Format every row first so each one reaches the file in a single write
+            buffer = io.StringIO()
+            csv.DictWriter(buffer, fieldnames=self.columns, restval="").writerows(rows)
+            self._file.write(buffer.getvalue())
+
+            self.n_rows += len(rows)
+            self._unflushed += len(rows)
+            if self._unflushed >= self.flush_every:
+                self._file.flush()
+                self._unflushed = 0
+
+    def write_row(self, row):
+        self.write_rows([row])
+
+    def flush(self):
+        """
+        Push every written row to disk.
+        @return: Number of rows in the csv (not counting the header).
+        """
+        with self._lock:
+            self._file.flush()
+            self._unflushed = 0
+            return self.n_rows
+
+    def truncate(self, n_rows):
+        """
+        Drop every row after the first n_rows, e.g. rows written after the checkpoint a run is resumed from.
+        """
+        with self._lock:
+            self._file.flush()
+            if n_rows >= self.n_rows:
+                return
+            _, _, offset = _scan_csv(self.csv_path, n_rows)
+            self._file.truncate(offset)
+            self.n_rows = n_rows
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _scan_csv(csv_path, max_rows=None):
+    """
+    Stream through a csv without loading it.
+    @param csv_path: Path of the csv.
+    @param max_rows: Stop after this many rows (not counting the header).
+    @return: (header columns, number of rows read, byte offset of the end of the last row read).
+    """
+    offset = 0
+
+    def lines(csv_file):
+        # csv.reader pulls one line at a time, so offset is always at the end of the last row it returned
+        nonlocal offset
+        for line in csv_file:
+            offset += len(line)
+            yield line.decode("utf-8")
+
+    with open(csv_path, "rb") as csv_file:
+        reader = csv.reader(lines(csv_file))
+        columns = next(reader, [])
+        n_rows = 0
+        end = offset
+        while max_rows is None or n_rows < max_rows:
+            if next(reader, None) is None:
+                break
+            n_rows += 1
+            end = offset
+    return columns, n_rows, end
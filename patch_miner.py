@@ -1,18 +1,13 @@
 import time
 import argparse
-import numpy as np
 import warnings
-import yaml
 import os
 
-import tiffslide
-from PIL import Image
 from pathlib import Path
 from functools import partial
-from opm.patch_manager import PatchManager
-from opm.utils import alpha_channel_check, patch_size_check, parse_config, generate_initial_mask, get_patch_size_in_microns
 
-Image.MAX_IMAGE_PIXELS = None
+# Everything else is imported by the mode that needs it (see benchmarks/bench_startup.py): replaying a coordinate csv
+# needs none of the masking code, and a batch run none of the single slide setup.
 warnings.simplefilter("ignore")
 
 
@@ -22,8 +17,11 @@ if __name__ == '__main__':
 
     parser.add_argument('-i', '--input_path',
                         dest='input_path',
-                        help="input path for the tissue",
-                        required=True)
+                        help="input path for the tissue")
+    parser.add_argument('-b', '--batch_list',
+                        dest='batch_list', default=None,
+                        help="CSV (SlidePath, optional LabelMapPath and SubjectID columns) or text file of slides to "
+                             "mine in one run, with a shared worker pool and a single output csv.")
     parser.add_argument('-c', '--config',
                         type=str,
                         dest='config',
@@ -41,8 +39,18 @@ if __name__ == '__main__':
     parser.add_argument('-icsv', '--input_csv',
                         dest='input_csv', default=None,
                         help="CSV with x,y coordinates of patches to mine.")
+    parser.add_argument('-r', '--resume',
+                        dest='resume', action='store_true',
+                        help="Continue an interrupted run from its last checkpoint in the output folder.")
 
     args = parser.parse_args()
+    if (args.input_path is None) == (args.batch_list is None):
+        parser.error("Provide exactly one of --input_path or --batch_list.")
+
+    from PIL import Image
+    from opm.utils import parse_config
+    Image.MAX_IMAGE_PIXELS = None
+
     if args.output_path is None:
         do_save_patches = False
         out_dir = ""
@@ -53,25 +61,41 @@ if __name__ == '__main__':
 
         do_save_patches = True
         out_dir = os.path.abspath(args.output_path)
+
+    if args.batch_list is not None:
+        from opm.batch import read_slide_list, mine_batch
+        mine_batch(read_slide_list(args.batch_list), parse_config(args.config), out_dir, args.output_csv,
+                   resume=args.resume)
+        print("Total time: {}".format(time.time() - start))
+        exit(0)
+
     # Path to openslide supported file (.svs, .tiff, etc.)
     slide_path = os.path.abspath(args.input_path)
 
     if not os.path.exists(slide_path):
         raise ValueError("Could not find the slide, could you recheck the path?")
 
+    from opm.patch_manager import PatchManager
     # Create new instance of slide manager
     manager = PatchManager(slide_path, args.output_path)
     cfg = parse_config(args.config)
 
     if args.input_csv is None:
-        # Generate an initial validity mask
-        mask, scale = generate_initial_mask(slide_path, cfg['scale'])
-        manager.set_valid_mask(mask, scale)
+        from opm.mask_cache import get_mask_cache
+        from opm.utils import alpha_channel_check, patch_size_check, generate_initial_mask, get_patch_size_in_microns, \
+            get_target_downsample
+        if args.resume and os.path.isfile(manager.get_checkpoint_path()):
+            print("Found checkpoint {}, resuming.".format(manager.get_checkpoint_path()))
+        else:
+            # Generate an initial validity mask
+            mask, scale = generate_initial_mask(slide_path, cfg['scale'], get_mask_cache(cfg))
+            manager.set_valid_mask(mask, scale)
         if args.label_map_path is not None:
             manager.set_label_map(args.label_map_path)
         
         ## trying to handle mpp
-        cfg['patch_size'] = get_patch_size_in_microns(slide_path, cfg['patch_size'], True)
+        cfg['patch_size'] = get_patch_size_in_microns(slide_path, cfg['patch_size'], True,
+                                                      get_target_downsample(manager.slide_object, cfg))
 
         # Reject patch if any pixels are transparent
         manager.add_patch_criteria(alpha_channel_check)
@@ -79,7 +103,7 @@ if __name__ == '__main__':
         patch_dims_check = partial(patch_size_check, patch_height=cfg['patch_size'][0], patch_width=cfg['patch_size'][1])
         manager.add_patch_criteria(patch_dims_check)
         # Save patches releases saves all patches stored in manager, dumps to specified output file
-        manager.mine_patches(output_csv=args.output_csv, config=cfg)
+        manager.mine_patches(output_csv=args.output_csv, config=cfg, resume=args.resume)
         print("Total time: {}".format(time.time() - start))
     else:
         if args.label_map_path is not None:
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_synthetic_slide
+from opm.utils import parse_config
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def synthetic_slide(tmp_path_factory):
+    """
+    Small tiled, pyramidal slide and label map. Its size is not a multiple of the tile size, so the last row and column
+    of tiles are partial.
+    @return: (slide path, label map path)
+    """
+    return make_synthetic_slide(str(tmp_path_factory.mktemp("slides")), 1000, 700, tile_size=256, levels=2)
+
+
+@pytest.fixture
+def config():
+    """
+    The shipped config.yml, with the defaults of every missing option filled in.
+    """
+    return parse_config(os.path.join(REPO_ROOT, "opm", "config.yml"))
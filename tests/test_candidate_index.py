@@ -0,0 +1,52 @@
+import numpy as np
+
+from opm.candidate_index import CandidateIndex
+from opm.packed_mask import PackedMask
+
+
+def random_mask(rng, shape=(37, 53), density=0.6):
+    return rng.random(shape) < density
+
+
+def test_draws_and_invalidation_match_brute_force():
+    rng = np.random.default_rng(0)
+    reference = random_mask(rng)
+    index = CandidateIndex(PackedMask(reference))
+
+    for step in range(200):
+        assert index.remaining == reference.sum()
+        np.testing.assert_array_equal(index.mask.to_array(), reference)
+
+        # draw_random picks the k-th remaining candidate in row-major order, with k from numpy's global RNG
+        np.random.seed(step)
+        drawn = index.draw_random()
+        np.random.seed(step)
+        expected = tuple(np.argwhere(reference)[np.random.randint(reference.sum())])
+        assert drawn == expected
+        assert index.draw_sequential() == tuple(np.argwhere(reference)[0])
+
+        if step % 3 == 0:
+            index.invalidate_point(*drawn)
+            reference[drawn] = False
+        else:
+            # Rectangles may extend past the mask, and are clipped like slicing
+            row, col = drawn
+            height, width = rng.integers(1, 12, 2)
+            index.invalidate(row - height // 2, row + height, col - width // 2, col + width)
+            reference[max(row - height // 2, 0):row + height, max(col - width // 2, 0):col + width] = False
+        if not reference.any():
+            break
+
+    assert index.remaining == reference.sum()
+
+
+def test_exhausted_index_draws_nothing():
+    index = CandidateIndex(np.zeros((4, 9), dtype=bool))
+    assert index.remaining == 0
+    assert index.draw_random() is None
+    assert index.draw_sequential() is None
+
+    index = CandidateIndex(np.ones((3, 3), dtype=bool))
+    index.invalidate(0, 3, 0, 3)
+    assert index.remaining == 0
+    assert index.draw_sequential() is None
@@ -0,0 +1,118 @@
+import os
+import glob
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+import zarr
+
+from opm.patch_manager import PatchManager
+
+
+class Killed(Exception):
+    pass
+
+
+def new_manager(slide_path, lm_path, output_dir):
+    manager = PatchManager(slide_path, output_dir)
+    # The synthetic slide is 1000 x 700, every location of a 1/10 scale mask can be drawn
+    manager.set_valid_mask(np.ones((70, 100), dtype=bool), (10, 10))
+    manager.set_label_map(lm_path)
+    return manager
+
+
+def mine_config(config, output_format):
+    return dict(config, output_format=output_format, num_patches=15, checkpoint_interval=5, num_workers=2,
+                patch_size=[64, 64])
+
+
+def read_output(output_dir, output_format):
+    """
+    Everything a run wrote, independent of where the output folder is: the manifest rows and the bytes or arrays of
+    every sample.
+    """
+    manifest = pd.read_csv(os.path.join(output_dir, "list.csv")).astype(str)
+    manifest = manifest.replace(output_dir, "", regex=True)
+    samples = {}
+    if output_format == "tar":
+        for index_path in sorted(glob.glob(os.path.join(output_dir, "shards", "*.tar.idx"))):
+            with open(index_path[:-len(".idx")], "rb") as shard:
+                for line in open(index_path):
+                    member = json.loads(line)
+                    shard.seek(member["offset"])
+                    samples[(os.path.basename(index_path), member["name"])] = shard.read(member["size"])
+    elif output_format == "zarr":
+        # Threads take store indices in completion order, so samples are compared in manifest order
+        store = zarr.open_group(glob.glob(os.path.join(output_dir, "*.zarr"))[0], mode="r")
+        order = manifest["StoreIndex"].astype(int).values
+        assert sorted(order) == list(range(store.attrs["count"]))
+        samples = {name: store[name][:][order] for name in store.array_keys()}
+        manifest = manifest.drop(columns=["SlidePatchPath", "LabelMapPatchPath", "StoreIndex"])
+    else:
+        for path in sorted(glob.glob(os.path.join(output_dir, "*", "*.png"))):
+            with open(path, "rb") as patch_file:
+                samples[os.path.relpath(path, output_dir)] = patch_file.read()
+    return manifest, samples
+
+
+@pytest.mark.parametrize("output_format", ["png", "tar", "zarr"])
+def test_resume_after_kill_matches_full_run(synthetic_slide, config, tmp_path, monkeypatch, output_format):
+    config = mine_config(config, output_format)
+    full_dir, resumed_dir = str(tmp_path / "full"), str(tmp_path / "resumed")
+
+    np.random.seed(0)
+    new_manager(*synthetic_slide, full_dir).mine_patches(config, output_csv=os.path.join(full_dir, "list.csv"))
+
+    # Kill the run when it is about to checkpoint its second batch: that batch is written, but not checkpointed
+    save_checkpoint = PatchManager.save_checkpoint
+    n_checkpoints = []
+
+    def killed_checkpoint(manager, *args, **kwargs):
+        # The first checkpoint is taken before mining starts
+        if len(n_checkpoints) == 2:
+            raise Killed()
+        n_checkpoints.append(args[0])
+        save_checkpoint(manager, *args, **kwargs)
+
+    np.random.seed(0)
+    monkeypatch.setattr(PatchManager, "save_checkpoint", killed_checkpoint)
+    with pytest.raises(Killed):
+        new_manager(*synthetic_slide, resumed_dir).mine_patches(config,
+                                                                output_csv=os.path.join(resumed_dir, "list.csv"))
+    monkeypatch.setattr(PatchManager, "save_checkpoint", save_checkpoint)
+    # Rows of the batch that was never checkpointed are already in the csv
+    assert len(pd.read_csv(os.path.join(resumed_dir, "list.csv"))) > n_checkpoints[-1]
+
+    # Another seed: everything after the checkpoint must come from the checkpoint's RNG state
+    np.random.seed(1)
+    new_manager(*synthetic_slide, resumed_dir).mine_patches(config, output_csv=os.path.join(resumed_dir, "list.csv"),
+                                                            resume=True)
+
+    full_manifest, full_samples = read_output(full_dir, output_format)
+    resumed_manifest, resumed_samples = read_output(resumed_dir, output_format)
+    assert len(full_manifest) == 15
+    pd.testing.assert_frame_equal(resumed_manifest, full_manifest)
+    assert resumed_samples.keys() == full_samples.keys()
+    for name in full_samples:
+        np.testing.assert_array_equal(np.asarray(resumed_samples[name]), np.asarray(full_samples[name]),
+                                      err_msg=str(name))
+
+
+def test_no_checkpoint_by_default(synthetic_slide, config, tmp_path):
+    output_dir = str(tmp_path / "out")
+    manager = new_manager(*synthetic_slide, output_dir)
+    manager.mine_patches(dict(config, patch_size=[64, 64]))
+    assert not os.path.exists(manager.get_checkpoint_path())
+    assert len(pd.read_csv(os.path.join(output_dir, "list.csv"))) == config["num_patches"]
+
+
+def test_checkpoint_path_depends_on_slide_folder(synthetic_slide, tmp_path):
+    # Same slide name in two folders, mined into one output folder
+    copies = []
+    for folder in ("a", "b"):
+        os.makedirs(str(tmp_path / folder))
+        copies.append(shutil.copy(synthetic_slide[0], str(tmp_path / folder)))
+    paths = [PatchManager(copy, str(tmp_path / "out")).get_checkpoint_path() for copy in copies]
+    assert paths[0] != paths[1]
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+import tiffslide
+from skimage.color.colorconv import rgb2hsv
+from skimage.filters import gaussian
+
+from benchmarks.synthetic import SyntheticSlide
+from opm import utils
+from tests.conftest import REPO_ROOT
+
+
+def reference_hue_range_mask(image, min_hue, max_hue, sat_min=0.05):
+    # Whole-image float64 version, as hue_range_mask was before it was computed in strips
+    hsv_image = rgb2hsv(image)
+    h_channel = gaussian(hsv_image[:, :, utils.HSV_HUE_CHANNEL])
+    s_channel = gaussian(hsv_image[:, :, utils.HSV_SAT_CHANNEL])
+    return (h_channel > min_hue) & (h_channel < max_hue) & (s_channel > sat_min)
+
+
+def reference_hsv_mask(image):
+    hsv_image = rgb2hsv(image)
+    return (hsv_image[:, :, utils.HSV_SAT_CHANNEL] <= utils.MIN_SAT) | \
+        (hsv_image[:, :, utils.HSV_VAL_CHANNEL] <= utils.MIN_VAL)
+
+
+def mask_images():
+    rng = np.random.default_rng(0)
+    images = {"random": rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)}
+    for seed in range(3):
+        images["synthetic_{}".format(seed)] = SyntheticSlide(16 * 800, 16 * 600, 0.5, seed).render(2, 0, 0, 600, 800)
+    lm = tiffslide.open_slide(os.path.join(REPO_ROOT, "images", "example_lm.tiff"))
+    images["example_lm"] = lm.read_region((0, 0), lm.level_count - 1, lm.level_dimensions[-1], as_array=True)
+    return images
+
+
+def near_threshold_images():
+    # Colours exactly on TISSUE_MIN_HUE, TISSUE_MAX_HUE and TISSUE_MIN_SAT, with a little noise: the smoothed hue or
+    # saturation of most pixels sits right on the threshold, where any rounding difference from rgb2hsv and gaussian
+    # flips pixels of the mask
+    rng = np.random.default_rng(2)
+    colours = {"min_hue": ([180, 100, 200], 0.5), "max_hue": ([200, 100, 106], 0.5), "min_sat": ([200, 190, 199], 0.3)}
+    images = {}
+    for name, (colour, noise) in colours.items():
+        image = rng.normal(colour, noise, (400, 400, 3))
+        images[name] = np.clip(np.round(image), 0, 255).astype(np.uint8)
+    return images
+
+
+@pytest.fixture(params=[None, 5000], ids=["whole", "strips"])
+def strip_pixels(request, monkeypatch):
+    if request.param is not None:
+        monkeypatch.setattr(utils, "MASK_STRIP_PIXELS", request.param)
+
+
+@pytest.mark.parametrize("name, image", mask_images().items())
+def test_hue_range_mask_matches_rgb2hsv(strip_pixels, name, image):
+    expected = reference_hue_range_mask(image, utils.TISSUE_MIN_HUE, utils.TISSUE_MAX_HUE, utils.TISSUE_MIN_SAT)
+    actual = utils.hue_range_mask(image, utils.TISSUE_MIN_HUE, utils.TISSUE_MAX_HUE, utils.TISSUE_MIN_SAT)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("name, image", near_threshold_images().items())
+def test_hue_range_mask_matches_rgb2hsv_near_thresholds(strip_pixels, name, image):
+    expected = reference_hue_range_mask(image, utils.TISSUE_MIN_HUE, utils.TISSUE_MAX_HUE, utils.TISSUE_MIN_SAT)
+    # The images straddle the threshold, so both sides of it are checked
+    assert 0 < np.count_nonzero(expected) < expected.size
+    actual = utils.hue_range_mask(image, utils.TISSUE_MIN_HUE, utils.TISSUE_MAX_HUE, utils.TISSUE_MIN_SAT)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("name, image", mask_images().items())
+def test_basic_hsv_mask_matches_rgb2hsv(strip_pixels, name, image):
+    np.testing.assert_array_equal(utils.basic_hsv_mask(image), reference_hsv_mask(image))
+
+
+def test_basic_hsv_mask_matches_rgb2hsv_on_every_channel_range():
+    # Saturation and value only depend on the largest and smallest channel, this covers every uint8 pixel
+    maximum, minimum = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    maximum, minimum = maximum[maximum >= minimum], minimum[maximum >= minimum]
+    image = np.stack([maximum, minimum, minimum], axis=1).astype(np.uint8).reshape(-1, 1, 3)
+    np.testing.assert_array_equal(utils.basic_hsv_mask(image), reference_hsv_mask(image))
+
+
+def test_hue_saturation_matches_rgb2hsv():
+    image = np.random.default_rng(1).integers(0, 256, (200, 200, 3), dtype=np.uint8)
+    # Channel ties decide which hue formula applies
+    image[:50, :, 1] = image[:50, :, 2]
+    image[50:100, :, 0] = image[50:100, :, 1]
+    hue, saturation = utils.hue_saturation(image)
+    hsv_image = rgb2hsv(image)
+    np.testing.assert_array_equal(hue, hsv_image[:, :, utils.HSV_HUE_CHANNEL])
+    np.testing.assert_array_equal(saturation, hsv_image[:, :, utils.HSV_SAT_CHANNEL])
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32, np.float64])
+def test_basic_hsv_mask_matches_rgb2hsv_on_other_dtypes(dtype):
+    # The same (maximum, minimum) pairs as for uint8, which put some pixels exactly on MIN_SAT and MIN_VAL
+    maximum, minimum = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    maximum, minimum = maximum[maximum >= minimum], minimum[maximum >= minimum]
+    image = np.stack([maximum, minimum, minimum], axis=1).reshape(-1, 1, 3)
+    if np.issubdtype(dtype, np.integer):
+        image = (image * (np.iinfo(dtype).max // 255)).astype(dtype)
+    else:
+        image = (image / 255).astype(dtype)
+    np.testing.assert_array_equal(utils.basic_hsv_mask(image), reference_hsv_mask(image))
@@ -0,0 +1,44 @@
+import numpy as np
+
+from opm.packed_mask import PackedMask
+
+
+def test_region_fraction_matches_mean():
+    rng = np.random.default_rng(0)
+    # Widths that are not a multiple of 8 leave a partial last byte in every row
+    for shape in [(1, 1), (13, 29), (64, 100), (200, 257)]:
+        mask = rng.random(shape) < 0.3
+        packed = PackedMask(mask)
+        np.testing.assert_array_equal(packed.to_array(), mask)
+
+        n_rects = 100
+        row_start = rng.integers(-5, shape[0] + 5, n_rects)
+        col_start = rng.integers(-5, shape[1] + 5, n_rects)
+        row_end = row_start + rng.integers(0, shape[0] + 5, n_rects)
+        col_end = col_start + rng.integers(0, shape[1] + 5, n_rects)
+        fractions = packed.region_fraction(row_start, row_end, col_start, col_end)
+
+        for i in range(n_rects):
+            region = mask[max(row_start[i], 0):max(row_end[i], 0), max(col_start[i], 0):max(col_end[i], 0)]
+            expected = np.mean(region) if region.size else 0.0
+            assert np.isclose(fractions[i], expected), (shape, i)
+
+
+def test_set_region_matches_slicing():
+    rng = np.random.default_rng(1)
+    mask = rng.random((20, 45)) < 0.5
+    packed = PackedMask(mask)
+    for _ in range(50):
+        row_start, col_start = rng.integers(-3, 25), rng.integers(-3, 50)
+        row_end, col_end = row_start + rng.integers(0, 10), col_start + rng.integers(0, 20)
+        value = bool(rng.integers(0, 2))
+        rows = slice(row_start, row_end)
+        cols = slice(col_start, col_end)
+        expected_changes = np.count_nonzero(mask[rows, cols] != value, axis=1)
+        changes = packed.set_region(row_start, row_end, col_start, col_end, value)
+        mask[rows, cols] = value
+        np.testing.assert_array_equal(packed.to_array(), mask)
+        if mask[rows, cols].size:
+            np.testing.assert_array_equal(changes, expected_changes)
+    np.testing.assert_array_equal(packed.row_counts(), mask.sum(axis=1))
+    assert packed.get(3, -1) == mask[3, -1]
@@ -0,0 +1,61 @@
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from opm.patch_manager import PatchManager
+from opm.utils import alpha_channel_check, patch_size_check, get_patch_class_proportions
+
+
+@pytest.fixture
+def manager(synthetic_slide, tmp_path):
+    manager = PatchManager(synthetic_slide[0], str(tmp_path))
+    manager.add_patch_criteria(alpha_channel_check)
+    manager.add_patch_criteria(partial(patch_size_check, patch_height=64, patch_width=64))
+    return manager
+
+
+def test_save_reads_patch_once(manager, tmp_path):
+    patch = manager.create_patch((100, 200), [64, 64])
+    accepted, saved_patch, summary = patch.save(str(tmp_path), process_method=get_patch_class_proportions)
+    assert accepted and saved_patch is patch
+    assert patch.read_count == 1
+
+    saved = np.asarray(Image.open(patch.get_patch_path(str(tmp_path), False)))
+    np.testing.assert_array_equal(saved, manager.create_patch((100, 200), [64, 64]).read_patch())
+
+
+def test_rejected_patch_is_read_once(manager, tmp_path):
+    manager.add_patch_criteria(lambda image: False)
+    patch = manager.create_patch((100, 200), [64, 64])
+    assert patch.save(str(tmp_path))[0] is False
+    assert patch.read_count == 1
+    assert not os.path.exists(patch.get_patch_path(str(tmp_path), False))
+
+
+@pytest.mark.parametrize("scales", [[2], [4], [2, 4]])
+def test_extract_scales_reads_each_level_once(manager, scales):
+    manager.set_output_scales(scales)
+    patch = manager.create_patch((300, 400), [64, 64])
+    arrays = patch.extract_scales()
+    assert len(arrays) == 1 + len(scales)
+    assert all(array.shape[:2] == (64, 64) for array in arrays)
+    levels = {patch.level} | {level for _, level, _, _ in patch.scales}
+    assert patch.read_count == len(levels)
+    # The patch is cropped from a shared read, identical to reading it on its own
+    np.testing.assert_array_equal(arrays[0], manager.create_patch((300, 400), [64, 64]).read_patch())
+
+
+def test_grid_iter_patches_prefilters_candidates(synthetic_slide, tmp_path, config):
+    manager = PatchManager(synthetic_slide[0], str(tmp_path))
+    manager.set_valid_mask(np.ones((70, 100), dtype=bool), (10, 10))
+    config = dict(config, read_type="grid", num_patches=-1, num_workers=2, patch_size=[64, 64], overlap_factor=0.0,
+                  min_tissue_fraction=0.0)
+    grid = manager.get_grid_coordinates(config['patch_size'])
+    # A grid tile past the slide's bottom right corner is rejected before it is read, like in mine_patches
+    manager.get_grid_coordinates = lambda *args, **kwargs: np.concatenate([[[680, 980]], grid])
+
+    coordinates = [tuple(sample[0]) for sample in manager.iter_patches(config)]
+    assert sorted(coordinates) == sorted(map(tuple, grid))
@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+
+from opm.pipeline import Pipeline
+
+
+def test_every_item_goes_through_every_stage():
+    pipeline = Pipeline(source=range(100),
+                        stages=[(lambda x: x * 2, 3), (lambda x: None if x % 3 == 0 else x + 1, 2)],
+                        queue_size=4)
+    assert sorted(pipeline) == sorted(x * 2 + 1 for x in range(100) if (x * 2) % 3 != 0)
+
+
+def test_queues_are_bounded():
+    depths = []
+    lock = threading.Lock()
+
+    def stage(item):
+        with lock:
+            depths.append(max(pipeline.queue_depths()))
+        return item
+
+    pipeline = Pipeline(source=range(200), stages=[(stage, 2)], queue_size=3)
+    assert len(list(pipeline)) == 200
+    assert max(depths) <= 3
+
+
+def test_stage_errors_are_raised_to_the_consumer():
+    def stage(item):
+        if item == 5:
+            raise ValueError("bad item")
+        return item
+
+    with pytest.raises(ValueError, match="bad item"):
+        list(Pipeline(source=range(100), stages=[(stage, 2)], queue_size=2))
+
+
+def test_closing_early_stops_the_source():
+    pipeline = Pipeline(source=iter(range(10 ** 9)), stages=[(lambda x: x, 2)], queue_size=2)
+    for item in pipeline:
+        if item > 10:
+            break
+    pipeline.close()
+    assert not any(thread.is_alive() for thread in pipeline._threads)
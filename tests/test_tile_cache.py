@@ -0,0 +1,46 @@
+import warnings
+
+import numpy as np
+import pytest
+import tiffslide
+
+from opm.tile_cache import TileCache, CachedSlide
+
+# (location, level, size) of regions straddling or past the slide edges (the slide is 1000 x 700)
+EDGE_REGIONS = [((-50, -30), 0, (100, 100)),
+                ((990, 690), 0, (64, 64)),
+                ((1010, 10), 0, (64, 64)),
+                ((10, 705), 0, (30, 30)),
+                ((3000, 3000), 0, (10, 10)),
+                ((950, 600), 1, (40, 40)),
+                ((1004, 0), 1, (16, 16))]
+
+
+@pytest.fixture
+def slides(synthetic_slide):
+    slide = tiffslide.open_slide(synthetic_slide[0])
+    return slide, CachedSlide(slide, TileCache(64 * 1024 ** 2))
+
+
+def assert_same_region(slide, cached, location, level, size):
+    with warnings.catch_warnings():
+        # tiffslide warns about every padded read
+        warnings.simplefilter("ignore")
+        expected = slide.read_region(location, level, size, as_array=True)
+        actual = cached.read_region(location, level, size, as_array=True)
+    np.testing.assert_array_equal(actual, expected, err_msg="region {} {} {}".format(location, level, size))
+
+
+@pytest.mark.parametrize("location, level, size", EDGE_REGIONS)
+def test_cached_read_matches_slide_at_edges(slides, location, level, size):
+    assert_same_region(*slides, location, level, size)
+
+
+def test_cached_read_matches_slide_on_random_regions(slides):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        level = int(rng.integers(0, 2))
+        size = tuple(int(side) for side in rng.integers(1, 300, 2))
+        location = tuple(int(coordinate) for coordinate in rng.integers(-200, 1200, 2))
+        assert_same_region(*slides, location, level, size)
+    assert slides[1].cache.hits > 0
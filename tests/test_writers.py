@@ -0,0 +1,107 @@
+import os
+import glob
+import json
+import tarfile
+
+import numpy as np
+import zarr
+
+from opm.writers import ArrayStoreWriter, ShardWriter
+
+
+def write_patches(writer, start, n_patches):
+    writer.reserve(n_patches)
+    for index in range(start, start + n_patches):
+        writer.write_sample(None, {"slide": np.full((4, 4, 3), index, dtype=np.uint8)}, coordinates=(index, 2 * index))
+
+
+def test_array_store_appends_to_existing_store(tmp_path):
+    store_path = str(tmp_path / "slide.zarr")
+    writer = ArrayStoreWriter(store_path)
+    write_patches(writer, 0, 3)
+    writer.close()
+
+    writer = ArrayStoreWriter(store_path)
+    assert writer.count == 3
+    write_patches(writer, 3, 2)
+    writer.close()
+
+    root = zarr.open_group(store_path, mode="r")
+    assert root.attrs["count"] == 5
+    assert root["slide"].shape == (5, 4, 4, 3)
+    np.testing.assert_array_equal(root["slide"][:, 0, 0, 0], np.arange(5))
+    np.testing.assert_array_equal(root["coordinates"][:], [[i, 2 * i] for i in range(5)])
+
+
+def test_array_store_ignores_reserved_slots_of_killed_run(tmp_path):
+    store_path = str(tmp_path / "slide.zarr")
+    writer = ArrayStoreWriter(store_path, capacity_step=1024, flush_every=1)
+    write_patches(writer, 0, 3)
+    # The run dies here: close() is never called and the arrays still hold 1024 slots
+    assert zarr.open_group(store_path, mode="r")["slide"].shape[0] == 1024
+
+    writer = ArrayStoreWriter(store_path)
+    assert writer.count == 3
+    assert writer.root["slide"].shape[0] == 3
+    write_patches(writer, 3, 1)
+    writer.close()
+    np.testing.assert_array_equal(zarr.open_group(store_path, mode="r")["slide"][:, 0, 0, 0], np.arange(4))
+
+
+def read_shards(shard_dir):
+    """
+    Every member of every shard, read through the .idx files and checked against the tar itself.
+    @return: dict(member name => bytes), in shard order
+    """
+    members = {}
+    for shard_path in sorted(glob.glob(os.path.join(shard_dir, "*.tar"))):
+        with tarfile.open(shard_path) as tar, open(shard_path, "rb") as shard:
+            names = tar.getnames()
+            indexed = [json.loads(line) for line in open(shard_path + ".idx")]
+            assert [entry["name"] for entry in indexed] == names
+            for entry in indexed:
+                shard.seek(entry["offset"])
+                data = shard.read(entry["size"])
+                assert tar.extractfile(entry["name"]).read() == data
+                members[entry["name"]] = data
+    return members
+
+
+def write_samples(writer, keys):
+    for key in keys:
+        writer.write_sample(key, {"png": key.encode() * 300, "lm.png": key.encode(), "composition.txt": b"{}"})
+
+
+def test_shard_writer_round_trip(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    writer = ShardWriter(shard_dir, "slide", max_shard_size=8 * 1024)
+    location = writer.write_sample("a", {"png": b"x" * 1000, "lm.png": b"y", "composition.txt": b"{}"})
+    assert location["slide"] == "a.png" and location["lm"] == "a.lm.png"
+    write_samples(writer, ["b", "c", "d", "e"])
+    writer.close()
+    # Shards are capped, and a sample is never split between two shards
+    assert len(glob.glob(os.path.join(shard_dir, "*.tar"))) > 1
+
+    # A new writer adds shards after the existing ones
+    writer = ShardWriter(shard_dir, "slide", max_shard_size=8 * 1024)
+    write_samples(writer, ["f"])
+    writer.close()
+
+    members = read_shards(shard_dir)
+    assert list(members) == ["a.png", "a.lm.png", "a.composition.txt"] + \
+        ["{}.{}".format(key, extension) for key in "bcdef" for extension in ("png", "lm.png", "composition.txt")]
+    assert members["f.png"] == b"f" * 300
+
+
+def test_shard_writer_rollback(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    writer = ShardWriter(shard_dir, "slide", max_shard_size=8 * 1024)
+    write_samples(writer, ["a", "b"])
+    position = writer.position()
+    write_samples(writer, ["c", "d", "e", "f"])
+    # Killed: the shards are never closed
+    writer = ShardWriter(shard_dir, "slide", max_shard_size=8 * 1024)
+    writer.rollback(position)
+    write_samples(writer, ["g"])
+    writer.close()
+    assert [name.split(".")[0] for name in read_shards(shard_dir)][::3] == ["a", "b", "g"]